@@ -2,18 +2,24 @@ import argparse
 import os
 import re
 import sys
+from decimal import Decimal
 
 from snet.contracts import get_all_abi_contract_files, get_contract_def
 
-from snet.cli.commands.commands import ContractCommand, IdentityCommand, NetworkCommand, OrganizationCommand, SessionSetCommand, SessionShowCommand, VersionCommand
+from snet.cli.commands.commands import AgentCommand, ContractCommand, IdentityCommand, NetworkCommand, OrganizationCommand, SessionSetCommand, SessionShowCommand, VersionCommand
 from snet.cli.commands.mpe_account import MPEAccountCommand
 from snet.cli.commands.mpe_channel import MPEChannelCommand
-from snet.cli.commands.mpe_client import MPEClientCommand
+from snet.cli.commands.mpe_client import MPEClientCommand, DEFAULT_PREPAID_CALLS, DEFAULT_ENDPOINT_CACHE_TTL, \
+    DEFAULT_ENDPOINT_PROBE_TIMEOUT, DEFAULT_REGISTRY_CHECK_INTERVAL
 from snet.cli.commands.mpe_service import MPEServiceCommand
 from snet.cli.commands.mpe_treasurer import MPETreasurerCommand
 from snet.cli.commands.sdk_command import SDKCommand
 from snet.cli.config import Config, get_session_keys, get_session_network_keys_removable
 from snet.cli.identity import get_identity_types
+from snet.cli.utils.call_output import OUTPUT_FORMATS
+from snet.cli.utils.fee_oracle import FEE_URGENCY_PERCENTILES
+from snet.cli.utils.key_agent import DEFAULT_AGENT_TTL
+from snet.cli.utils.receipt_waiter import DEFAULT_RECEIPT_TIMEOUT
 from snet.cli.utils.token2cogs import strtoken2cogs
 from snet.cli.utils.utils import type_converter
 
@@ -65,6 +71,9 @@ def add_root_options(parser, config):
     p = subparsers.add_parser("account", help="ASI(FET) account")
     add_mpe_account_options(p)
 
+    p = subparsers.add_parser("agent", help="Keep decrypted keys in memory of the background agent")
+    add_agent_options(p)
+
     p = subparsers.add_parser("channel", help="Interact with SingularityNET payment channels")
     add_mpe_channel_options(p)
 
@@ -114,6 +123,31 @@ def add_version_options(parser):
     parser.set_defaults(fn="show")
 
 
+def add_agent_options(parser):
+    parser.set_defaults(cmd=AgentCommand)
+
+    subparsers = parser.add_subparsers(title="actions", metavar="ACTION")
+    subparsers.required = True
+
+    p = subparsers.add_parser("start",
+                              help="Start the agent. Encrypted keys of key, mnemonic and keystore identities are "
+                                   "added to the agent after the password prompt and transactions are signed "
+                                   "by the agent until the keys expire")
+    p.set_defaults(fn="start")
+    p.add_argument("--ttl", type=int, default=DEFAULT_AGENT_TTL,
+                   help="Lifetime of keys in the agent in seconds (default: %(default)s)")
+    p.add_argument("--foreground", action="store_true", help="Do not detach, serve requests until interrupted")
+
+    p = subparsers.add_parser("stop", help="Stop the agent (all keys are forgotten)")
+    p.set_defaults(fn="stop")
+
+    p = subparsers.add_parser("status", help="Show keys held by the agent and their remaining lifetime")
+    p.set_defaults(fn="status")
+
+    p = subparsers.add_parser("remove-all", help="Remove all keys from the agent")
+    p.set_defaults(fn="remove_all_keys")
+
+
 def add_identity_options(parser, config):
     parser.set_defaults(cmd=IdentityCommand)
 
@@ -521,11 +555,38 @@ def add_transaction_arguments(parser):
         "--yes", "-y", action="store_true",
         help="Skip interactive confirmation of transaction payload",
         default=False)
+    transaction_g.add_argument(
+        "--fee-urgency", default="medium", choices=list(FEE_URGENCY_PERCENTILES),
+        help="Priority fee is the 10th (slow), 50th (medium) or 90th (fast) percentile of priority fees "
+             "in the last blocks (default medium). Ignored on networks without EIP-1559")
+    transaction_g.add_argument(
+        "--receipt-timeout", type=float, default=DEFAULT_RECEIPT_TIMEOUT,
+        help="Fail if the transaction hasn't been mined in the given number of seconds "
+             "(default %(default)s, 0 - wait forever)")
+    transaction_g.add_argument(
+        "--confirmations", type=int, default=0,
+        help="Number of blocks which should be mined on top of the transaction before we consider it final (default 0)")
     g = transaction_g.add_mutually_exclusive_group()
     g.add_argument("--quiet", "-q", action="store_true", help="Quiet transaction printing", default=False)
     g.add_argument("--verbose", "-v", action="store_true", help="Verbose transaction printing", default=False)
 
 
+def add_grpc_channel_arguments(parser):
+    g = parser.add_argument_group(title="grpc channel arguments (defaults to session.default_grpc_*)")
+    g.add_argument("--grpc-max-message-length",
+                   type=int,
+                   help="Maximal size of sent and received messages in bytes (default 1GB)")
+    g.add_argument("--grpc-keepalive-time-ms",
+                   type=int,
+                   help="Send http2 keepalive pings with the given interval in milliseconds (disabled by default)")
+    g.add_argument("--grpc-http2-window-size",
+                   type=int,
+                   help="Initial http2 flow control window in bytes, useful for large payloads on high-latency links")
+    g.add_argument("--grpc-compression",
+                   choices=["none", "gzip"],
+                   help="Compression of request messages (default none)")
+
+
 class AppendPositionalAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         positional_inputs = getattr(
@@ -816,12 +877,41 @@ def add_mpe_channel_options(parser):
     add_transaction_arguments(p)
 
 
+def add_p_payment_mode(p, allow_none=False):
+    p.add_argument("--payment-mode",
+                   default="escrow",
+                   choices=["escrow", "prepaid", "none"] if allow_none else ["escrow", "prepaid"],
+                   help="escrow - sign every call separately, "
+                        "prepaid - sign upfront for several calls and use token from the daemon (allows concurrent calls)"
+                        + (", none - send calls without payment (free calls or test daemon)" if allow_none else ""))
+    p.add_argument("--prepaid-calls",
+                   type=int,
+                   default=None,
+                   help="Number of calls we sign upfront in prepaid mode "
+                        "(default %i for call and the number of requests for call-batch)" % DEFAULT_PREPAID_CALLS)
+
+
 def add_mpe_client_options(parser):
     parser.set_defaults(cmd=MPEClientCommand)
     subparsers = parser.add_subparsers(title="Commands", metavar="COMMAND")
     subparsers.required = True
 
-    def add_p_set1_for_call(_p):
+    def add_p_endpoint_selection(_p):
+        _p.add_argument("--endpoint",
+                        help="Service endpoint (by default we select the fastest available endpoint from metadata)")
+        _p.add_argument("--endpoint-cache-ttl",
+                        type=float,
+                        default=DEFAULT_ENDPOINT_CACHE_TTL,
+                        help="How long (in seconds) we trust cached health and RTT of endpoints from metadata "
+                             "(default %i)" % DEFAULT_ENDPOINT_CACHE_TTL)
+        _p.add_argument("--endpoint-probe-timeout",
+                        type=float,
+                        default=DEFAULT_ENDPOINT_PROBE_TIMEOUT,
+                        help="Deadline for the health check of one endpoint in seconds "
+                             "(default %i)" % DEFAULT_ENDPOINT_PROBE_TIMEOUT)
+        add_grpc_channel_arguments(_p)
+
+    def add_p_method_and_params(_p, allow_streaming=True):
         _p.add_argument("--service",
                         default=None,
                         help="Name of protobuf service to call. It should be specified in case of method name conflict.")
@@ -831,8 +921,17 @@ def add_mpe_client_options(parser):
         _p.add_argument("params",
                         nargs='?',
                         help="JSON-serialized parameters object or path containing "
-                             "JSON-serialized parameters object (leave emtpy to read from stdin)",
+                             "JSON-serialized parameters object (leave emtpy to read from stdin)"
+                             + (". For client streaming methods it should be JSONL (one request per line)"
+                                if allow_streaming else ""),
                         metavar="PARAMS")
+
+    def add_p_set1_for_call(_p):
+        add_p_method_and_params(_p)
+        _p.add_argument("--chunk-size",
+                        type=int,
+                        default=1024 * 1024,
+                        help="Size of chunks for file_chunks@ parameters of client streaming methods (default 1MB)")
         add_eth_call_arguments(_p)
 
         add_p_mpe_address_opt(_p)
@@ -843,9 +942,16 @@ def add_mpe_client_options(parser):
         _p.add_argument("--save-field",
                         default=None,
                         nargs=2,
-                        help="Save specific field in the file (two arguments 'field' and 'file_name' should be specified)")
-        _p.add_argument("--endpoint",
-                        help="Service endpoint (by default we read it from metadata)")
+                        action="append",
+                        metavar=("FIELD", "FILENAME"),
+                        help="Save specific field in the file (two arguments 'field' and 'file_name' should be specified). "
+                             "Nested fields could be given as field1.field2, could be used several times")
+        _p.add_argument("--output-format",
+                        default="text",
+                        choices=OUTPUT_FORMATS,
+                        help="Format of printed responses: text (protobuf text format), json or ndjson "
+                             "(one response per line) (default text)")
+        add_p_endpoint_selection(_p)
         # p.add_argument("group-name",
         #                default=None,
         #                help="Name of the payment group. Parameter should be specified only for services with several payment groups")
@@ -858,6 +964,15 @@ def add_mpe_client_options(parser):
     add_group_name(p)
     add_p_set1_for_call(p)
     add_p_channel_id_opt(p)
+    add_p_payment_mode(p)
+    p.add_argument("--profile",
+                   action="store_true",
+                   default=False,
+                   help="Print time spent in each phase of the call (registry check, metadata, payment, rpc, ...)")
+    p.add_argument("--profile-json",
+                   default=None,
+                   help="Save time spent in each phase of the call in the JSON file",
+                   metavar="FILENAME")
     p.add_argument("--yes", "-y",
                    action="store_true",
                    help="Skip interactive confirmation of call price",
@@ -866,6 +981,107 @@ def add_mpe_client_options(parser):
                    action="store_true",
                    help="Skip check for service update",
                    default=False)
+    p.add_argument("--registry-check-interval",
+                   type=float,
+                   default=DEFAULT_REGISTRY_CHECK_INTERVAL,
+                   help="Scan Registry events for service update only if the last scan was more than "
+                        "this number of seconds ago (default %i). We always check it if daemon rejects the price"
+                        % DEFAULT_REGISTRY_CHECK_INTERVAL)
+
+    p = subparsers.add_parser("call-batch",
+                              help="Call server with many requests over one channel. "
+                                   "Call params are read from JSONL file (one JSON params object per line) "
+                                   "and results are written as JSONL in the input order.")
+    p.set_defaults(fn="call_server_batch")
+    add_p_org_id_service_id(p)
+    add_group_name(p)
+    p.add_argument("--service",
+                   default=None,
+                   help="Name of protobuf service to call. It should be specified in case of method name conflict.")
+    p.add_argument("method",
+                   help="Target service's method name to call",
+                   metavar="METHOD")
+    p.add_argument("--input",
+                   default=None,
+                   help="JSONL file with call params (leave empty to read from stdin)",
+                   metavar="FILENAME")
+    p.add_argument("--output",
+                   default=None,
+                   help="Write JSONL results to the file instead of stdout",
+                   metavar="FILENAME")
+    p.add_argument("--concurrency",
+                   type=int,
+                   default=1,
+                   help="Maximal number of requests in flight (default 1). It applies only to "
+                        "--payment-mode prepaid: escrow calls are always sent one by one, whatever --concurrency is")
+    p.add_argument("--max-retries",
+                   type=int,
+                   default=3,
+                   help="How many times we retry a request if daemon rejects its payment (default 3)")
+    add_eth_call_arguments(p)
+    add_p_mpe_address_opt(p)
+    add_p_endpoint_selection(p)
+    add_p_channel_id_opt(p)
+    add_p_payment_mode(p)
+    p.add_argument("--yes", "-y",
+                   action="store_true",
+                   help="Skip interactive confirmation of the total price",
+                   default=False)
+    p.add_argument("--skip-update-check",
+                   action="store_true",
+                   help="Skip check for service update",
+                   default=False)
+    p.add_argument("--registry-check-interval",
+                   type=float,
+                   default=DEFAULT_REGISTRY_CHECK_INTERVAL,
+                   help="Scan Registry events for service update only if the last scan was more than "
+                        "this number of seconds ago (default %i). We always check it if daemon rejects the price"
+                        % DEFAULT_REGISTRY_CHECK_INTERVAL)
+
+    p = subparsers.add_parser("bench",
+                              help="Benchmark the service through the payment path: send the same request many times "
+                                   "and report latency percentiles, errors and requests per second")
+    p.set_defaults(fn="bench_service")
+    add_p_org_id_service_id(p)
+    add_group_name(p)
+    # bench sends the same request of unary method and doesn't print responses
+    add_p_method_and_params(p, allow_streaming=False)
+    add_eth_call_arguments(p)
+    add_p_mpe_address_opt(p)
+    add_p_endpoint_selection(p)
+    add_p_channel_id_opt(p)
+    add_p_payment_mode(p, allow_none=True)
+    p.add_argument("--requests", "-n",
+                   type=int,
+                   default=100,
+                   help="Number of requests (default 100)")
+    p.add_argument("--concurrency",
+                   type=int,
+                   default=1,
+                   help="Maximal number of requests in flight (default 1). "
+                        "Escrow calls cannot be concurrent, use --payment-mode prepaid or none")
+    p.add_argument("--rate",
+                   type=float,
+                   default=None,
+                   help="Target rate in requests per second (by default we send the next request as soon as "
+                        "one of --concurrency workers is free). In this mode latency includes time in the queue")
+    p.add_argument("--histogram-buckets",
+                   type=int,
+                   default=10,
+                   help="Number of buckets in the latency histogram (default 10)")
+    p.add_argument("--yes", "-y",
+                   action="store_true",
+                   help="Skip interactive confirmation of the total price",
+                   default=False)
+    p.add_argument("--skip-update-check",
+                   action="store_true",
+                   help="Skip check for service update",
+                   default=False)
+    p.add_argument("--registry-check-interval",
+                   type=float,
+                   default=DEFAULT_REGISTRY_CHECK_INTERVAL,
+                   help="Scan Registry events for service update only if the last scan was more than "
+                        "this number of seconds ago (default %i)" % DEFAULT_REGISTRY_CHECK_INTERVAL)
 
     p = subparsers.add_parser("call-lowlevel",
                               help="Low level function for calling the server. Service should be already initialized.")
@@ -890,6 +1106,7 @@ def add_mpe_client_options(parser):
     add_p_channel_id(p)
     add_p_endpoint(p)
     add_eth_call_arguments(p)
+    add_grpc_channel_arguments(p)
 
 
 def add_mpe_service_options(parser):
@@ -1251,6 +1468,19 @@ def add_mpe_service_options(parser):
     p.set_defaults(fn="print_service_status")
     add_p_service_in_registry(p)
     add_p_group_name(p)
+    p.add_argument("--timeout",
+                   type=float,
+                   default=10,
+                   help="Deadline for the health check of one endpoint in seconds (default 10)")
+    p.add_argument("--repeat",
+                   type=int,
+                   default=1,
+                   help="Number of check rounds, 0 means repeat until interrupted. "
+                        "After several rounds p50/p99 latency is printed for each endpoint (default 1)")
+    p.add_argument("--interval",
+                   type=float,
+                   default=1,
+                   help="Pause between check rounds in seconds (default 1)")
 
     p = subparsers.add_parser("print-tags",
                               help="Print tags for given service from registry")
@@ -1287,8 +1517,24 @@ def add_mpe_treasurer_options(parser):
 
     def add_p_daemon_endpoint(_p):
         _p.add_argument("--endpoint",
-                        required=True,
-                        help="Daemon endpoint")
+                        action="append",
+                        help="Daemon endpoint. Could be given several times, daemons are queried concurrently "
+                             "and claims of all daemons are sent together")
+        _p.add_argument("--org-id",
+                        help="Instead of --endpoint take daemon endpoints from metadata of the service "
+                             "(--org-id and --service-id)")
+        _p.add_argument("--service-id",
+                        help="Service id, see --org-id")
+        _p.add_argument("--group-name",
+                        help="Use only endpoints of this payment group (by default endpoints of all groups are used)")
+        add_grpc_channel_arguments(_p)
+
+    def add_p_claim_batch_size(_p):
+        _p.add_argument("--claim-batch-size",
+                        type=int,
+                        default=20,
+                        help="Maximal number of channels claimed in one multiChannelClaim transaction (default 20). "
+                             "Failed batches are split and retried, single channels are claimed with channelClaim")
 
     p = subparsers.add_parser("print-unclaimed",
                               help="Print unclaimed payments")
@@ -1305,12 +1551,14 @@ def add_mpe_treasurer_options(parser):
                    help="Channels to claim",
                    metavar="CHANNELS")
     add_p_daemon_endpoint(p)
+    add_p_claim_batch_size(p)
     add_transaction_arguments(p)
 
     p = subparsers.add_parser("claim-all",
                               help="Claim all channels. We also claim all pending 'payments in progress' in case we 'lost' some payments.")
     p.set_defaults(fn="claim_all_channels")
     add_p_daemon_endpoint(p)
+    add_p_claim_batch_size(p)
     add_transaction_arguments(p)
 
     p = subparsers.add_parser("claim-expired",
@@ -1321,6 +1569,67 @@ def add_mpe_treasurer_options(parser):
                    default=34560,
                    help="Service expiration threshold in blocks (default is 34560 ~ 6 days with 15s/block)")
     add_p_daemon_endpoint(p)
+    add_p_claim_batch_size(p)
+    add_transaction_arguments(p)
+
+    p = subparsers.add_parser("run",
+                              help="Run the treasurer loop: periodically claim channels with unclaimed amount above "
+                                   "the threshold or close to expiration")
+    p.set_defaults(fn="run_treasurer")
+    p.add_argument("--interval",
+                   type=float,
+                   default=60,
+                   help="Interval between checks of unclaimed payments in seconds (default 60)")
+    p.add_argument("--amount-threshold",
+                   type=strtoken2cogs,
+                   default=None,
+                   help="Claim the channel if its unclaimed amount in ASI(FET) is at least this value "
+                        "(by default channels are claimed only close to expiration)")
+    p.add_argument("--expiration-threshold",
+                   type=int,
+                   default=34560,
+                   help="Claim the channel if it expires in less than this number of blocks "
+                        "(default is 34560 ~ 6 days with 15s/block)")
+    p.add_argument("--max-backoff",
+                   type=float,
+                   default=600,
+                   help="After failed checks the interval is doubled up to this number of seconds (default 600)")
+    p.add_argument("--metrics-port",
+                   type=int,
+                   default=None,
+                   help="Serve metrics in Prometheus text format on http://127.0.0.1:PORT/metrics")
+    p.add_argument("--max-iterations",
+                   type=int,
+                   default=None,
+                   help="Stop after this number of checks (by default run until interrupted)")
+    add_p_daemon_endpoint(p)
+    add_p_claim_batch_size(p)
+    add_transaction_arguments(p)
+
+    p = subparsers.add_parser("plan",
+                              help="Print the claim plan: unclaimed channels ranked by time to expiration and net value "
+                                   "(claimed amount minus estimated gas cost) within the gas budget")
+    p.set_defaults(fn="plan_claims")
+    p.add_argument("--gas-budget",
+                   type=int,
+                   default=None,
+                   help="Maximal total gas of claim transactions (by default there is no limit)")
+    p.add_argument("--token-price-in-eth",
+                   type=Decimal,
+                   default=None,
+                   help="Price of one ASI(FET) in ETH. If given, channels whose amount is worth less than "
+                        "the estimated gas cost are not claimed")
+    p.add_argument("--expiration-threshold",
+                   type=int,
+                   default=34560,
+                   help="Channels which expire in less than this number of blocks are claimed first "
+                        "(default is 34560 ~ 6 days with 15s/block)")
+    p.add_argument("--execute",
+                   action="store_true",
+                   default=False,
+                   help="Claim the planned channels")
+    add_p_daemon_endpoint(p)
+    add_p_claim_batch_size(p)
     add_transaction_arguments(p)
 
 
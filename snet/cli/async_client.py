@@ -0,0 +1,103 @@
+""" Asyncio client for paid calls of services (grpc.aio) """
+import asyncio
+import functools
+import sys
+
+import grpc
+
+from snet.cli.commands.mpe_client import MPEClientCommand, DEFAULT_PREPAID_CALLS, DEFAULT_ENDPOINT_CACHE_TTL, \
+    DEFAULT_ENDPOINT_PROBE_TIMEOUT, DEFAULT_REGISTRY_CHECK_INTERVAL
+from snet.cli.utils.utils import DefaultAttributeObject, open_grpc_aio_channel
+
+
+class AsyncServiceClient(object):
+    """
+    Call unary methods of the service from asyncio code. Example:
+
+        async with AsyncServiceClient(Config(), "org_id", "service_id", "default_group") as client:
+            responses = await asyncio.gather(*[client.call("classify", params) for params in all_params])
+
+    The registry checks, the endpoint and channel selection are done once in open().
+    Payments are allocated by MPEClientCommand (local ledger in escrow mode or shared token in prepaid mode),
+    blocking parts of it are run in the default thread pool, and RPCs themselves are run on the grpc.aio channel,
+    so one event loop can have thousands of requests in flight (use payment_mode="prepaid" for this,
+    because daemon processes escrow payments of one channel one by one).
+    """
+
+    def __init__(self, config, org_id, service_id, group_name, channel_id=None, endpoint=None,
+                 payment_mode="escrow", prepaid_calls=DEFAULT_PREPAID_CALLS, skip_update_check=False,
+                 registry_check_interval=DEFAULT_REGISTRY_CHECK_INTERVAL, mpe_address=None, wallet_index=None,
+                 endpoint_cache_ttl=DEFAULT_ENDPOINT_CACHE_TTL, endpoint_probe_timeout=DEFAULT_ENDPOINT_PROBE_TIMEOUT,
+                 err_f=sys.stderr):
+        args = DefaultAttributeObject(org_id=org_id,
+                                      service_id=service_id,
+                                      group_name=group_name,
+                                      channel_id=channel_id,
+                                      endpoint=endpoint,
+                                      payment_mode=payment_mode,
+                                      prepaid_calls=prepaid_calls,
+                                      skip_update_check=skip_update_check,
+                                      registry_check_interval=registry_check_interval,
+                                      multipartyescrow_at=mpe_address,
+                                      wallet_index=wallet_index,
+                                      endpoint_cache_ttl=endpoint_cache_ttl,
+                                      endpoint_probe_timeout=endpoint_probe_timeout)
+        self._command = MPEClientCommand(config, args, out_f=None, err_f=err_f)
+        self._session = None
+        self._call_fns = {}
+        self._aio_channel = None
+
+    async def _run_in_executor(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+    async def open(self):
+        self._session = await self._run_in_executor(self._command.open_call_session)
+        self._aio_channel = open_grpc_aio_channel(self._session["endpoint"], self._command.get_grpc_channel_options())
+
+    async def close(self):
+        if self._aio_channel is not None:
+            await self._aio_channel.close()
+            self._aio_channel = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _get_call_fn(self, method, service=None):
+        if (service, method) not in self._call_fns:
+            self._call_fns[(service, method)] = self._command.get_unary_method(
+                self._session, self._aio_channel, method, service)
+        return self._call_fns[(service, method)]
+
+    @property
+    def price(self):
+        """ Price of one call in cogs """
+        return self._session["payment_state"]["price"]
+
+    async def call(self, method, params, service=None, timeout=None):
+        """
+        Call the method with the given params (dict with fields of the request message) and return response message.
+        service should be provided only in the case of conflicting method names
+        """
+        if self._aio_channel is None:
+            raise Exception("AsyncServiceClient is not opened")
+        call_fn, build_request = self._get_call_fn(method, service)
+        request = build_request(params)
+
+        payment_state = self._session["payment_state"]
+        rejected_generation = None
+        for attempt in range(2):
+            generation, metadata = await self._run_in_executor(
+                self._command.allocate_call_payment, payment_state, rejected_generation)
+            try:
+                return await call_fn(request, metadata=metadata, timeout=timeout,
+                                     compression=payment_state["compression"])
+            except grpc.RpcError as e:
+                await self._run_in_executor(self._command.release_failed_call_payment, payment_state, generation)
+                # payment could be rejected because the ledger or the prepaid token was out of date
+                if e.code() != grpc.StatusCode.UNAUTHENTICATED or attempt == 1:
+                    raise
+                rejected_generation = generation
@@ -1,29 +1,39 @@
 import base64
 import getpass
+import hashlib
 import json
 import secrets
 import sys
 from pathlib import Path
 from textwrap import indent
 
+import grpc
 import ipfshttpclient
 import jsonschema
 from lighthouseweb3 import Lighthouse
 import yaml
 import web3
 from cryptography.fernet import InvalidToken
+from web3.exceptions import ContractLogicError
 from snet.contracts import get_contract_def
 
 from snet.cli.contract import Contract
-from snet.cli.identity import KeyIdentityProvider, KeyStoreIdentityProvider, LedgerIdentityProvider, \
-    MnemonicIdentityProvider, RpcIdentityProvider, TrezorIdentityProvider, get_kws_for_identity_type
+from snet.cli.identity import AgentIdentityProvider, KeyIdentityProvider, KeyStoreIdentityProvider, \
+    LedgerIdentityProvider, MnemonicIdentityProvider, RpcIdentityProvider, TrezorIdentityProvider, \
+    get_kws_for_identity_type, check_pipelined_transaction, unlock_keystore_with_password
 from snet.cli.metadata.organization import OrganizationMetadata, PaymentStorageClient, Payment, Group
 from snet.cli.utils.config import get_contract_address, get_field_from_args_or_session, \
     read_default_contract_address, decrypt_secret
+from snet.cli.utils.fee_oracle import FeeOracle
 from snet.cli.utils.ipfs_utils import get_from_ipfs_and_checkhash, \
     hash_to_bytesuri, publish_file_in_ipfs, publish_file_in_filecoin
+from snet.cli.utils.key_agent import KeyAgentClient, get_agent_socket_path, get_running_agent, \
+    run_agent, start_agent_process
+from snet.cli.utils.nonce_manager import NonceManager, is_nonce_error
+from snet.cli.utils.receipt_waiter import DEFAULT_RECEIPT_TIMEOUT, ReceiptWaiter
 from snet.cli.utils.utils import DefaultAttributeObject, get_web3, is_valid_url, serializable, type_converter, \
-    get_cli_version, bytes32_to_str, bytesuri_to_hash, get_file_from_filecoin
+    get_cli_version, bytes32_to_str, bytesuri_to_hash, get_file_from_filecoin, get_grpc_channel_options, \
+    open_grpc_channel
 
 
 class Command(object):
@@ -91,6 +101,41 @@ class VersionCommand(Command):
         self._pprint({"version": get_cli_version()})
 
 
+class AgentCommand(Command):
+    def start(self):
+        client = KeyAgentClient(get_agent_socket_path())
+        if client.is_running():
+            self._printerr("Agent is already running on %s" % client.socket_path)
+            return
+        if self.args.foreground:
+            self._printerr("Agent is listening on %s" % client.socket_path)
+            run_agent(client.socket_path, self.args.ttl)
+            return
+        pid = start_agent_process(client.socket_path, self.args.ttl)
+        self._pprint({"agent": {"pid": pid, "socket": str(client.socket_path), "ttl": self.args.ttl}})
+
+    def stop(self):
+        client = self._get_running_agent_or_error()
+        client.stop()
+        self._printerr("Agent has been stopped")
+
+    def status(self):
+        client = self._get_running_agent_or_error()
+        self._pprint({"agent": {"socket": str(client.socket_path), "keys": client.list_keys()}})
+
+    def remove_all_keys(self):
+        client = self._get_running_agent_or_error()
+        for key in client.list_keys():
+            client.remove_key(key["key_id"])
+        self._printerr("All keys have been removed from the agent")
+
+    def _get_running_agent_or_error(self):
+        client = KeyAgentClient(get_agent_socket_path())
+        if not client.is_running():
+            self._error("Agent is not running on %s (start it with 'snet agent start')" % client.socket_path)
+        return client
+
+
 """
 # Temporally deprecated
 
@@ -123,10 +168,18 @@ class CachedGasPriceStrategy:
 
 
 class BlockchainCommand(Command):
-    def __init__(self, config, args, out_f=sys.stdout, err_f=sys.stderr, w3=None, ident=None):
+    def __init__(self, config, args, out_f=sys.stdout, err_f=sys.stderr, w3=None, ident=None, fee_oracle=None):
         super(BlockchainCommand, self).__init__(config, args, out_f, err_f)
         self.w3 = w3 or get_web3(self.get_eth_endpoint())
         self.ident = ident or self.get_identity()
+        self._fee_oracle = fee_oracle
+
+    @property
+    def fee_oracle(self):
+        """ FeeOracle of the command, it is shared with contract commands, so they share the fee history """
+        if self._fee_oracle is None:
+            self._fee_oracle = FeeOracle(self.w3)
+        return self._fee_oracle
 
     def get_eth_endpoint(self):
         # the only one source of eth_rpc_endpoint is the configuration file
@@ -153,6 +206,57 @@ class BlockchainCommand(Command):
         self._printerr("# gas_price = %f GWei" % (gas_price * 1E-9))
         return int(gas_price)
 
+    def get_fee_params_verbose(self):
+        """
+        EIP-1559 fee parameters for the --fee-urgency (slow, medium or fast) or legacy gasPrice
+        if the network doesn't support EIP-1559 or the identity is a hardware wallet (it signs only legacy transactions)
+        """
+        if not isinstance(self.ident, (LedgerIdentityProvider, TrezorIdentityProvider)):
+            self._printerr("# Calculating transaction fee... one moment..")
+            fee_params = self.fee_oracle.get_fee_params(getattr(self.args, "fee_urgency", None) or "medium")
+            if fee_params is not None:
+                self._printerr("# maxFeePerGas = %f GWei, maxPriorityFeePerGas = %f GWei" % (
+                    fee_params["maxFeePerGas"] * 1E-9, fee_params["maxPriorityFeePerGas"] * 1E-9))
+                return fee_params
+        return {"gasPrice": self.get_gas_price_verbose()}
+
+    def get_expected_gas_price(self):
+        """ Price per gas we expect to pay (for planning), see get_fee_params_verbose """
+        if not isinstance(self.ident, (LedgerIdentityProvider, TrezorIdentityProvider)):
+            gas_price = self.fee_oracle.get_expected_gas_price(getattr(self.args, "fee_urgency", None) or "medium")
+            if gas_price is not None:
+                return gas_price
+        return self.get_gas_price_verbose()
+
+    def _get_grpc_field_from_args_or_session(self, field_name):
+        value = getattr(self.args, field_name, None)
+        if value is None:
+            value = self.config.get_session_field("default_%s" % field_name, exception_if_not_found=False)
+        return value
+
+    def get_grpc_channel_options(self):
+        """ grpc channel options from command line arguments (--grpc-*) or session (default_grpc_*) """
+        def get_int(field_name):
+            value = self._get_grpc_field_from_args_or_session(field_name)
+            return int(value) if value else None
+
+        return get_grpc_channel_options(max_message_length=get_int("grpc_max_message_length"),
+                                        keepalive_time_ms=get_int("grpc_keepalive_time_ms"),
+                                        http2_window_size=get_int("grpc_http2_window_size"))
+
+    def get_grpc_compression(self):
+        """ per-call grpc compression from command line arguments or session (None means no compression) """
+        compression = self._get_grpc_field_from_args_or_session("grpc_compression")
+        if not compression or compression == "none":
+            return None
+        if compression == "gzip":
+            return grpc.Compression.Gzip
+        raise Exception("Unknown grpc compression: %s. Possible values: none, gzip" % compression)
+
+    def open_grpc_channel(self, endpoint):
+        """ open (or reuse already opened) grpc channel to the endpoint with configured channel options """
+        return open_grpc_channel(endpoint, self.get_grpc_channel_options(), reuse=True)
+
     def get_mpe_address(self):
         return get_contract_address(self, "MultiPartyEscrow")
 
@@ -177,13 +281,51 @@ class BlockchainCommand(Command):
 
     def check_ident(self):
         identity_type = self.config.get_session_field("identity_type")
+        if isinstance(self.ident, AgentIdentityProvider):
+            return
         if get_kws_for_identity_type(identity_type)[0][1] and not self.ident.private_key:
             if identity_type == "key":
                 secret = self.config.get_session_field("private_key")
+                key_id = "key:" + hashlib.sha256(secret.encode("utf-8")).hexdigest()[:16]
             else:
                 secret = self.config.get_session_field("mnemonic")
+                key_id = "mnemonic:%s:%i" % (hashlib.sha256(secret.encode("utf-8")).hexdigest()[:16],
+                                             self.ident.index)
+            if self._use_agent_identity(key_id):
+                return
             decrypted_secret = self._get_decrypted_secret(secret)
             self.ident.set_secret(decrypted_secret)
+            self._add_key_to_agent(key_id, self.ident.private_key)
+        elif identity_type == "keystore" and self.ident.private_key is None:
+            key_id = "keystore:" + str(Path(self.ident.path_to_keystore).expanduser().resolve())
+            if self._use_agent_identity(key_id):
+                return
+            if self.agent is not None:
+                # unlock now (instead of the first signature) to give the key to the agent
+                self.ident.private_key = unlock_keystore_with_password(self.w3, self.ident.path_to_keystore)
+                self._add_key_to_agent(key_id, self.ident.private_key)
+
+    @property
+    def agent(self):
+        """ Client of the running snet agent or None (checked once per command) """
+        if not hasattr(self, "_agent"):
+            self._agent = get_running_agent()
+        return self._agent
+
+    def _use_agent_identity(self, key_id):
+        """ Switch to signing by the agent if it holds the key """
+        if self.agent is None:
+            return False
+        address = self.agent.get_address(key_id)
+        if address is None:
+            return False
+        self.ident = AgentIdentityProvider(self.w3, self.agent, key_id, address)
+        return True
+
+    def _add_key_to_agent(self, key_id, private_key):
+        if self.agent is not None:
+            self.agent.add_key(key_id, private_key)
+            self._printerr("Key has been added to snet agent")
 
     def _get_decrypted_secret(self, secret):
         decrypted_secret = None
@@ -234,7 +376,8 @@ class BlockchainCommand(Command):
                                out_f=out_f,
                                err_f=err_f,
                                w3=self.w3,
-                               ident=self.ident)
+                               ident=self.ident,
+                               fee_oracle=self.fee_oracle)
 
     def call_contract_command(self, contract_name, contract_fn, contract_params, is_silent=True):
         contract_address = get_contract_address(self, contract_name)
@@ -246,6 +389,59 @@ class BlockchainCommand(Command):
         return self.get_contract_command(contract_name, contract_address, contract_fn, contract_params,
                                          is_silent).transact()
 
+    def get_nonce_manager(self):
+        """ nonce manager of the current identity (it should be called after check_ident) """
+        if getattr(self, "_nonce_manager", None) is None:
+            self._nonce_manager = NonceManager(self.w3, self.ident.get_address())
+        return self._nonce_manager
+
+    def send_contract_command(self, contract_name, contract_fn, contract_params, is_silent=False):
+        """ Send transaction with the locally assigned nonce without waiting for the receipt (see wait_for_contract_commands) """
+        contract_address = get_contract_address(self, contract_name)
+        return self.get_contract_command(contract_name, contract_address, contract_fn, contract_params,
+                                         is_silent).send(self.get_nonce_manager())
+
+    def get_receipt_waiter(self):
+        timeout = getattr(self.args, "receipt_timeout", None)
+        if timeout is None:
+            timeout = DEFAULT_RECEIPT_TIMEOUT
+        # --receipt-timeout 0 means that we wait forever
+        return ReceiptWaiter(self.w3, timeout=timeout or None,
+                             confirmations=getattr(self.args, "confirmations", None) or 0)
+
+    def wait_for_contract_commands(self, sent):
+        """ Wait for receipts of all transactions returned by send_contract_command at once. Return list of (receipt, events) """
+        if not sent:
+            return []
+        sent_by_hash = {s.txn_hash: s for s in sent}
+        receipts = self.get_receipt_waiter().wait(list(sent_by_hash),
+                                                  on_missing=lambda txn_hash: sent_by_hash[txn_hash].check_if_dropped())
+        return [s.process_receipt(receipt) for s, receipt in zip(sent, receipts)]
+
+    def transact_contract_commands(self, transactions, is_silent=False):
+        """
+        Send several transactions (list of (contract_name, contract_fn, contract_params)) with consecutive nonces
+        without waiting for the receipts, after that wait for all receipts. Return list of (receipt, events).
+        Gas estimation of the transaction could fail because it depends on the previous ones (deposit after approve),
+        in this case we wait for the already sent transactions and try again.
+        If the node rejects the nonce (another transaction has been sent from this address meanwhile), the nonce
+        manager is resynchronized with the node and the transaction is sent again.
+        """
+        self.check_ident()
+        results = []
+        sent = []
+        for contract_name, contract_fn, contract_params in transactions:
+            try:
+                sent.append(self.send_contract_command(contract_name, contract_fn, contract_params, is_silent))
+            except (ValueError, ContractLogicError) as e:
+                if is_nonce_error(e):
+                    self.get_nonce_manager().resync()
+                elif not sent:
+                    raise
+                results += self.wait_for_contract_commands(sent)
+                sent = [self.send_contract_command(contract_name, contract_fn, contract_params, is_silent)]
+        return results + self.wait_for_contract_commands(sent)
+
 
 class IdentityCommand(Command):
     def create(self):
@@ -386,14 +582,15 @@ class ContractCommand(BlockchainCommand):
         self._printout(result)
         return result
 
-    def transact(self):
+    def send(self, nonce_manager=None):
+        """ Build, sign and send the transaction without waiting for the receipt. Return SentTransaction """
         self.check_ident()
         contract_address = get_contract_address(self, self.args.contract_name,
                                                 "--at is required to specify target contract address")
 
         abi = self.args.contract_def["abi"]
 
-        contract = Contract(self.w3, contract_address, abi)
+        contract = Contract(self.w3, contract_address, abi, nonce_manager)
 
         positional_inputs = getattr(
             self.args, "contract_positional_inputs", [])
@@ -402,26 +599,54 @@ class ContractCommand(BlockchainCommand):
             in self.args.__dict__.items() if name.startswith("contract_named_input_")
         }
 
-        gas_price = self.get_gas_price_verbose()
+        fee_params = self.get_fee_params_verbose()
 
         txn = contract.build_transaction(self.args.contract_function,
                                          self.ident.get_address(),
-                                         gas_price,
+                                         fee_params,
                                          *positional_inputs,
                                          **named_inputs)
+        nonce = txn["nonce"]
 
         if not self.args.yes or self.args.verbose:
             self._pprint({"transaction": txn})
 
         proceed = self.args.yes or input("Proceed? (y/n): ") == "y"
 
-        if proceed:
-            receipt = self.ident.transact(txn, self.err_f)
-            events = contract.process_receipt(receipt)
-            self._pprint_receipt_and_events(receipt, events)
-            return receipt, events
-        else:
+        if not proceed:
+            if nonce_manager is not None:
+                nonce_manager.release(nonce)
             self._error("Cancelled")
+        try:
+            txn_hash, raw_transaction = self.ident.send_transaction(txn, self.err_f)
+        except Exception:
+            if nonce_manager is not None:
+                nonce_manager.release(nonce)
+            raise
+        return SentTransaction(self, contract, txn_hash, nonce, raw_transaction)
+
+    def transact(self):
+        return self.wait_for_contract_commands([self.send()])[0]
+
+
+class SentTransaction(object):
+    """ Transaction which has been sent, but we haven't got its receipt yet """
+
+    def __init__(self, command, contract, txn_hash, nonce, raw_transaction):
+        self.command = command
+        self.contract = contract
+        self.txn_hash = txn_hash
+        self.nonce = nonce
+        self.raw_transaction = raw_transaction
+
+    def check_if_dropped(self):
+        check_pipelined_transaction(self.command.w3, self.txn_hash, self.command.ident.get_address(), self.nonce,
+                                    self.raw_transaction)
+
+    def process_receipt(self, receipt):
+        events = self.contract.process_receipt(receipt)
+        self.command._pprint_receipt_and_events(receipt, events)
+        return receipt, events
 
 
 class OrganizationCommand(BlockchainCommand):
@@ -30,10 +30,12 @@ class MPEAccountCommand(BlockchainCommand):
         amount = self.args.amount
         mpe_address = self.get_mpe_address()
 
+        transactions = []
         already_approved = self.call_contract_command("FetchToken", "allowance", [self.ident.address, mpe_address])
         if already_approved < amount:
-            self.transact_contract_command("FetchToken", "approve", [mpe_address, amount])
-        self.transact_contract_command("MultiPartyEscrow", "deposit", [amount])
+            transactions.append(("FetchToken", "approve", [mpe_address, amount]))
+        transactions.append(("MultiPartyEscrow", "deposit", [amount]))
+        self.transact_contract_commands(transactions)
 
     def withdraw_from_mpe(self):
         self.check_ident()
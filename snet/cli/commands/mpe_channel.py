@@ -3,11 +3,13 @@ import os
 import pickle
 import shutil
 import tempfile
+import time
 from collections import defaultdict
 from importlib.metadata import metadata
 from pathlib import Path
 
 from eth_abi.codec import ABICodec
+from eth_utils import encode_hex, event_abi_to_log_topic
 from web3._utils.events import get_event_data
 from snet.contracts import get_contract_def, get_contract_deployment_block
 
@@ -16,9 +18,14 @@ from snet.cli.metadata.service import mpe_service_metadata_from_json, load_mpe_s
 from snet.cli.metadata.organization import OrganizationMetadata
 from snet.cli.utils.token2cogs import cogs2strtoken
 from snet.cli.utils.ipfs_utils import get_from_ipfs_and_checkhash
+from snet.cli.utils.proto_utils import build_method_index, save_method_index
 from snet.cli.utils.utils import abi_decode_struct_to_dict, abi_get_element_by_name, \
     compile_proto, type_converter, bytesuri_to_hash, get_file_from_filecoin, download_and_safe_extract_proto, \
-    check_training_in_proto
+    check_training_in_proto, bytes32_to_str, write_pickle_atomically
+
+# Registry events which could change metadata of organizations and services
+REGISTRY_ORG_EVENTS = ["OrganizationModified", "OrganizationDeleted"]
+REGISTRY_SERVICE_EVENTS = ["ServiceMetadataModified", "ServiceDeleted"]
 
 
 # we inherit MPEServiceCommand because we need _get_service_metadata_from_registry
@@ -176,6 +183,23 @@ class MPEChannelCommand(OrganizationCommand):
     def is_org_initialized(self):
         return os.path.isfile(self._get_org_info_file(self.args.org_id))
 
+    def _get_registry_checkpoint_file(self, org_id, service_id):
+        return os.path.join(self._get_service_base_dir(org_id, service_id), "registry_checkpoint.pickle")
+
+    def _save_registry_checkpoint(self, block_number):
+        fn = self._get_registry_checkpoint_file(self.args.org_id, self.args.service_id)
+        write_pickle_atomically(fn, {"block_number": block_number, "checked_at": time.time()})
+
+    def _read_registry_checkpoint(self):
+        fn = self._get_registry_checkpoint_file(self.args.org_id, self.args.service_id)
+        if not os.path.isfile(fn):
+            return None
+        try:
+            with open(fn, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
     def _check_mpe_address_metadata(self, metadata):
         """ we make sure that MultiPartyEscrow address from metadata is correct """
         mpe_address = self.get_mpe_address()
@@ -365,11 +389,13 @@ class MPEChannelCommand(OrganizationCommand):
 
     def channel_claim_timeout_all(self):
         channels_ids = self._get_filtered_channels(return_only_id=True, sender=self.ident.address)
+        current_block = self.ident.w3.eth.block_number
+        transactions = []
         for channel_id in channels_ids:
             response = self._get_channel_state_from_blockchain(channel_id)
-            if response["value"] > 0 and response["expiration"] < self.ident.w3.eth.block_number:
-                self.transact_contract_command(
-                    "MultiPartyEscrow", "channelClaimTimeout", [channel_id])
+            if response["value"] > 0 and response["expiration"] < current_block:
+                transactions.append(("MultiPartyEscrow", "channelClaimTimeout", [channel_id]))
+        self.transact_contract_commands(transactions)
 
     def _channel_extend_add_funds_with_channel_id(self, channel_id):
         if self.args.amount is None and self.args.expiration is None:
@@ -609,6 +635,9 @@ class MPEChannelCommand(OrganizationCommand):
             if not compile_proto(Path(spec_dir), service_dir, add_training = training_added):
                 raise Exception("Fail to compile %s/*.proto" % spec_dir)
 
+            # index all methods once, so the call path imports only the module it needs
+            save_method_index(service_dir, build_method_index(service_dir))
+
             # save service_metadata.json in channel_dir
             metadata.save_pretty(os.path.join(
                 service_dir, "service_metadata.json"))
@@ -644,3 +673,57 @@ class MPEChannelCommand(OrganizationCommand):
         service_metadata = self._get_service_metadata_from_registry()
         self._init_or_update_service_if_needed(
             service_metadata, service_registration)
+
+    def _get_registry_events(self, org_id, from_block, to_block):
+        """
+        Return names of Registry events for the given organization (only events which could change
+        organization or service metadata) and ids of the services they are related to: [(event_name, service_id)]
+        service_id is None for organization events
+        """
+        abi = get_contract_def("Registry")
+        events_abi = [abi_get_element_by_name(abi, name) for name in REGISTRY_ORG_EVENTS + REGISTRY_SERVICE_EVENTS]
+        topic_to_name = {encode_hex(event_abi_to_log_topic(a)): a["name"] for a in events_abi}
+        org_id_topic = encode_hex(type_converter("bytes32")(org_id))
+
+        logs = []
+        blocks_per_batch = 5000
+        while from_block <= to_block:
+            batch_to_block = min(from_block + blocks_per_batch, to_block)
+            logs += self.ident.w3.eth.get_logs({"fromBlock": from_block,
+                                                "toBlock": batch_to_block,
+                                                "address": self.get_registry_address(),
+                                                "topics": [list(topic_to_name), org_id_topic]})
+            from_block = batch_to_block + 1
+
+        events = []
+        for log in logs:
+            name = topic_to_name[encode_hex(log["topics"][0])]
+            service_id = bytes32_to_str(bytes(log["topics"][2])) if name in REGISTRY_SERVICE_EVENTS else None
+            events.append((name, service_id))
+        return events
+
+    def _init_or_update_registered_org_and_service_from_events(self, check_interval):
+        """
+        similar to _init_or_update_registered_org_if_needed and _init_or_update_registered_service_if_needed,
+        but instead of reading registrations from Registry on each call we scan Registry events of the organization
+        since the last checkpoint block (not more often than once in check_interval seconds),
+        and we read registrations only if there are events for our organization or service
+        """
+        checkpoint = self._read_registry_checkpoint() if self.is_service_initialized() else None
+        if checkpoint is None:
+            current_block = self.ident.w3.eth.block_number
+            self._init_or_update_registered_org_if_needed()
+            self._init_or_update_registered_service_if_needed()
+            self._save_registry_checkpoint(current_block)
+            return
+        if time.time() - checkpoint["checked_at"] < check_interval:
+            return
+
+        current_block = self.ident.w3.eth.block_number
+        if current_block > checkpoint["block_number"]:
+            events = self._get_registry_events(self.args.org_id, checkpoint["block_number"] + 1, current_block)
+            if any(service_id is None for _, service_id in events):
+                self._init_or_update_registered_org_if_needed()
+            if any(service_id == self.args.service_id for _, service_id in events):
+                self._init_or_update_registered_service_if_needed()
+        self._save_registry_checkpoint(current_block)
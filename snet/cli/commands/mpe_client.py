@@ -1,14 +1,38 @@
 import base64
+import contextlib
+import io
 import json
+import mmap
+import os
+import pickle
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import grpc
 from eth_account.messages import encode_defunct
 
 from snet.cli.commands.mpe_channel import MPEChannelCommand
+from snet.cli.utils.bench_stats import run_bench_requests, summarize_bench_results, latency_histogram, \
+    format_histogram
+from snet.cli.utils.call_output import CallOutput, response_to_dict
+from snet.cli.utils.daemon_stubs import get_daemon_stub_classes
+from snet.cli.utils.phase_timer import PhaseTimer
 from snet.cli.utils.token2cogs import cogs2strtoken
-from snet.cli.utils.proto_utils import import_protobuf_from_dir, switch_to_json_payload_encoding
-from snet.cli.utils.utils import open_grpc_channel, rgetattr, RESOURCES_PATH
+from snet.cli.utils.proto_utils import switch_to_fast_json_payload_encoding, \
+    build_method_index, save_method_index, load_method_index, find_method_in_index, import_protobuf_from_index, \
+    build_json_request, build_serialized_request, switch_to_serialized_requests
+from snet.cli.utils.utils import check_endpoint_health, file_lock, is_grpc_channel_ready, \
+    write_pickle_atomically
+
+
+# how many calls we sign upfront in prepaid mode (if --prepaid-calls is not given)
+DEFAULT_PREPAID_CALLS = 10
+# defaults of --endpoint-cache-ttl, --endpoint-probe-timeout and --registry-check-interval (in seconds)
+DEFAULT_ENDPOINT_CACHE_TTL = 300
+DEFAULT_ENDPOINT_PROBE_TIMEOUT = 5
+DEFAULT_REGISTRY_CHECK_INTERVAL = 15
 
 
 # we inherit MPEChannelCommand because client needs channels
@@ -22,9 +46,10 @@ class MPEClientCommand(MPEChannelCommand):
             [self.prefixInSignature, mpe_address, channel_id, nonce, amount])
 
     def _sign_message(self, mpe_address, channel_id, nonce, amount):
-        message = self._compose_message_to_sign(
-            mpe_address, channel_id, nonce, amount)
-        sign = self.ident.sign_message_after_solidity_keccak(message)
+        with self._phase("sign"):
+            message = self._compose_message_to_sign(
+                mpe_address, channel_id, nonce, amount)
+            sign = self.ident.sign_message_after_solidity_keccak(message)
         return sign
 
     def _verify_my_signature(self, signature, mpe_address, channel_id, nonce, amount):
@@ -44,8 +69,17 @@ class MPEClientCommand(MPEChannelCommand):
 
     # II. Call related functions (low level)
 
+    def _check_call_params_from_stdin(self, params_source):
+        """ Confirmation of the price is read from stdin, so call params could be read from stdin only with -y """
+        if params_source is not None and params_source != "-":
+            return
+        if not getattr(self.args, "yes", True) and getattr(self.args, "payment_mode", None) != "none":
+            self._error("Call params are read from stdin, so we cannot ask for confirmation of the price. "
+                        "Use -y to skip the confirmation")
+
     def _get_call_params(self):
         params_string = self.args.params
+        self._check_call_params_from_stdin(params_string)
 
         # try to read from command line
         if params_string is None or params_string == "-":
@@ -67,22 +101,49 @@ class MPEClientCommand(MPEChannelCommand):
             raise
 
         try:
-            params = self._transform_call_params(params)
+            params = self._transform_call_params(params, self._get_mapped_files())
         except Exception as e:
             self._printerr('Fail to "transform" call params')
             raise
 
         return params
 
-    def _transform_call_params(self, params):
+    @staticmethod
+    def _map_file(file_name, mapped_files):
+        """
+        Return read-only mmap of the file (pages are read only when they are needed and could be evicted).
+        mmap is added to mapped_files, they should be closed by _close_mapped_files after requests are built
+        """
+        with open(file_name, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mapped_files.append(data)
+        return data
+
+    @staticmethod
+    def _close_mapped_files(mapped_files):
+        while mapped_files:
+            mapped_files.pop().close()
+
+    def _get_mapped_files(self):
+        """ mmaps of file@ params of the single call, they are closed when the call command is done """
+        if not hasattr(self, "_mapped_files"):
+            self._mapped_files = []
+        return self._mapped_files
+
+    def _transform_call_params(self, params, mapped_files):
         """
         possible modifiers: file, b64encode, b64decode
         format:             modifier1@modifier2@...modifierN@k_final
+        file@ gives mmap of the file (it is added to mapped_files, see _map_file), so the content
+        of top level bytes fields is copied only once (see build_serialized_request).
+        b64encode@ returns the whole encoded content, so file@b64encode@ reads the whole file into memory
         """
         rez = {}
         for k, v in params.items():
             if isinstance(v, dict):
-                v = self._transform_call_params(v)
+                v = self._transform_call_params(v, mapped_files)
                 k_final = k
             else:
                 # k = modifier1@modifier2@...modifierN@k_final
@@ -91,8 +152,7 @@ class MPEClientCommand(MPEChannelCommand):
                 k_mods = k_split[:-1]
                 for m in k_mods:
                     if m == "file":
-                        with open(v, 'rb') as f:
-                            v = f.read()
+                        v = self._map_file(v, mapped_files)
                     elif m == "b64encode":
                         v = base64.b64encode(v)
                     elif m == "b64decode":
@@ -103,26 +163,112 @@ class MPEClientCommand(MPEChannelCommand):
             rez[k_final] = v
         return rez
 
-    def _import_protobuf_for_service(self):
+    def _iterate_streaming_call_params(self):
+        """
+        Lazily read call params for client streaming methods (one JSON params object per line).
+        A line can contain one top level "file_chunks@<field>" parameter: in this case the file
+        is sent as a stream of messages with --chunk-size bytes in <field> (other fields are repeated)
+        """
+        params_string = self.args.params
+        if params_string is None or params_string == "-":
+            self._printerr("Waiting for JSONL call params on stdin...")
+            yield from self._iterate_streaming_call_params_from_lines(sys.stdin)
+        elif Path(params_string).is_file():
+            self._printerr("Read call params from the file: %s" % params_string)
+            with open(params_string, "r") as f:
+                yield from self._iterate_streaming_call_params_from_lines(f)
+        else:
+            yield from self._iterate_streaming_call_params_from_lines(io.StringIO(params_string))
+
+    def _iterate_streaming_call_params_from_lines(self, lines):
+        for line in lines:
+            if not line.strip():
+                continue
+            params = json.loads(line)
+            chunked_keys = [k for k in params if k.startswith("file_chunks@")]
+            if len(chunked_keys) > 1:
+                raise Exception("Only one file_chunks@ parameter is allowed in one line of call params")
+            mapped_files = []
+            try:
+                if not chunked_keys:
+                    yield self._transform_call_params(params, mapped_files)
+                    continue
+                file_name = params.pop(chunked_keys[0])
+                field = chunked_keys[0][len("file_chunks@"):]
+                params = self._transform_call_params(params, mapped_files)
+                data = self._map_file(file_name, mapped_files)
+                for offset in range(0, len(data), self.args.chunk_size):
+                    # chunks are slices of mmap, they are copied only into the serialized request
+                    chunk = memoryview(data)[offset:offset + self.args.chunk_size]
+                    try:
+                        yield dict(params, **{field: chunk})
+                    finally:
+                        # the request with this chunk has been built when the next one is asked for
+                        chunk.release()
+            finally:
+                self._close_mapped_files(mapped_files)
+
+    def _get_call_params_for_method(self, index_entry):
+        if index_entry["streaming"] in ("client_streaming", "bidi_streaming"):
+            # params are read lazily, so we check stdin before the confirmation prompt
+            self._check_call_params_from_stdin(self.args.params)
+            return self._iterate_streaming_call_params()
+        return self._get_call_params()
+
+    def _get_method_index(self):
         spec_dir = self.get_service_spec_dir(
             self.args.org_id, self.args.service_id)
-        return import_protobuf_from_dir(spec_dir, self.args.method, self.args.service)
+        index = load_method_index(spec_dir)
+        if index is None:
+            # service was initialized by the old version of snet-cli, so we build the index only once
+            index = build_method_index(spec_dir)
+            save_method_index(spec_dir, index)
+        return index
 
-    def _call_server_via_grpc_channel(self, grpc_channel, channel_id, nonce, amount, params, service_metadata):
-        stub_class, request_class, response_class = self._import_protobuf_for_service()
-
-        request = request_class(**params)
-        stub = stub_class(grpc_channel)
-        call_fn = getattr(stub, self.args.method)
+    def _get_method_index_entry(self):
+        return find_method_in_index(self._get_method_index(), self.args.method, self.args.service)
 
-        if service_metadata["encoding"] == "json":
-            switch_to_json_payload_encoding(call_fn, response_class)
+    def _import_protobuf_for_service(self, index_entry=None):
+        spec_dir = self.get_service_spec_dir(
+            self.args.org_id, self.args.service_id)
+        if index_entry is None:
+            index_entry = self._get_method_index_entry()
+        return import_protobuf_from_index(spec_dir, index_entry)
 
+    def _call_server_via_grpc_channel(self, grpc_channel, channel_id, nonce, amount, params, service_metadata):
         metadata = self._create_call_metadata(channel_id, nonce, amount)
-        return call_fn(request, metadata=metadata)
+        return self._call_server_with_metadata(grpc_channel, metadata, params, service_metadata)
 
-    def _create_call_metadata(self, channel_id, nonce, amount):
-        mpe_address = self.get_mpe_address()
+    def _call_server_with_metadata(self, grpc_channel, metadata, params, service_metadata):
+        """
+        For client streaming methods params is an iterator over params of request messages.
+        For server streaming methods we return an iterator over response messages
+        """
+        with self._phase("protobuf_import"):
+            index_entry = self._get_method_index_entry()
+            stub_class, request_class, response_class = self._import_protobuf_for_service(index_entry)
+            call_fn = getattr(stub_class(grpc_channel), self.args.method)
+            build_request = self._get_request_builder(call_fn, request_class, response_class, service_metadata)
+
+        with self._phase("build_request"):
+            if index_entry["streaming"] in ("client_streaming", "bidi_streaming"):
+                request = (build_request(p) for p in params)
+            else:
+                request = build_request(params)
+        with self._phase("rpc"):
+            return call_fn(request, metadata=metadata, compression=self.get_grpc_compression())
+
+    def _get_request_builder(self, call_fn, request_class, response_class, service_metadata):
+        """ Prepare call_fn for the payload encoding of the service and return function which builds request from params """
+        if service_metadata["encoding"] == "json":
+            switch_to_fast_json_payload_encoding(call_fn, response_class)
+            return lambda params: build_json_request(request_class, params)
+        switch_to_serialized_requests(call_fn)
+        return lambda params: build_serialized_request(request_class, params)
+
+    def _create_call_metadata(self, channel_id, nonce, amount, mpe_address=None):
+        if mpe_address is None:
+            mpe_address = self.get_mpe_address()
         signature = self._sign_message(mpe_address, channel_id, nonce, amount)
         return [("snet-payment-type",                 "escrow"),
                 ("snet-payment-channel-id",            str(channel_id)),
@@ -131,33 +277,87 @@ class MPEClientCommand(MPEChannelCommand):
                 ("snet-payment-channel-signature-bin", bytes(signature)),
                 ("snet-payment-mpe-address",           str(mpe_address))]
 
-    def _deal_with_call_response(self, response):
-        if self.args.save_response:
-            with open(self.args.save_response, "wb") as f:
-                f.write(response.SerializeToString())
-        elif self.args.save_field:
-            field = rgetattr(response, self.args.save_field[0])
-            file_name = self.args.save_field[1]
-            if type(field) == bytes:
-                with open(file_name, "wb") as f:
-                    f.write(field)
-            else:
-                with open(file_name, "w") as f:
-                    f.write(str(field))
-        else:
-            self._printout(response)
-
-    def _get_endpoint_from_metadata_or_args(self, metadata):
+    def _deal_with_call_response_for_method(self, response, index_entry):
+        """ Write the response (or the stream of responses for server streaming methods) as it arrives """
+        is_stream = index_entry["streaming"] in ("server_streaming", "bidi_streaming")
+        with CallOutput(self._printout, self.args.output_format, self.args.save_response, self.args.save_field,
+                        is_stream) as output:
+            if not is_stream:
+                with self._phase("output"):
+                    output.write(response)
+                return
+            responses = iter(response)
+            while True:
+                # responses of the stream arrive while we iterate, so waiting for them is the part of the rpc phase
+                with self._phase("rpc"):
+                    r = next(responses, None)
+                if r is None:
+                    break
+                with self._phase("output"):
+                    output.write(r)
+
+    def _get_endpoints_cache_file(self):
+        return Path.home().joinpath(".snet", "cache", "endpoints.pickle")
+
+    def _read_endpoints_cache(self):
+        cache_file = self._get_endpoints_cache_file()
+        if not cache_file.exists():
+            return {}
+        try:
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            return {}
+
+    def _update_endpoints_cache(self, checks):
+        """ checks is {endpoint: {"available": bool, "rtt": float or None, "checked_at": timestamp}} """
+        cache = self._read_endpoints_cache()
+        cache.update(checks)
+        write_pickle_atomically(self._get_endpoints_cache_file(), cache)
+
+    def _mark_endpoint_unavailable(self, endpoint):
+        self._update_endpoints_cache({endpoint: {"available": False, "rtt": None, "checked_at": time.time()}})
+
+    def _probe_endpoints(self, endpoints):
+        """ Concurrently check health and RTT of the endpoints and save results in the cache """
+        options = self.get_grpc_channel_options()
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+            results = list(executor.map(lambda e: check_endpoint_health(e, self.args.endpoint_probe_timeout, options),
+                                        endpoints))
+        now = time.time()
+        checks = {e: {"available": is_available, "rtt": rtt, "checked_at": now}
+                  for e, (is_available, rtt) in zip(endpoints, results)}
+        self._update_endpoints_cache(checks)
+        return checks
+
+    def _get_ranked_endpoints(self, metadata):
+        """
+        Return endpoints in the order we should try them: available endpoints sorted by RTT,
+        then endpoints which failed the last check (we still try them as the last resort).
+        Health and RTT are cached in ~/.snet/cache for --endpoint-cache-ttl seconds
+        """
         if self.args.endpoint:
-            return self.args.endpoint
+            return [self.args.endpoint]
         endpoints = metadata.get_all_endpoints_for_group(self.args.group_name)
         if not endpoints:
             raise Exception(
                 "Cannot find endpoint in metadata for the given payment group.")
-        if len(endpoints) > 1:
-            self._printerr(
-                "There are several endpoints for the given payment group. We will select %s" % endpoints[0])
-        return endpoints[0]
+        if len(endpoints) == 1:
+            return endpoints
+
+        cache = self._read_endpoints_cache()
+        now = time.time()
+        checks = {e: cache[e] for e in endpoints
+                  if e in cache and now - cache[e]["checked_at"] < self.args.endpoint_cache_ttl}
+        to_probe = [e for e in endpoints if e not in checks]
+        if to_probe:
+            checks.update(self._probe_endpoints(to_probe))
+
+        available = sorted((e for e in endpoints if checks[e]["available"]), key=lambda e: checks[e]["rtt"])
+        return available + [e for e in endpoints if not checks[e]["available"]]
+
+    def _get_endpoint_from_metadata_or_args(self, metadata):
+        return self._get_ranked_endpoints(metadata)[0]
 
     def call_server_lowlevel(self):
         self.check_ident()
@@ -165,26 +365,23 @@ class MPEClientCommand(MPEChannelCommand):
         self._init_or_update_registered_org_if_needed()
         self._init_or_update_registered_service_if_needed()
 
-        params = self._get_call_params()
+        index_entry = self._get_method_index_entry()
+        params = self._get_call_params_for_method(index_entry)
         service_metadata = self._get_service_metadata()
         endpoint = self._get_endpoint_from_metadata_or_args(service_metadata)
-        grpc_channel = open_grpc_channel(endpoint)
+        grpc_channel = self.open_grpc_channel(endpoint)
 
-        response = self._call_server_via_grpc_channel(
-            grpc_channel, self.args.channel_id, self.args.nonce, self.args.amount_in_cogs, params, service_metadata)
-        self._deal_with_call_response(response)
+        try:
+            response = self._call_server_via_grpc_channel(
+                grpc_channel, self.args.channel_id, self.args.nonce, self.args.amount_in_cogs, params, service_metadata)
+            self._deal_with_call_response_for_method(response, index_entry)
+        finally:
+            self._close_mapped_files(self._get_mapped_files())
 
     # III. Stateless client related functions
     def _get_channel_state_from_server(self, grpc_channel, channel_id):
 
-        # We should simply statically import everything, but it doesn't work because of the following issue in protobuf: https://github.com/protocolbuffers/protobuf/issues/1491
-        #from snet_cli.resources.proto.state_service_pb2      import ChannelStateRequest            as request_class
-        #from snet_cli.resources.proto.state_service_pb2_grpc import PaymentChannelStateServiceStub as stub_class
-        proto_dir = RESOURCES_PATH.joinpath("proto")
-        stub_class, request_class, _ = import_protobuf_from_dir(
-            proto_dir,
-            "GetChannelState"
-        )
+        stub_class, request_class, _ = get_daemon_stub_classes("GetChannelState")
         current_block = self.ident.w3.eth.block_number
         mpe_address = self.get_mpe_address()
         message = self.w3.solidity_keccak(
@@ -213,26 +410,27 @@ class MPEClientCommand(MPEChannelCommand):
         )
 
         error_message = "Error in _get_channel_state_from_server. My own signature from the server is not valid."
-        self._assert_validity_of_my_signature_or_zero_amount(
-            bytes(response.current_signature),
-            channel_id, state["current_nonce"],
-            state["current_signed_amount"],
-            error_message
-        )
-
-        if hasattr(response, "old_nonce_signed_amount"):
-            state["old_nonce_signed_amount"] = int.from_bytes(
-                response.old_nonce_signed_amount,
-                byteorder='big'
-            )
+        with self._phase("verify_signature"):
             self._assert_validity_of_my_signature_or_zero_amount(
-                bytes(response.old_nonce_signature),
-                channel_id,
-                state["current_nonce"] - 1,
-                state["old_nonce_signed_amount"],
+                bytes(response.current_signature),
+                channel_id, state["current_nonce"],
+                state["current_signed_amount"],
                 error_message
             )
 
+            if hasattr(response, "old_nonce_signed_amount"):
+                state["old_nonce_signed_amount"] = int.from_bytes(
+                    response.old_nonce_signed_amount,
+                    byteorder='big'
+                )
+                self._assert_validity_of_my_signature_or_zero_amount(
+                    bytes(response.old_nonce_signature),
+                    channel_id,
+                    state["current_nonce"] - 1,
+                    state["old_nonce_signed_amount"],
+                    error_message
+                )
+
         return state
 
     def _calculate_unspent_amount(self, blockchain, server):
@@ -265,7 +463,7 @@ class MPEClientCommand(MPEChannelCommand):
     def print_channel_state_statelessly(self):
         self.check_ident()
 
-        grpc_channel = open_grpc_channel(self.args.endpoint)
+        grpc_channel = self.open_grpc_channel(self.args.endpoint)
 
         current_nonce, current_amount, unspent_amount = self._get_channel_state_statelessly(
             grpc_channel,
@@ -284,34 +482,527 @@ class MPEClientCommand(MPEChannelCommand):
                         return pricing["price_in_cogs"]
         raise Exception("We do not support price model: %s" %(pricing["price_model"]))
 
+    def _check_service_for_update_if_needed(self, force=False):
+        """
+        if service is not initilized we will initialize it (unless we want skip registry check for update)
+        We scan Registry events for updates not more often than once in --registry-check-interval seconds,
+        if force is True we read registrations from Registry directly
+        """
+        if not force and (self.args.skip_update_check or getattr(self, "_is_service_checked", False)):
+            return
+        with self._phase("registry_check"):
+            if force:
+                current_block = self.ident.w3.eth.block_number
+                self._init_or_update_registered_org_if_needed()
+                self._init_or_update_registered_service_if_needed()
+                self._save_registry_checkpoint(current_block)
+            else:
+                self._init_or_update_registered_org_and_service_from_events(self.args.registry_check_interval or 0)
+        self._is_service_checked = True
+
+    def _is_price_rejection(self, rpc_error):
+        # daemon rejects escrow payment with "income ... does not equal to price ..." if we use the old price
+        return rpc_error.code() == grpc.StatusCode.UNAUTHENTICATED and "price" in (rpc_error.details() or "").lower()
+
+    def _update_price_after_rejection(self, old_price):
+        """ Daemon has rejected our payment because of the price, so the service metadata could be out of date """
+        self._check_service_for_update_if_needed(force=True)
+        price = self._get_price_from_metadata(self._get_service_metadata(), self.args.group_name)
+        if price == old_price:
+            return price
+        self._printerr("Price of the service has been changed from %s to %s ASI(FET)" % (
+            cogs2strtoken(old_price), cogs2strtoken(price)))
+        if price > old_price and not self.args.yes and input("Proceed with the new price? (y/n): ") != "y":
+            self._error("Cancelled")
+        return price
+
     def call_server_statelessly_with_params(self, params, group_name):
+        self._check_service_for_update_if_needed()
+
+        with self._phase("metadata_load"):
+            org_metadata = self._read_metadata_for_org(self.args.org_id)
+            service_metadata = self._get_service_metadata()
+        with self._phase("endpoint_selection"):
+            endpoints = self._get_ranked_endpoints(service_metadata)
 
-        # if service is not initilized we will initialize it (unless we want skip registry check for update)
-        if not self.args.skip_update_check:
-            self._init_or_update_registered_org_if_needed()
-            self._init_or_update_registered_service_if_needed()
+        # if channel was not initilized we will try to initailize it (it will work only in simple case of signer == sender)
+        with self._phase("channel_cache"):
+            channel = self._smart_get_channel_for_org(org_metadata, filter_by="signer")
+        channel_id = channel["channel_id"]
+        price = self._get_price_from_metadata(service_metadata, group_name)
+
+        prepaid_warning = ""
+        if self.args.payment_mode == "prepaid":
+            prepaid_calls = self.args.prepaid_calls or DEFAULT_PREPAID_CALLS
+            prepaid_warning = " If the prepaid token is used up, we will sign upfront for %i calls (%s ASI(FET))." % (
+                prepaid_calls, cogs2strtoken(price * prepaid_calls))
+        proceed = self.args.yes or input(
+            "Price for this call will be %s ASI(FET).%s (use -y to remove this warning). Proceed? (y/n): " % (
+                cogs2strtoken(price), prepaid_warning)) == "y"
+        if not proceed:
+            self._error("Cancelled")
+
+        # failover to the next endpoint only if we cannot connect to the current one: once the signed payment
+        # is sent, another daemon would get the payment which conflicts with it (and client stream is consumed)
+        with self._phase("connect"):
+            for i, endpoint in enumerate(endpoints):
+                grpc_channel = self.open_grpc_channel(endpoint)
+                if i == len(endpoints) - 1 or is_grpc_channel_ready(grpc_channel, self.args.endpoint_probe_timeout):
+                    break
+                self._mark_endpoint_unavailable(endpoint)
+                self._printerr("Endpoint %s is unavailable, we will try %s" % (endpoint, endpoints[i + 1]))
+
+        if self.args.payment_mode == "prepaid":
+            return self._call_server_prepaid(grpc_channel, channel_id, price, params, service_metadata)
+        return self._call_server_escrow(grpc_channel, channel_id, price, params, service_metadata)
+
+    def call_server_statelessly(self):
+        if self.args.profile or self.args.profile_json:
+            self._phase_timer = PhaseTimer()
+        try:
+            with self._phase("identity"):
+                self.check_ident()
+            group_name = self.args.group_name
+            # we need the method index to know how to read params, so service should be initialized first
+            self._check_service_for_update_if_needed()
+            with self._phase("read_params"):
+                index_entry = self._get_method_index_entry()
+                params = self._get_call_params_for_method(index_entry)
+            response = self.call_server_statelessly_with_params(params, group_name)
+            self._deal_with_call_response_for_method(response, index_entry)
+        finally:
+            self._close_mapped_files(self._get_mapped_files())
+            self._report_phases()
+
+    # Profiling (--profile and --profile-json)
+    def _phase(self, name):
+        """ Measure the phase of the call (only if profiling was enabled) """
+        phase_timer = getattr(self, "_phase_timer", None)
+        if phase_timer is None:
+            return contextlib.nullcontext()
+        return phase_timer.phase(name)
+
+    def _report_phases(self):
+        phase_timer = getattr(self, "_phase_timer", None)
+        if phase_timer is None:
+            return
+        if self.args.profile:
+            self._printerr(phase_timer.format_report())
+        if self.args.profile_json:
+            phase_timer.save_json(self.args.profile_json)
+
+    # IV. Batch calls
+    def _read_batch_params_lines(self):
+        self._check_call_params_from_stdin(self.args.input)
+        if self.args.input is None or self.args.input == "-":
+            self._printerr("Waiting for JSONL call params on stdin...")
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(self.args.input, "r") as f:
+                lines = f.read().splitlines()
+        return [line for line in lines if line.strip()]
+
+    def allocate_call_payment(self, state, rejected_generation=None):
+        """
+        Allocate the next amount in the ledger and sign it (or take prepaid token in prepaid mode).
+        state is the dict with grpc_channel, mpe_address, channel_id, price, payment_mode and prepaid_calls.
+        rejected_generation is returned by the previous allocation for the request which was rejected by the daemon
+        """
+        if state["payment_mode"] == "prepaid":
+            return self._get_prepaid_payment_metadata(state["grpc_channel"], state["channel_id"], state["price"],
+                                                      state["prepaid_calls"], rejected_generation)
+        nonce, amount, generation = self._allocate_channel_amount(
+            state["grpc_channel"], state["channel_id"], state["price"])
+        metadata = self._create_call_metadata(state["channel_id"], nonce, amount, state["mpe_address"])
+        return generation, metadata
+
+    def release_failed_call_payment(self, state, generation):
+        """ The call with the payment from allocate_call_payment has failed, so daemon hasn't taken this payment """
+        if state["payment_mode"] == "escrow":
+            # the ledger is ahead of the daemon now
+            self._invalidate_channel_ledger(state["channel_id"], generation)
+
+    def _call_batch_item(self, call_fn, build_request, state, index, line):
+        # daemon rejects payment if the amount is not exactly "last signed amount + price" (UNAUTHENTICATED)
+        # or if another payment in the same channel is in progress (FAILED_PRECONDITION)
+        retry_codes = (grpc.StatusCode.UNAUTHENTICATED, grpc.StatusCode.FAILED_PRECONDITION)
+        try:
+            mapped_files = []
+            try:
+                request = build_request(self._transform_call_params(json.loads(line), mapped_files))
+            finally:
+                self._close_mapped_files(mapped_files)
+            attempt = 0
+            rejected_generation = None
+            while True:
+                generation, metadata = self.allocate_call_payment(state, rejected_generation)
+                try:
+                    response = call_fn(request, metadata=metadata, compression=state["compression"])
+                    return {"index": index, "response": response_to_dict(response)}
+                except grpc.RpcError as e:
+                    self.release_failed_call_payment(state, generation)
+                    if e.code() not in retry_codes or attempt >= self.args.max_retries:
+                        raise
+                    attempt += 1
+                    rejected_generation = generation
+        except grpc.RpcError as e:
+            return {"index": index, "error": "%s: %s" % (e.code().name, e.details())}
+        except Exception as e:
+            return {"index": index, "error": str(e)}
+
+    def _get_batch_concurrency(self):
+        if self.args.payment_mode == "escrow" and self.args.concurrency > 1:
+            # each escrow payment should be "last signed amount + price" and daemon accepts only one payment
+            # in progress per channel, so concurrent escrow calls would be rejected
+            self._printerr("Escrow calls in one channel cannot be concurrent, so we send them one by one "
+                           "(use --payment-mode prepaid for concurrent calls)")
+            return 1
+        return self.args.concurrency
+
+    @staticmethod
+    def _run_batch_calls(call_item, lines, concurrency):
+        """ Call call_item(index, line) for all lines with up to concurrency calls in flight """
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # executor.map yields results in the input order
+            yield from executor.map(lambda item: call_item(*item), enumerate(lines))
+
+    def call_server_batch(self):
+        self.check_ident()
+        lines = self._read_batch_params_lines()
+        if not lines:
+            self._printerr("No call params were given")
+            return
+
+        self._check_service_for_update_if_needed()
 
         org_metadata = self._read_metadata_for_org(self.args.org_id)
         service_metadata = self._get_service_metadata()
         endpoint = self._get_endpoint_from_metadata_or_args(service_metadata)
-        grpc_channel = open_grpc_channel(endpoint)
 
-        # if channel was not initilized we will try to initailize it (it will work only in simple case of signer == sender)
         channel = self._smart_get_channel_for_org(org_metadata, filter_by="signer")
         channel_id = channel["channel_id"]
-        price = self._get_price_from_metadata(service_metadata, group_name)
-        server_state = self._get_channel_state_from_server(grpc_channel, channel_id)
+        price = self._get_price_from_metadata(service_metadata, self.args.group_name)
+        total_price = price * len(lines)
 
         proceed = self.args.yes or input(
-            "Price for this call will be %s ASI(FET) (use -y to remove this warning). Proceed? (y/n): " % (cogs2strtoken(price))) == "y"
+            "Price for %i calls will be %s ASI(FET) (use -y to remove this warning). Proceed? (y/n): " % (
+                len(lines), cogs2strtoken(total_price))) == "y"
         if not proceed:
             self._error("Cancelled")
 
-        return self._call_server_via_grpc_channel(grpc_channel, channel_id, server_state["current_nonce"], server_state["current_signed_amount"] + price, params, service_metadata)
+        grpc_channel = self.open_grpc_channel(endpoint)
+        _, _, unspent_amount = self._get_channel_state_statelessly(grpc_channel, channel_id)
+        if unspent_amount < total_price:
+            raise Exception("Unspent amount in channel %i is %s ASI(FET), but %i calls cost %s ASI(FET). "
+                            "You can add funds with 'snet channel extend-add'" % (
+                                channel_id, cogs2strtoken(unspent_amount), len(lines), cogs2strtoken(total_price)))
+
+        index_entry = self._get_method_index_entry()
+        if index_entry["streaming"] != "unary":
+            raise Exception("call-batch supports only unary methods, but %s is %s" % (
+                self.args.method, index_entry["streaming"]))
+        stub_class, request_class, response_class = self._import_protobuf_for_service(index_entry)
+        call_fn = getattr(stub_class(grpc_channel), self.args.method)
+        build_request = self._get_request_builder(call_fn, request_class, response_class, service_metadata)
+
+        state = {"grpc_channel": grpc_channel,
+                 "mpe_address": self.get_mpe_address(),
+                 "channel_id": channel_id,
+                 "price": price,
+                 "payment_mode": self.args.payment_mode,
+                 "prepaid_calls": self.args.prepaid_calls or len(lines),
+                 "compression": self.get_grpc_compression()}
+
+        output = sys.stdout if self.args.output is None else open(self.args.output, "w")
+        n_errors = 0
+        try:
+            results = self._run_batch_calls(lambda index, line: self._call_batch_item(
+                call_fn, build_request, state, index, line), lines, self._get_batch_concurrency())
+            for result in results:
+                n_errors += "error" in result
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self._printerr("Done %i calls, %i failed" % (len(lines), n_errors))
+
+    # V. Prepaid (token based) payments
+    def _get_prepaid_tokens_file(self):
+        mpe_address = self.get_mpe_address().lower()
+        return Path.home().joinpath(".snet", "cache", "mpe", mpe_address, "prepaid_tokens.pickle")
+
+    def _read_prepaid_tokens(self):
+        tokens_file = self._get_prepaid_tokens_file()
+        if not tokens_file.exists():
+            return {}
+        try:
+            with open(tokens_file, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            return {}
 
-    def call_server_statelessly(self):
+    def _save_prepaid_token(self, channel_id, token):
+        tokens = self._read_prepaid_tokens()
+        tokens[channel_id] = token
+        write_pickle_atomically(self._get_prepaid_tokens_file(), tokens)
+
+    def _request_prepaid_token(self, grpc_channel, channel_id, nonce, signed_amount):
+        """
+        Call TokenService.GetToken. We sign the usual MPE claim message for signed_amount
+        and then sign this signature together with the current block number
+        """
+        stub_class, request_class, _ = get_daemon_stub_classes("GetToken")
+        current_block = self.ident.w3.eth.block_number
+        mpe_signature = self._sign_message(self.get_mpe_address(), channel_id, nonce, signed_amount)
+        message = self.w3.solidity_keccak(["bytes", "uint256"], [bytes(mpe_signature), current_block])
+        signature = self.ident.sign_message_after_solidity_keccak(message)
+
+        request = request_class(
+            channel_id=channel_id,
+            current_nonce=nonce,
+            signed_amount=signed_amount,
+            signature=bytes(signature),
+            current_block=current_block,
+            claim_signature=bytes(mpe_signature)
+        )
+        reply = stub_class(grpc_channel).GetToken(request)
+        return {"token": reply.token,
+                "nonce": nonce,
+                "signed_amount": signed_amount,
+                "planned_amount": reply.planned_amount,
+                "used_amount": reply.used_amount}
+
+    def _renew_prepaid_token(self, grpc_channel, channel_id, price, prepaid_calls):
+        nonce, signed_amount, unspent_amount = self._get_channel_state_statelessly(grpc_channel, channel_id)
+        # maybe the last signed amount is not used up yet (for example it was signed by another process)
+        if signed_amount > 0:
+            token = self._request_prepaid_token(grpc_channel, channel_id, nonce, signed_amount)
+            if token["planned_amount"] - token["used_amount"] >= price:
+                return token
+
+        prepaid_calls = min(prepaid_calls, unspent_amount // price)
+        if prepaid_calls == 0:
+            raise Exception("Unspent amount in channel %i is %s ASI(FET), which is not enough for one call. "
+                            "You can add funds with 'snet channel extend-add'" % (
+                                channel_id, cogs2strtoken(unspent_amount)))
+        return self._request_prepaid_token(grpc_channel, channel_id, nonce, signed_amount + price * prepaid_calls)
+
+    def _get_prepaid_payment_metadata(self, grpc_channel, channel_id, price, prepaid_calls, rejected_token=None):
+        """
+        Return (token, metadata) for one prepaid call. The token is cached in ~/.snet/cache and we count
+        used amount locally, so we renew it only if planned_amount - used_amount < price or if daemon
+        has rejected it (rejected_token). The same token is shared by concurrent calls (threads and processes).
+        """
+        with file_lock(self._get_prepaid_tokens_file().with_suffix(".lock")):
+            token = self._read_prepaid_tokens().get(channel_id)
+            if (token is None or token["planned_amount"] - token["used_amount"] < price
+                    or (rejected_token is not None and token["token"] == rejected_token)):
+                token = self._renew_prepaid_token(grpc_channel, channel_id, price, prepaid_calls)
+            token["used_amount"] += price
+            self._save_prepaid_token(channel_id, token)
+
+        metadata = [("snet-payment-type",           "prepaid-call"),
+                    ("snet-payment-channel-id",     str(channel_id)),
+                    ("snet-payment-channel-nonce",  str(token["nonce"])),
+                    ("snet-prepaid-auth-token-bin", bytes(token["token"], "utf-8"))]
+        return token["token"], metadata
+
+    def _call_server_prepaid(self, grpc_channel, channel_id, price, params, service_metadata):
+        prepaid_calls = self.args.prepaid_calls or DEFAULT_PREPAID_CALLS
+        with self._phase("payment"):
+            token, metadata = self._get_prepaid_payment_metadata(grpc_channel, channel_id, price, prepaid_calls)
+        try:
+            return self._call_server_with_metadata(grpc_channel, metadata, params, service_metadata)
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.UNAUTHENTICATED or not isinstance(params, dict):
+                raise
+            # the token could be used up by another process, so we renew it and try once again
+            token, metadata = self._get_prepaid_payment_metadata(grpc_channel, channel_id, price, prepaid_calls, token)
+            return self._call_server_with_metadata(grpc_channel, metadata, params, service_metadata)
+
+    # VI. Local ledger of signed amounts
+    def _get_channel_ledger_file(self):
+        mpe_address = self.get_mpe_address().lower()
+        return Path.home().joinpath(".snet", "cache", "mpe", mpe_address, "ledger.pickle")
+
+    def _read_channel_ledger(self):
+        ledger_file = self._get_channel_ledger_file()
+        if not ledger_file.exists():
+            return {}
+        try:
+            with open(ledger_file, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            return {}
+
+    def _write_channel_ledger(self, ledger):
+        write_pickle_atomically(self._get_channel_ledger_file(), ledger)
+
+    def _allocate_channel_amount(self, grpc_channel, channel_id, price):
+        """
+        Allocate the next amount to sign (the last allocated amount + price) atomically between threads and processes.
+        We ask the daemon for the channel state only if the channel is not in the ledger yet or if it was invalidated
+        after a failed call (generation of the ledger entry is incremented each time we reconcile it with the daemon).
+        Return (nonce, amount, generation)
+        """
+        with file_lock(self._get_channel_ledger_file().with_suffix(".lock")):
+            ledger = self._read_channel_ledger()
+            entry = ledger.get(channel_id)
+            if entry is None or entry["is_stale"]:
+                with self._phase("get_channel_state"):
+                    server_state = self._get_channel_state_from_server(grpc_channel, channel_id)
+                entry = {"nonce": server_state["current_nonce"],
+                         "amount": server_state["current_signed_amount"],
+                         "generation": 0 if entry is None else entry["generation"] + 1,
+                         "is_stale": False}
+            entry["amount"] += price
+            ledger[channel_id] = entry
+            self._write_channel_ledger(ledger)
+            return entry["nonce"], entry["amount"], entry["generation"]
+
+    def _invalidate_channel_ledger(self, channel_id, generation):
+        """ Reconcile the channel with the daemon before the next call (unless it has been done after this generation) """
+        with file_lock(self._get_channel_ledger_file().with_suffix(".lock")):
+            ledger = self._read_channel_ledger()
+            entry = ledger.get(channel_id)
+            if entry is not None and entry["generation"] == generation:
+                entry["is_stale"] = True
+                self._write_channel_ledger(ledger)
+
+    def _invalidate_channel_ledger_on_stream_error(self, responses, channel_id, generation):
+        try:
+            yield from responses
+        except grpc.RpcError:
+            # daemon doesn't take payment for failed calls, so the ledger is ahead of the daemon now
+            self._invalidate_channel_ledger(channel_id, generation)
+            raise
+
+    def _call_server_escrow(self, grpc_channel, channel_id, price, params, service_metadata):
+        for attempt in range(2):
+            with self._phase("payment"):
+                nonce, amount, generation = self._allocate_channel_amount(grpc_channel, channel_id, price)
+            try:
+                response = self._call_server_via_grpc_channel(
+                    grpc_channel, channel_id, nonce, amount, params, service_metadata)
+                if isinstance(response, grpc.Call):
+                    # errors of server streaming calls are raised only while we read the responses
+                    return self._invalidate_channel_ledger_on_stream_error(response, channel_id, generation)
+                return response
+            except grpc.RpcError as e:
+                # daemon doesn't take payment for failed calls, so the ledger is ahead of the daemon now
+                self._invalidate_channel_ledger(channel_id, generation)
+                # payment could be rejected because the ledger was out of date (for example the channel was claimed
+                # and its nonce was changed) or because the price was changed,
+                # so we try once again after reconciliation
+                if e.code() != grpc.StatusCode.UNAUTHENTICATED or attempt == 1 or not isinstance(params, dict):
+                    raise
+                if self._is_price_rejection(e):
+                    price = self._update_price_after_rejection(price)
+
+    # VII. Call sessions of library clients (see snet.cli.async_client)
+    def open_call_session(self):
+        """
+        Do the registry check, the endpoint and the channel selection once for many calls.
+        Return dict with endpoint, service_metadata, method_index and payment_state (see allocate_call_payment)
+        """
         self.check_ident()
-        group_name = self.args.group_name
+        self._check_service_for_update_if_needed()
+        org_metadata = self._read_metadata_for_org(self.args.org_id)
+        service_metadata = self._get_service_metadata()
+        endpoint = self._get_endpoint_from_metadata_or_args(service_metadata)
+        channel = self._smart_get_channel_for_org(org_metadata, filter_by="signer")
+
+        # synchronous channel is used only for GetChannelState/GetToken requests of the payment logic
+        payment_state = {"grpc_channel": self.open_grpc_channel(endpoint),
+                         "mpe_address": self.get_mpe_address(),
+                         "channel_id": channel["channel_id"],
+                         "price": self._get_price_from_metadata(service_metadata, self.args.group_name),
+                         "payment_mode": self.args.payment_mode,
+                         "prepaid_calls": self.args.prepaid_calls,
+                         "compression": self.get_grpc_compression()}
+        return {"endpoint": endpoint,
+                "service_metadata": service_metadata,
+                "method_index": self._get_method_index(),
+                "payment_state": payment_state}
+
+    def get_unary_method(self, session, grpc_channel, method, service=None):
+        """
+        Return (call_fn, build_request) for the unary method of the session's service over grpc_channel
+        (it could be grpc.aio channel). service should be provided only in the case of conflicting method names
+        """
+        index_entry = find_method_in_index(session["method_index"], method, service)
+        if index_entry["streaming"] != "unary":
+            raise Exception("Only unary methods are supported, but %s is %s" % (method, index_entry["streaming"]))
+        stub_class, request_class, response_class = self._import_protobuf_for_service(index_entry)
+        call_fn = getattr(stub_class(grpc_channel), method)
+        return call_fn, self._get_request_builder(call_fn, request_class, response_class, session["service_metadata"])
+
+    # VIII. Benchmark
+    def _bench_request(self, call_fn, request, state):
+        """ Send one request and return the error (None for successful requests) """
+        generation = None
+        try:
+            if state["payment_mode"] == "none":
+                metadata = []
+            else:
+                generation, metadata = self.allocate_call_payment(state)
+            call_fn(request, metadata=metadata, compression=state["compression"])
+            return None
+        except grpc.RpcError as e:
+            if generation is not None:
+                self.release_failed_call_payment(state, generation)
+            return e.code().name
+        except Exception as e:
+            return type(e).__name__
+
+    def bench_service(self):
+        if self.args.payment_mode == "escrow" and self.args.concurrency > 1:
+            # each escrow payment should be "last signed amount + price" and daemon accepts only one payment
+            # in progress per channel, so concurrent escrow calls would be rejected
+            self._error("Escrow calls in one channel cannot be concurrent, "
+                        "use --payment-mode prepaid (or none for free calls) with --concurrency")
+        self.check_ident()
+        self._check_service_for_update_if_needed()
+        index_entry = self._get_method_index_entry()
+        if index_entry["streaming"] != "unary":
+            raise Exception("bench supports only unary methods, but %s is %s" % (
+                self.args.method, index_entry["streaming"]))
         params = self._get_call_params()
-        response = self.call_server_statelessly_with_params(params, group_name)
-        self._deal_with_call_response(response)
+
+        service_metadata = self._get_service_metadata()
+        endpoint = self._get_endpoint_from_metadata_or_args(service_metadata)
+        grpc_channel = self.open_grpc_channel(endpoint)
+
+        stub_class, request_class, response_class = self._import_protobuf_for_service(index_entry)
+        call_fn = getattr(stub_class(grpc_channel), self.args.method)
+        # the same request is sent each time, so we build it only once
+        request = self._get_request_builder(call_fn, request_class, response_class, service_metadata)(params)
+        self._close_mapped_files(self._get_mapped_files())
+
+        state = {"grpc_channel": grpc_channel,
+                 "payment_mode": self.args.payment_mode,
+                 "compression": self.get_grpc_compression()}
+        if self.args.payment_mode != "none":
+            org_metadata = self._read_metadata_for_org(self.args.org_id)
+            channel_id = self._smart_get_channel_for_org(org_metadata, filter_by="signer")["channel_id"]
+            price = self._get_price_from_metadata(service_metadata, self.args.group_name)
+            total_price = price * self.args.requests
+            proceed = self.args.yes or input(
+                "Price for %i calls will be %s ASI(FET) (use -y to remove this warning). Proceed? (y/n): " % (
+                    self.args.requests, cogs2strtoken(total_price))) == "y"
+            if not proceed:
+                self._error("Cancelled")
+            state.update({"mpe_address": self.get_mpe_address(),
+                          "channel_id": channel_id,
+                          "price": price,
+                          "prepaid_calls": self.args.prepaid_calls or self.args.requests})
+
+        self._printerr("Sending %i requests to %s" % (self.args.requests, endpoint))
+        results, elapsed = run_bench_requests(lambda: self._bench_request(call_fn, request, state),
+                                              self.args.requests, self.args.concurrency, self.args.rate)
+
+        self._pprint({"bench_summary": summarize_bench_results(results, elapsed)})
+        latencies = [latency for latency, error in results if error is None]
+        if latencies:
+            self._printout(format_histogram(latency_histogram(latencies, self.args.histogram_buckets)))
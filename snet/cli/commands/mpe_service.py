@@ -1,20 +1,20 @@
 import json
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from re import search
 from sys import exit
 import tempfile
 
-from grpc_health.v1 import health_pb2 as heartb_pb2
-from grpc_health.v1 import health_pb2_grpc as heartb_pb2_grpc
 import jsonschema
 
 from snet.cli.commands.commands import BlockchainCommand
 from snet.cli.metadata.organization import OrganizationMetadata
 from snet.cli.metadata.service import MPEServiceMetadata, load_mpe_service_metadata, mpe_service_metadata_from_json
 from snet.cli.utils import ipfs_utils
-from snet.cli.utils.utils import is_valid_url, open_grpc_channel, type_converter, bytesuri_to_hash, \
-    get_file_from_filecoin, download_and_safe_extract_proto
+from snet.cli.utils.utils import is_valid_url, type_converter, bytesuri_to_hash, \
+    get_file_from_filecoin, download_and_safe_extract_proto, check_endpoint_health, percentile
 
 
 class MPEServiceCommand(BlockchainCommand):
@@ -591,17 +591,12 @@ class MPEServiceCommand(BlockchainCommand):
         metadata = self._get_service_metadata_from_registry()
         self._printout(metadata.get_json_pretty())
 
-    def _service_status(self, url, secure=True):
-        try:
-            channel = open_grpc_channel(endpoint=url)
-            stub = heartb_pb2_grpc.HealthStub(channel)
-            response = stub.Check(
-                heartb_pb2.HealthCheckRequest(service=""), timeout=10)
-            if response != None and response.status == 1:
-                return True
-            return False
-        except Exception as e:
-            return False
+    def _check_endpoints_concurrently(self, endpoints):
+        """ Run health checks for all endpoints at once. Return {endpoint: (is_available, rtt)} """
+        options = self.get_grpc_channel_options()
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+            results = executor.map(lambda e: check_endpoint_health(e, self.args.timeout, options), endpoints)
+            return dict(zip(endpoints, results))
 
     def print_service_status(self):
         metadata = self._get_service_metadata_from_registry()
@@ -610,18 +605,46 @@ class MPEServiceCommand(BlockchainCommand):
                 self.args.group_name)}
         else:
             groups = metadata.get_all_group_endpoints()
-        service_status = defaultdict(list)
-        for name, group_endpoints in groups.items():
-            for endpoint in group_endpoints:
-                status = "Available" if self._service_status(
-                    url=endpoint) else "Not Available"
-                service_status[name].append(
-                    {"endpoint": endpoint, "status": status})
-        if service_status == {}:
+        endpoints = sorted({endpoint for group_endpoints in groups.values() for endpoint in group_endpoints})
+        if not endpoints:
             self._printout(
                 "Error: No endpoints found to check service status.")
             return
-        self._pprint(service_status)
+
+        rtts = defaultdict(list)
+        failures = defaultdict(int)
+        n_rounds = 0
+        try:
+            while self.args.repeat == 0 or n_rounds < self.args.repeat:
+                if n_rounds > 0:
+                    time.sleep(self.args.interval)
+                results = self._check_endpoints_concurrently(endpoints)
+                n_rounds += 1
+                service_status = defaultdict(list)
+                for name, group_endpoints in groups.items():
+                    for endpoint in group_endpoints:
+                        is_available, rtt = results[endpoint]
+                        status = {"endpoint": endpoint, "status": "Available" if is_available else "Not Available"}
+                        if is_available:
+                            status["rtt_ms"] = round(rtt * 1000, 1)
+                        service_status[name].append(status)
+                for endpoint, (is_available, rtt) in results.items():
+                    if is_available:
+                        rtts[endpoint].append(rtt)
+                    else:
+                        failures[endpoint] += 1
+                self._pprint(service_status)
+        except KeyboardInterrupt:
+            pass
+
+        if n_rounds > 1:
+            summary = {}
+            for endpoint in endpoints:
+                summary[endpoint] = {"checks": n_rounds, "failures": failures[endpoint]}
+                if rtts[endpoint]:
+                    summary[endpoint]["p50_ms"] = round(percentile(rtts[endpoint], 50) * 1000, 1)
+                    summary[endpoint]["p99_ms"] = round(percentile(rtts[endpoint], 99) * 1000, 1)
+            self._pprint({"latency_summary": summary})
 
     def print_service_tags_from_registry(self):
         metadata = self._get_service_metadata_from_registry()
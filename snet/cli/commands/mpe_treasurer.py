@@ -1,11 +1,19 @@
-from pathlib import Path
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import grpc
 import web3
-from snet.cli.utils.proto_utils import import_protobuf_from_dir
-from snet.cli.utils.utils import compile_proto, open_grpc_channel, int4bytes_big, RESOURCES_PATH
+from snet.cli.utils.daemon_stubs import get_daemon_stub_classes
+from snet.cli.utils.utils import int4bytes_big
 from snet.cli.commands.mpe_client import MPEClientCommand
+from snet.cli.utils.claim_planner import make_claim_plan, get_claim_gas, select_channels_to_claim
+from snet.cli.utils.metrics import Metrics, start_metrics_server
 from snet.cli.utils.token2cogs import cogs2strtoken
 
+# multiChannelClaim costs about CLAIM_GAS_PER_CHANNEL (45k) gas per channel (see claim_planner),
+# so the default batch is far below the block gas limit
+DEFAULT_CLAIM_BATCH_SIZE = 20
+
 
 class MPETreasurerCommand(MPEClientCommand):
     """ We inherit MPEChannelCommand because we need _get_channel_state_from_blockchain """
@@ -30,53 +38,41 @@ class MPETreasurerCommand(MPEClientCommand):
 
     def _get_stub_and_request_classes(self, service_name):
         """ import protobuf and return stub and request class """
-        # Compile protobuf if needed
-        codegen_dir = Path.home().joinpath(".snet", "mpe_client", "control_service")
-        proto_dir = RESOURCES_PATH.joinpath("proto")
-        if not codegen_dir.joinpath("control_service_pb2.py").is_file():
-            compile_proto(proto_dir, codegen_dir,
-                          proto_file="control_service.proto")
-
-        stub_class, request_class, _ = import_protobuf_from_dir(
-            codegen_dir, service_name)
+        stub_class, request_class, _ = get_daemon_stub_classes(service_name)
         return stub_class, request_class
 
     def _decode_PaymentReply(self, p):
         return {"channel_id":  int4bytes_big(p.channel_id), "nonce": int4bytes_big(p.channel_nonce), "amount": int4bytes_big(p.signed_amount), "signature": p.signature}
 
-    def _call_GetListUnclaimed(self, grpc_channel):
-        stub_class, request_class = self._get_stub_and_request_classes(
-            "GetListUnclaimed")
-        stub = stub_class(grpc_channel)
-
+    def _get_signed_list_request(self, method):
+        """ Request for GetListUnclaimed or GetListInProgress (the same request could be sent to several daemons) """
+        _, request_class = self._get_stub_and_request_classes(method)
         mpe_address = self.get_mpe_address()
         current_block = self.ident.w3.eth.block_number
-        signature = self._sign_message_list_unclaimed(
-            mpe_address, current_block)
-        request = request_class(
+        if method == "GetListUnclaimed":
+            signature = self._sign_message_list_unclaimed(mpe_address, current_block)
+        else:
+            signature = self._sign_message_list_in_progress(mpe_address, current_block)
+        return request_class(
             mpe_address=mpe_address, current_block=current_block, signature=bytes(signature))
-        response = getattr(stub, "GetListUnclaimed")(request)
-
-        for p in response.payments:
-            if len(p.signature) > 0:
-                raise Exception(
-                    "Signature was set in GetListUnclaimed. Response is invalid")
 
+    def _decode_list_response(self, method, response):
+        if method == "GetListUnclaimed":
+            for p in response.payments:
+                if len(p.signature) > 0:
+                    raise Exception(
+                        "Signature was set in GetListUnclaimed. Response is invalid")
         return [self._decode_PaymentReply(p) for p in response.payments]
 
-    def _call_GetListInProgress(self, grpc_channel):
-        stub_class, request_class = self._get_stub_and_request_classes(
-            "GetListInProgress")
-        stub = stub_class(grpc_channel)
+    def _call_GetListUnclaimed(self, grpc_channel):
+        stub_class, _ = self._get_stub_and_request_classes("GetListUnclaimed")
+        response = stub_class(grpc_channel).GetListUnclaimed(self._get_signed_list_request("GetListUnclaimed"))
+        return self._decode_list_response("GetListUnclaimed", response)
 
-        mpe_address = self.get_mpe_address()
-        current_block = self.ident.w3.eth.block_number
-        signature = self._sign_message_list_in_progress(
-            mpe_address, current_block)
-        request = request_class(
-            mpe_address=mpe_address, current_block=current_block, signature=bytes(signature))
-        response = getattr(stub, "GetListInProgress")(request)
-        return [self._decode_PaymentReply(p) for p in response.payments]
+    def _call_GetListInProgress(self, grpc_channel):
+        stub_class, _ = self._get_stub_and_request_classes("GetListInProgress")
+        response = stub_class(grpc_channel).GetListInProgress(self._get_signed_list_request("GetListInProgress"))
+        return self._decode_list_response("GetListInProgress", response)
 
     def _call_StartClaim(self, grpc_channel, channel_id, channel_nonce):
         stub_class, request_class = self._get_stub_and_request_classes(
@@ -90,9 +86,72 @@ class MPETreasurerCommand(MPEClientCommand):
         response = getattr(stub, "StartClaim")(request)
         return self._decode_PaymentReply(response)
 
+    def _open_daemon_channels(self):
+        """
+        Return {endpoint: grpc_channel} for daemons given with --endpoint (could be given several times)
+        or for daemon endpoints of the service (--org-id, --service-id and optional --group-name) from its metadata
+        """
+        endpoints = self.args.endpoint
+        if not endpoints:
+            if not self.args.org_id or not self.args.service_id:
+                raise Exception("Please specify --endpoint or --org-id and --service-id")
+            self._init_or_update_registered_org_and_service_from_events(0)
+            metadata = self._get_service_metadata()
+            if self.args.group_name:
+                endpoints = metadata.get_all_endpoints_for_group(self.args.group_name) or []
+            else:
+                endpoints = [e for group_endpoints in metadata.get_all_group_endpoints().values()
+                             for e in group_endpoints]
+            if not endpoints:
+                raise Exception("Cannot find daemon endpoints in the service metadata")
+        return {e: self.open_grpc_channel(e) for e in dict.fromkeys(endpoints)}
+
+    def _get_payments_from_daemons(self, grpc_channels, method):
+        """
+        Call GetListUnclaimed or GetListInProgress on all daemons concurrently and return payments with "endpoint"
+        of the daemon. Daemons of one payment group share the payment storage, so payments are deduplicated by channel.
+        Daemons which have failed are skipped (unless all of them have failed)
+        """
+        stub_class, _ = self._get_stub_and_request_classes(method)
+        request = self._get_signed_list_request(method)
+
+        def call(endpoint):
+            try:
+                return self._decode_list_response(method, getattr(stub_class(grpc_channels[endpoint]), method)(request))
+            except grpc.RpcError as e:
+                self._printerr("%s failed for %s: %s" % (method, endpoint, e.details()))
+                return None
+
+        with ThreadPoolExecutor(max_workers=len(grpc_channels)) as executor:
+            results = list(executor.map(call, grpc_channels))
+        if all(r is None for r in results):
+            raise Exception("%s failed for all daemon endpoints" % method)
+
+        payments = {}
+        for endpoint, endpoint_payments in zip(grpc_channels, results):
+            for p in endpoint_payments or []:
+                payments.setdefault(p["channel_id"], dict(p, endpoint=endpoint))
+        return list(payments.values())
+
+    def _start_claims_on_daemons(self, grpc_channels, to_claim):
+        """ to_claim is the list of (endpoint, channel_id, channel_nonce), requests are sent concurrently """
+        if not to_claim:
+            return []
+        stub_class, request_class = self._get_stub_and_request_classes("StartClaim")
+        mpe_address = self.get_mpe_address()
+        # we sign in this thread, because hardware wallets cannot sign concurrently
+        requests = [(endpoint, request_class(mpe_address=mpe_address, channel_id=web3.Web3.to_bytes(channel_id),
+                                             signature=bytes(self._sign_message_start_claim(
+                                                 mpe_address, channel_id, channel_nonce))))
+                    for endpoint, channel_id, channel_nonce in to_claim]
+        with ThreadPoolExecutor(max_workers=len(grpc_channels)) as executor:
+            responses = list(executor.map(lambda r: stub_class(grpc_channels[r[0]]).StartClaim(r[1]), requests))
+        return [dict(self._decode_PaymentReply(response), endpoint=endpoint)
+                for (endpoint, _), response in zip(requests, responses)]
+
     def print_unclaimed(self):
-        grpc_channel = open_grpc_channel(self.args.endpoint)
-        payments = self._call_GetListUnclaimed(grpc_channel)
+        grpc_channels = self._open_daemon_channels()
+        payments = self._get_payments_from_daemons(grpc_channels, "GetListUnclaimed")
         self._printout("# channel_id  channel_nonce  signed_amount (ASI(FET))")
         total = 0
         for p in payments:
@@ -101,80 +160,270 @@ class MPETreasurerCommand(MPEClientCommand):
             total += p["amount"]
         self._printout("# total_unclaimed_in_ASI(FET) = %s" % cogs2strtoken(total))
 
-    def _blockchain_claim(self, payments):
-        for payment in payments:
-            channel_id = payment["channel_id"]
-            amount = payment["amount"]
-            sig = payment["signature"]
-            if len(sig) != 65:
-                raise Exception(
-                    "Length of signature is incorrect: %i instead of 65" % (len(sig)))
-            v, r, s = int(sig[-1]), sig[:32], sig[32:64]
-            v = v % 27 + 27
-            params = [channel_id, amount, amount, v, r, s, False]
-            self.transact_contract_command(
-                "MultiPartyEscrow", "channelClaim", params)
-
-    def _start_claim_channels(self, grpc_channel, channels_ids):
+    def _get_claim_signature_params(self, payment):
+        sig = payment["signature"]
+        if len(sig) != 65:
+            raise Exception(
+                "Length of signature is incorrect: %i instead of 65" % (len(sig)))
+        v, r, s = int(sig[-1]), sig[:32], sig[32:64]
+        v = v % 27 + 27
+        return v, r, s
+
+    def _get_claim_fn_and_params(self, payments):
+        """ channelClaim for the single payment and multiChannelClaim for several payments """
+        signatures = [self._get_claim_signature_params(p) for p in payments]
+        if len(payments) == 1:
+            (v, r, s), = signatures
+            return "channelClaim", [payments[0]["channel_id"], payments[0]["amount"], payments[0]["amount"],
+                                    v, r, s, False]
+        amounts = [p["amount"] for p in payments]
+        return "multiChannelClaim", [[p["channel_id"] for p in payments], amounts, amounts,
+                                     [False] * len(payments), [v for v, _, _ in signatures],
+                                     [r for _, r, _ in signatures], [s for _, _, s in signatures]]
+
+    def _blockchain_claim(self, payments, on_claimed=None):
+        """
+        Claim payments with multiChannelClaim transactions of at most --claim-batch-size channels
+        and return the claimed payments (on_claimed(payments) is called for each claimed batch).
+        All batches are sent with consecutive nonces and we wait for their receipts concurrently.
+        multiChannelClaim is atomic, so the failed batch is split in halves and claimed again.
+        """
+        batch_size = self.args.claim_batch_size or DEFAULT_CLAIM_BATCH_SIZE
+        batches = [payments[i:i + batch_size] for i in range(0, len(payments), batch_size)]
+        claimed = []
+        failed_channels = []
+        while batches:
+            sent = []
+            failed = []
+            for batch in batches:
+                contract_fn, params = self._get_claim_fn_and_params(batch)
+                try:
+                    sent.append((batch, self.send_contract_command("MultiPartyEscrow", contract_fn, params)))
+                except Exception as e:
+                    # typically gas estimation fails because one of the payments is invalid or the batch is too large
+                    self._printerr("%s for %i channels failed: %s" % (contract_fn, len(batch), e))
+                    failed.append(batch)
+            results = self.wait_for_contract_commands([s for _, s in sent])
+            for (batch, _), (receipt, _) in zip(sent, results):
+                if receipt["status"] != 1:
+                    self._printerr("Claim transaction for %i channels failed" % len(batch))
+                    failed.append(batch)
+                else:
+                    claimed += batch
+                    if on_claimed is not None:
+                        on_claimed(batch)
+
+            batches = []
+            for batch in failed:
+                if len(batch) == 1:
+                    failed_channels.append(batch[0]["channel_id"])
+                    continue
+                middle = len(batch) // 2
+                self._printerr("Splitting the batch into %i and %i channels" % (middle, len(batch) - middle))
+                batches += [batch[:middle], batch[middle:]]
+        if failed_channels:
+            raise Exception("Cannot claim channels: %s" % ", ".join(str(c) for c in failed_channels))
+        return claimed
+
+    def _start_claim_channels(self, grpc_channels, channels_ids):
         """ Safely run StartClaim for given channels """
-        unclaimed_payments = self._call_GetListUnclaimed(grpc_channel)
+        unclaimed_payments = self._get_payments_from_daemons(grpc_channels, "GetListUnclaimed")
         unclaimed_payments_dict = {
             p["channel_id"]: p for p in unclaimed_payments}
 
-        to_claim = []
+        channels_with_payments = []
         for channel_id in channels_ids:
             if channel_id not in unclaimed_payments_dict or unclaimed_payments_dict[channel_id]["amount"] == 0:
                 self._printout(
                     "There is nothing to claim for channel %i, we skip it" % channel_id)
                 continue
-            blockchain = self._get_channel_state_from_blockchain(channel_id)
+            channels_with_payments.append(channel_id)
+
+        to_claim = []
+        blockchain_states = self._get_channels_state_from_blockchain(channels_with_payments)
+        for channel_id, blockchain in blockchain_states.items():
             if unclaimed_payments_dict[channel_id]["nonce"] != blockchain["nonce"]:
                 self._printout(
                     "Old payment for channel %i is still in progress. Please run claim for this channel later." % channel_id)
                 continue
-            to_claim.append((channel_id,  blockchain["nonce"]))
+            to_claim.append((unclaimed_payments_dict[channel_id]["endpoint"], channel_id, blockchain["nonce"]))
 
-        payments = [self._call_StartClaim(
-            grpc_channel, channel_id, nonce) for channel_id, nonce in to_claim]
-        return payments
+        return self._start_claims_on_daemons(grpc_channels, to_claim)
 
-    def _claim_in_progress_and_claim_channels(self, grpc_channel, channels):
-        """ Claim all 'pending' payments in progress and after we claim given channels """
+    def _claim_in_progress_and_claim_channels(self, grpc_channels, channels, on_claimed=None):
+        """
+        Claim all 'pending' payments in progress and after we claim given channels. Return claimed payments.
+        Payments of all daemons are claimed together, but in two steps: new claim of the channel can be started only
+        after its payment in progress has been claimed in blockchain
+        """
+        claimed = []
         # first we get the list of all 'payments in progress' in case we 'lost' some payments.
-        payments = self._call_GetListInProgress(grpc_channel)
+        payments = self._get_payments_from_daemons(grpc_channels, "GetListInProgress")
         if len(payments) > 0:
             self._printout(
                 "There are %i payments in 'progress' (they haven't been claimed in blockchain). We will claim them." % len(payments))
-            self._blockchain_claim(payments)
-        payments = self._start_claim_channels(grpc_channel, channels)
-        self._blockchain_claim(payments)
+            claimed += self._blockchain_claim(payments, on_claimed)
+        payments = self._start_claim_channels(grpc_channels, channels)
+        claimed += self._blockchain_claim(payments, on_claimed)
+        return claimed
 
     def claim_channels(self):
         self.check_ident()
-        grpc_channel = open_grpc_channel(self.args.endpoint)
-        self._claim_in_progress_and_claim_channels(grpc_channel, self.args.channels)
+        grpc_channels = self._open_daemon_channels()
+        self._claim_in_progress_and_claim_channels(grpc_channels, self.args.channels)
 
     def claim_all_channels(self):
         self.check_ident()
-        grpc_channel = open_grpc_channel(self.args.endpoint)
+        grpc_channels = self._open_daemon_channels()
         # we take list of all channels
-        unclaimed_payments = self._call_GetListUnclaimed(grpc_channel)
+        unclaimed_payments = self._get_payments_from_daemons(grpc_channels, "GetListUnclaimed")
         channels = [p["channel_id"] for p in unclaimed_payments]
-        self._claim_in_progress_and_claim_channels(grpc_channel, channels)
+        self._claim_in_progress_and_claim_channels(grpc_channels, channels)
+
+    def _get_channels_state_from_blockchain(self, channels_ids):
+        """ Return {channel_id: channel} for the given channels, channels are read concurrently """
+        channels_ids = list(dict.fromkeys(channels_ids))
+        if not channels_ids:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(len(channels_ids), 16)) as executor:
+            return dict(zip(channels_ids, executor.map(self._get_channel_state_from_blockchain, channels_ids)))
 
     def claim_almost_expired_channels(self):
         self.check_ident()
-        grpc_channel = open_grpc_channel(self.args.endpoint)
+        grpc_channels = self._open_daemon_channels()
         # we take list of all channels
-        unclaimed_payments = self._call_GetListUnclaimed(grpc_channel)
+        unclaimed_payments = [p for p in self._get_payments_from_daemons(grpc_channels, "GetListUnclaimed")
+                              if p["amount"] > 0]
+        blockchain = self._get_channels_state_from_blockchain([p["channel_id"] for p in unclaimed_payments])
+        current_block = self.ident.w3.eth.block_number
 
         channels = []
         for p in unclaimed_payments:
-            if p["amount"] == 0:
-                continue
             channel_id = p["channel_id"]
-            blockchain = self._get_channel_state_from_blockchain(channel_id)
-            if blockchain["expiration"] < self.ident.w3.eth.block_number + self.args.expiration_threshold:
+            if blockchain[channel_id]["expiration"] < current_block + self.args.expiration_threshold:
                 self._printout("We are going to claim channel %i" % channel_id)
                 channels.append(channel_id)
-        self._claim_in_progress_and_claim_channels(grpc_channel, channels)
+        self._claim_in_progress_and_claim_channels(grpc_channels, channels)
+
+    def plan_claims(self):
+        """
+        Print (and with --execute claim) the plan: unclaimed channels ranked by time to expiration and net value
+        (claimed amount minus estimated gas cost) which fit into --gas-budget
+        """
+        self.check_ident()
+        grpc_channels = self._open_daemon_channels()
+        unclaimed_payments = [p for p in self._get_payments_from_daemons(grpc_channels, "GetListUnclaimed")
+                              if p["amount"] > 0]
+        blockchain = self._get_channels_state_from_blockchain([p["channel_id"] for p in unclaimed_payments])
+        current_block = self.ident.w3.eth.block_number
+
+        candidates = []
+        in_progress = []
+        for p in unclaimed_payments:
+            channel = blockchain[p["channel_id"]]
+            if p["nonce"] != channel["nonce"]:
+                # the previous payment hasn't been claimed in blockchain yet, StartClaim would be refused
+                in_progress.append(p["channel_id"])
+                continue
+            candidates.append({"channel_id": p["channel_id"], "amount": p["amount"],
+                               "blocks_to_expiration": channel["expiration"] - current_block})
+
+        gas_price = self.get_expected_gas_price()
+        batch_size = self.args.claim_batch_size or DEFAULT_CLAIM_BATCH_SIZE
+        plan = make_claim_plan(candidates, gas_price, batch_size, self.args.expiration_threshold,
+                               self.args.gas_budget, self.args.token_price_in_eth)
+        selected = [p for p in plan if p["selected"]]
+
+        def eth(wei):
+            return str(self.w3.from_wei(wei, "ether"))
+
+        self._pprint({"claim_plan": {
+            "gas_price_gwei": str(self.w3.from_wei(gas_price, "gwei")),
+            "channels": [{"channel_id": p["channel_id"],
+                          "amount": cogs2strtoken(p["amount"]),
+                          "blocks_to_expiration": p["blocks_to_expiration"],
+                          "estimated_gas_cost_eth": eth(p["gas_cost_wei"]),
+                          "net_value_eth": eth(p["net_value_wei"]) if p["net_value_wei"] is not None else None,
+                          "claim": p["selected"],
+                          "reason": p["reason"]} for p in plan],
+            "channels_with_payment_in_progress": in_progress,
+            "total": {"channels": len(selected),
+                      "amount": cogs2strtoken(sum(p["amount"] for p in selected)),
+                      "estimated_gas": get_claim_gas(len(selected), batch_size),
+                      "estimated_gas_cost_eth": eth(get_claim_gas(len(selected), batch_size) * gas_price)}}})
+
+        if self.args.execute and selected:
+            self._claim_in_progress_and_claim_channels(grpc_channels, [p["channel_id"] for p in selected])
+
+    def _select_channels_to_claim(self, unclaimed_payments, expirations):
+        """ Channels with unclaimed amount above --amount-threshold or close to expiration (see select_channels_to_claim) """
+        def get_expirations(channels_ids):
+            return {channel_id: channel["expiration"]
+                    for channel_id, channel in self._get_channels_state_from_blockchain(channels_ids).items()}
+
+        selected = select_channels_to_claim(unclaimed_payments, expirations, get_expirations,
+                                            self.ident.w3.eth.block_number, self.args.expiration_threshold,
+                                            self.args.amount_threshold)
+        amounts = {p["channel_id"]: p["amount"] for p in unclaimed_payments}
+        for channel_id, reason in selected:
+            if reason == "amount":
+                self._printout("Unclaimed amount of channel %i is %s ASI(FET), we are going to claim it" % (
+                    channel_id, cogs2strtoken(amounts[channel_id])))
+            else:
+                self._printout("Channel %i is close to expiration, we are going to claim it" % channel_id)
+        return [channel_id for channel_id, _ in selected]
+
+    def _run_treasurer_iteration(self, grpc_channels, metrics, expirations):
+        unclaimed_payments = self._get_payments_from_daemons(grpc_channels, "GetListUnclaimed")
+        metrics.set("unclaimed_channels", sum(1 for p in unclaimed_payments if p["amount"] > 0))
+        metrics.set("unclaimed_cogs", sum(p["amount"] for p in unclaimed_payments))
+
+        channels = self._select_channels_to_claim(unclaimed_payments, expirations)
+        if not channels:
+            return
+
+        def on_claimed(payments):
+            # metrics are updated after each batch, so they are correct even if the next batch fails
+            for p in payments:
+                # the channel nonce has been changed, we will read its state again
+                expirations.pop(p["channel_id"], None)
+            metrics.inc("claimed_payments_total", len(payments))
+            metrics.inc("claimed_cogs_total", sum(p["amount"] for p in payments))
+
+        self._claim_in_progress_and_claim_channels(grpc_channels, channels, on_claimed)
+
+    def run_treasurer(self):
+        """
+        Claim channels periodically. Connections to the daemons and to the blockchain are kept between iterations,
+        after failed iteration we retry with exponential backoff (up to --max-backoff seconds)
+        """
+        self._ensure(self.args.yes, "snet treasurer run sends transactions without confirmation, please add --yes")
+        self.check_ident()
+        grpc_channels = self._open_daemon_channels()
+        metrics = Metrics("snet_treasurer")
+        if self.args.metrics_port:
+            start_metrics_server(metrics, self.args.metrics_port)
+            self._printerr("Metrics are available on http://127.0.0.1:%i/metrics" % self.args.metrics_port)
+
+        expirations = {}
+        failures = 0
+        iteration = 0
+        try:
+            while True:
+                iteration += 1
+                metrics.inc("iterations_total")
+                try:
+                    self._run_treasurer_iteration(grpc_channels, metrics, expirations)
+                    failures = 0
+                    metrics.set("last_success_timestamp_seconds", int(time.time()))
+                except Exception as e:
+                    failures += 1
+                    metrics.inc("errors_total")
+                    self._printerr("Treasurer iteration failed: %s" % e)
+                metrics.set("consecutive_failures", failures)
+                if self.args.max_iterations is not None and iteration >= self.args.max_iterations:
+                    break
+                time.sleep(min(self.args.interval * 2 ** failures, max(self.args.max_backoff, self.args.interval)))
+        except KeyboardInterrupt:
+            pass
+        self._pprint({"treasurer_metrics": metrics.to_dict()})
@@ -298,13 +298,19 @@ def get_session_identity_keys():
     return ["default_wallet_index"]
 
 
+def get_session_grpc_keys():
+    return ["default_grpc_max_message_length", "default_grpc_keepalive_time_ms", "default_grpc_http2_window_size",
+            "default_grpc_compression"]
+
+
 def get_session_network_keys():
     return ["current_registry_at", "current_multipartyescrow_at", "current_singularitynettoken_at",
-            "default_eth_rpc_endpoint"]
+            "default_eth_rpc_endpoint"] + get_session_grpc_keys()
 
 
 def get_session_network_keys_removable():
-    return ["current_registry_at", "current_multipartyescrow_at", "current_singularitynettoken_at", "filecoin_api_key"]
+    return ["current_registry_at", "current_multipartyescrow_at", "current_singularitynettoken_at",
+            "filecoin_api_key"] + get_session_grpc_keys()
 
 
 def get_session_keys():
@@ -2,23 +2,29 @@ from web3.logs import DISCARD
 
 
 class Contract:
-    def __init__(self, w3, address, abi):
+    def __init__(self, w3, address, abi, nonce_manager=None):
         self.w3 = w3
         self.contract = self.w3.eth.contract(address=self.w3.to_checksum_address(address), abi=abi)
         self.abi = abi
+        self.nonce_manager = nonce_manager
 
     def call(self, function_name, *positional_inputs, **named_inputs):
         return getattr(self.contract.functions, function_name)(*positional_inputs, **named_inputs).call()
 
-    def build_transaction(self, function_name, from_address, gas_price, *positional_inputs, **named_inputs):
-        nonce = self.w3.eth.get_transaction_count(from_address)
+    def build_transaction(self, function_name, from_address, fee_params, *positional_inputs, **named_inputs):
+        """ fee_params is dict with gasPrice (legacy transaction) or with maxFeePerGas and maxPriorityFeePerGas """
         chain_id = self.w3.net.version
-        return getattr(self.contract.functions, function_name)(*positional_inputs, **named_inputs).build_transaction({
+        # gas is estimated here, so the nonce is assigned only if the estimation was successful
+        txn = getattr(self.contract.functions, function_name)(*positional_inputs, **named_inputs).build_transaction({
             "from": from_address,
-            "nonce": nonce,
-            "gasPrice": gas_price,
-            "chainId": int(chain_id)
+            "chainId": int(chain_id),
+            **fee_params
         })
+        if self.nonce_manager is not None:
+            txn["nonce"] = self.nonce_manager.next_nonce()
+        else:
+            txn["nonce"] = self.w3.eth.get_transaction_count(from_address)
+        return txn
 
     def process_receipt(self, receipt):
         events = []
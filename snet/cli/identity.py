@@ -1,7 +1,6 @@
 import abc
 import json
 import struct
-import time
 import getpass
 
 import rlp
@@ -14,6 +13,7 @@ from ledgerblue.commException import CommException
 from trezorlib.client import TrezorClient
 from trezorlib import messages as proto
 from trezorlib.transport.hid import HidTransport
+from web3.exceptions import TransactionNotFound
 
 
 from snet.cli.utils.utils import get_address_from_private, normalize_private_key
@@ -27,9 +27,19 @@ class IdentityProvider(abc.ABC):
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def transact(self, transaction, out_f):
+    def sign_transaction(self, transaction, out_f):
+        """ Return signed raw transaction """
         raise NotImplementedError()
 
+    def send_transaction(self, transaction, out_f):
+        """
+        Sign and send the transaction without waiting for the receipt.
+        Return (txn_hash, raw_transaction), raw_transaction could be used to resend the dropped transaction
+        """
+        raw_transaction = self.sign_transaction(transaction, out_f)
+        print("Submitting transaction...\n", file=out_f)
+        return self.w3.eth.send_raw_transaction(raw_transaction), raw_transaction
+
     @abc.abstractmethod
     def sign_message_after_solidity_keccak(self, message):
         raise NotImplementedError()
@@ -51,10 +61,9 @@ class KeyIdentityProvider(IdentityProvider):
     def get_address(self):
         return self.address
 
-    def transact(self, transaction, out_f):
-        raw_transaction = sign_transaction_with_private_key(
+    def sign_transaction(self, transaction, out_f):
+        return sign_transaction_with_private_key(
             self.w3, self.private_key, transaction)
-        return send_and_wait_for_transaction(raw_transaction, self.w3, out_f)
 
     def sign_message_after_solidity_keccak(self, message):
         return sign_message_with_private_key(self.w3, self.private_key, message)
@@ -77,15 +86,14 @@ class KeyStoreIdentityProvider(IdentityProvider):
     def get_address(self):
         return self.address
 
-    def transact(self, transaction, out_f):
+    def sign_transaction(self, transaction, out_f):
 
         if self.private_key is None:
             self.private_key = unlock_keystore_with_password(
                 self.w3, self.path_to_keystore)
 
-        raw_transaction = sign_transaction_with_private_key(
+        return sign_transaction_with_private_key(
             self.w3, self.private_key, transaction)
-        return send_and_wait_for_transaction(raw_transaction, self.w3, out_f)
 
     def sign_message_after_solidity_keccak(self, message):
 
@@ -96,6 +104,25 @@ class KeyStoreIdentityProvider(IdentityProvider):
         return sign_message_with_private_key(self.w3, self.private_key, message)
 
 
+class AgentIdentityProvider(IdentityProvider):
+    """ Identity whose decrypted key is held by snet agent: transactions and messages are signed by the agent """
+
+    def __init__(self, w3, agent, key_id, address):
+        self.w3 = w3
+        self.agent = agent
+        self.key_id = key_id
+        self.address = address
+
+    def get_address(self):
+        return self.address
+
+    def sign_transaction(self, transaction, out_f):
+        return self.agent.sign_transaction(self.key_id, transaction)
+
+    def sign_message_after_solidity_keccak(self, message):
+        return self.agent.sign_message(self.key_id, message)
+
+
 class RpcIdentityProvider(IdentityProvider):
     def __init__(self, w3, index):
         self.w3 = w3
@@ -104,10 +131,12 @@ class RpcIdentityProvider(IdentityProvider):
     def get_address(self):
         return self.address
 
-    def transact(self, transaction, out_f):
+    def sign_transaction(self, transaction, out_f):
+        raise Exception("Transactions of rpc identity are signed by the node")
+
+    def send_transaction(self, transaction, out_f):
         print("Submitting transaction...\n", file=out_f)
-        txn_hash = self.w3.eth.sendTransaction(transaction)
-        return send_and_wait_for_transaction_receipt(txn_hash, self.w3)
+        return self.w3.eth.sendTransaction(transaction), None
 
     def sign_message_after_solidity_keccak(self, message):
         return self.w3.eth.sign(self.get_address(), message)
@@ -132,10 +161,9 @@ class MnemonicIdentityProvider(IdentityProvider):
     def get_address(self):
         return self.address
 
-    def transact(self, transaction, out_f):
-        raw_transaction = sign_transaction_with_private_key(
+    def sign_transaction(self, transaction, out_f):
+        return sign_transaction_with_private_key(
             self.w3, self.private_key, transaction)
-        return send_and_wait_for_transaction(raw_transaction, self.w3, out_f)
 
     def sign_message_after_solidity_keccak(self, message):
         return sign_message_with_private_key(self.w3, self.private_key, message)
@@ -155,7 +183,7 @@ class TrezorIdentityProvider(IdentityProvider):
     def get_address(self):
         return self.address
 
-    def transact(self, transaction, out_f):
+    def sign_transaction(self, transaction, out_f):
         print("Sending transaction to trezor for signature...\n", file=out_f)
         signature = self.client.ethereum_sign_tx(n=[44 + BIP32_HARDEN, 60 + BIP32_HARDEN,
                                                     BIP32_HARDEN, 0, self.index],
@@ -174,7 +202,7 @@ class TrezorIdentityProvider(IdentityProvider):
                                              vrs=(signature[0],
                                                   int(signature[1].hex(), 16),
                                                   int(signature[2].hex(), 16)))
-        return send_and_wait_for_transaction(raw_transaction, self.w3, out_f)
+        return raw_transaction
 
     def sign_message_after_solidity_keccak(self, message):
         n = self.client._convert_prime([44 + BIP32_HARDEN,
@@ -215,7 +243,7 @@ class LedgerIdentityProvider(IdentityProvider):
     def get_address(self):
         return self.address
 
-    def transact(self, transaction, out_f):
+    def sign_transaction(self, transaction, out_f):
         tx = UnsignedTransaction(
             nonce=transaction["nonce"],
             gasPrice=transaction["gasPrice"],
@@ -265,7 +293,7 @@ class LedgerIdentityProvider(IdentityProvider):
                                                   int.from_bytes(
                                                       result[1:33], byteorder="big"),
                                                   int.from_bytes(result[33:65], byteorder="big")))
-        return send_and_wait_for_transaction(raw_transaction, self.w3, out_f)
+        return raw_transaction
 
     def sign_message_after_solidity_keccak(self, message):
         apdu = LedgerIdentityProvider.SIGN_MESSAGE_OP
@@ -281,24 +309,30 @@ class LedgerIdentityProvider(IdentityProvider):
         return result[1:] + result[0:1]
 
 
-def send_and_wait_for_transaction_receipt(txn_hash, w3):
-    # Wait for transaction to be mined
-    receipt = dict()
-    while not receipt:
-        time.sleep(1)
+def check_pipelined_transaction(w3, txn_hash, address, nonce, raw_transaction=None):
+    """
+    Check the transaction without receipt which was sent with the locally assigned nonce (see NonceManager).
+    If the node has forgotten the transaction (it was dropped from the mempool) we send it again,
+    if another transaction with the same nonce has been mined (it was replaced) we raise an exception.
+    """
+    if w3.eth.get_transaction_count(address) > nonce:
+        # the nonce has been used, but our transaction could be mined just after we asked for the receipt
+        try:
+            w3.eth.get_transaction_receipt(txn_hash)
+            return
+        except TransactionNotFound:
+            raise Exception("Transaction %s has been replaced by another transaction with nonce %i" % (
+                w3.to_hex(txn_hash), nonce))
+    try:
+        w3.eth.get_transaction(txn_hash)
+    except TransactionNotFound:
+        if raw_transaction is None:
+            raise Exception("Transaction %s has been dropped by the node" % w3.to_hex(txn_hash))
         try:
-            receipt = w3.eth.get_transaction_receipt(txn_hash)
-            if receipt and "blockHash" in receipt and receipt["blockHash"] is None:
-                receipt = dict()
-        except:
-            receipt = dict()
-    return receipt
-
-
-def send_and_wait_for_transaction(raw_transaction, w3, out_f):
-    print("Submitting transaction...\n", file=out_f)
-    txn_hash = w3.eth.send_raw_transaction(raw_transaction)
-    return send_and_wait_for_transaction_receipt(txn_hash, w3)
+            w3.eth.send_raw_transaction(raw_transaction)
+        except ValueError:
+            # "already known" or "nonce too low", we will see it on the next block
+            pass
 
 
 def parse_bip32_path(path):
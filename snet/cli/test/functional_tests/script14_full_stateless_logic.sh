@@ -50,4 +50,7 @@ snet client call testo tests group1 classify {} -y
 
 test_get_channel_state 99950000
 
+snet client bench testo tests group1 classify {} --requests 10 -y
+test_get_channel_state 99850000
+
 kill $DAEMON
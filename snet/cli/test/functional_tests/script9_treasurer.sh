@@ -87,4 +87,28 @@ snet client call testo tests group0 classify {} --channel-id 2 -y
 snet treasurer claim-all --endpoint 127.0.0.1:50051  --wallet-index 9 -yq
 assert_balance 0.0014
 
+# treasurer loop claims channels with unclaimed amount above the threshold
+snet client call testo tests group0 classify {} --channel-id 1 -y
+snet treasurer run --amount-threshold 0.0001 --max-iterations 1 --endpoint 127.0.0.1:50051  --wallet-index 9 -yq
+assert_balance 0.0015
+
+# several endpoints of the same payment group return the same payments, they should be claimed only once
+snet client call testo tests group0 classify {} --channel-id 2 -y
+snet treasurer print-unclaimed --endpoint 127.0.0.1:50051 --endpoint localhost:50051 --wallet-index 9
+snet treasurer claim-all --endpoint 127.0.0.1:50051 --endpoint localhost:50051 --wallet-index 9 -yq
+assert_balance 0.0016
+
+# claim plan: with zero ASI(FET) price nothing is worth claiming, without it everything is claimed
+snet client call testo tests group0 classify {} --channel-id 0 -y
+snet treasurer plan --token-price-in-eth 0 --execute --endpoint 127.0.0.1:50051 --wallet-index 9 -yq
+assert_balance 0.0016
+snet treasurer plan --execute --endpoint 127.0.0.1:50051 --wallet-index 9 -yq
+assert_balance 0.0017
+
+# with --claim-batch-size 1 every channel is claimed by its own channelClaim transaction
+snet client call testo tests group0 classify {} --channel-id 1 -y
+snet client call testo tests group0 classify {} --channel-id 2 -y
+snet treasurer claim 1 2 --endpoint 127.0.0.1:50051  --wallet-index 9 --claim-batch-size 1 -yq
+assert_balance 0.0019
+
 kill $DAEMON
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import grpc
+from web3 import Web3
+
+from snet.cli.async_client import AsyncServiceClient
+from snet.cli.commands.mpe_client import MPEClientCommand
+from snet.cli.utils.proto_utils import build_method_index, import_protobuf_from_index
+from snet.cli.utils.utils import compile_proto, close_grpc_channels
+
+SERVICE_SPEC_DIR = Path(__file__).absolute().parent.parent.joinpath("functional_tests", "service_spec1")
+CHANNEL_ID = 7
+PRICE = 10
+
+
+class _Config(object):
+    def get_session_field(self, key, exception_if_not_found=True):
+        return None
+
+
+class _FakeService(object):
+    """ ExampleService behind the daemon, which accepts escrow payment only if it is "last signed amount + price" """
+
+    def __init__(self):
+        self.signed_amount = 100
+        self.amounts = []
+
+    async def classify(self, request, context):
+        amount = int(dict(context.invocation_metadata())["snet-payment-channel-amount"])
+        self.amounts.append(amount)
+        if amount != self.signed_amount + PRICE:
+            await context.abort(grpc.StatusCode.UNAUTHENTICATED, "incorrect payment amount")
+        if not request.image:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "empty image")
+        self.signed_amount = amount
+        return self.response_class(predictions=[request.image_type])
+
+
+class _ClientCommand(MPEClientCommand):
+    """ Client command without blockchain and registry: org, service and channel are given by the test """
+    service = None
+    spec_dir = None
+
+    def __init__(self, config, args, out_f=None, err_f=None):
+        super().__init__(_Config(), args, out_f=out_f, err_f=err_f, w3=Web3(), ident=object())
+
+    def check_ident(self):
+        pass
+
+    def get_mpe_address(self):
+        return "0x" + "00" * 20
+
+    def get_service_spec_dir(self, org_id, service_id):
+        return self.spec_dir
+
+    def _read_metadata_for_org(self, org_id):
+        return None
+
+    def _get_service_metadata(self):
+        return {"encoding": "proto"}
+
+    def _get_price_from_metadata(self, service_metadata, group_name):
+        return PRICE
+
+    def _smart_get_channel_for_org(self, org_metadata, filter_by):
+        return {"channel_id": CHANNEL_ID}
+
+    def _get_channel_state_from_server(self, grpc_channel, channel_id):
+        return {"current_nonce": 0, "current_signed_amount": self.service.signed_amount}
+
+    def _create_call_metadata(self, channel_id, nonce, amount, mpe_address=None):
+        return [("snet-payment-channel-amount", str(amount))]
+
+
+class TestAsyncServiceClient(unittest.TestCase):
+    def setUp(self):
+        self.home_dir = tempfile.mkdtemp()
+        self.spec_dir = Path(tempfile.mkdtemp())
+        self.assertTrue(compile_proto(SERVICE_SPEC_DIR, self.spec_dir, proto_file="ExampleService.proto"))
+        index = build_method_index(self.spec_dir)
+        _, _, response_class = import_protobuf_from_index(self.spec_dir, index["methods"]["ExampleService.classify"])
+
+        self.service = _FakeService()
+        self.service.response_class = response_class
+        _ClientCommand.service = self.service
+        _ClientCommand.spec_dir = self.spec_dir
+        self.patches = [mock.patch.dict(os.environ, {"HOME": self.home_dir}),
+                        mock.patch("snet.cli.async_client.MPEClientCommand", _ClientCommand)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        close_grpc_channels()
+        shutil.rmtree(self.home_dir)
+        shutil.rmtree(self.spec_dir)
+
+    def _run_with_server(self, test):
+        async def run():
+            import ExampleService_pb2_grpc
+            server = grpc.aio.server()
+            ExampleService_pb2_grpc.add_ExampleServiceServicer_to_server(self.service, server)
+            port = server.add_insecure_port("localhost:0")
+            await server.start()
+            try:
+                client = AsyncServiceClient(None, "org", "service", "default_group", endpoint="localhost:%i" % port,
+                                            skip_update_check=True)
+                async with client:
+                    await test(client)
+            finally:
+                await server.stop(None)
+
+        asyncio.run(run())
+
+    def test_call(self):
+        async def test(client):
+            self.assertEqual(client.price, PRICE)
+            response = await client.call("classify", {"image_type": "jpg", "image": "abc"})
+            self.assertEqual(list(response.predictions), ["jpg"])
+            # escrow calls of one channel are processed by daemon one by one
+            for i in range(3):
+                response = await client.call("classify", {"image_type": str(i), "image": "abc"})
+                self.assertEqual(list(response.predictions), [str(i)])
+
+        self._run_with_server(test)
+        self.assertEqual(self.service.amounts, [110, 120, 130, 140])
+
+    def test_retry_and_failed_call(self):
+        async def test(client):
+            # the ledger is ahead of the daemon (for example another process has signed the amount, but failed)
+            payment_state = client._session["payment_state"]
+            client._command.allocate_call_payment(payment_state)
+            response = await client.call("classify", {"image_type": "jpg", "image": "abc"})
+            self.assertEqual(list(response.predictions), ["jpg"])
+
+            with self.assertRaises(grpc.RpcError) as context:
+                await client.call("classify", {"image_type": "jpg"})
+            self.assertEqual(context.exception.code(), grpc.StatusCode.INVALID_ARGUMENT)
+            # the failed call doesn't take the payment, so the next call signs the same amount
+            await client.call("classify", {"image_type": "jpg", "image": "abc"})
+
+        self._run_with_server(test)
+        self.assertEqual(self.service.amounts, [120, 110, 120, 120])
+
+    def test_not_opened(self):
+        client = AsyncServiceClient(None, "org", "service", "default_group")
+        with self.assertRaises(Exception):
+            asyncio.run(client.call("classify", {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import time
+import unittest
+
+from snet.cli.utils.bench_stats import run_bench_requests, summarize_bench_results, latency_histogram, \
+    format_histogram
+
+
+class TestBenchStats(unittest.TestCase):
+    def test_summarize_bench_results(self):
+        results = [(i / 1000, None) for i in range(1, 101)] + [(0.5, "UNAVAILABLE"), (0.1, "UNAVAILABLE"),
+                                                                (0.2, "UNAUTHENTICATED")]
+        summary = summarize_bench_results(results, 2.0)
+        self.assertEqual(summary["requests"], 103)
+        self.assertEqual(summary["successful"], 100)
+        self.assertEqual(summary["errors"], {"UNAVAILABLE": 2, "UNAUTHENTICATED": 1})
+        self.assertEqual(summary["rps"], 51.5)
+        self.assertEqual(summary["latency_ms"], {"p50": 50.0, "p90": 90.0, "p99": 99.0, "max": 100.0})
+
+        summary = summarize_bench_results([(0.1, "UNAVAILABLE")], 0.1)
+        self.assertEqual(summary["successful"], 0)
+        self.assertNotIn("latency_ms", summary)
+
+    def test_latency_histogram(self):
+        latencies = [0.001, 0.002, 0.02, 0.1, 0.1]
+        histogram = latency_histogram(latencies, n_buckets=2)
+        self.assertEqual([count for _, count in histogram], [2, 3])
+        self.assertAlmostEqual(histogram[0][0], 0.01)
+        self.assertEqual(histogram[-1][0], 0.1)
+        self.assertEqual(latency_histogram([0.1, 0.1]), [(0.1, 2)])
+        self.assertEqual(latency_histogram([]), [])
+        self.assertEqual(len(format_histogram(histogram).splitlines()), 2)
+
+    def test_closed_loop_latency(self):
+        def send():
+            time.sleep(0.02)
+            return None
+
+        # latency doesn't include waiting for a free thread, so it doesn't grow with the number of requests
+        results, elapsed = run_bench_requests(send, 20, concurrency=2)
+        self.assertEqual(len(results), 20)
+        self.assertGreaterEqual(elapsed, 0.2)
+        self.assertTrue(all(0.02 <= latency < 0.1 for latency, _ in results))
+
+    def test_open_loop_latency(self):
+        # requests are scheduled faster than one thread sends them, so later requests wait in the queue
+        results, elapsed = run_bench_requests(lambda: time.sleep(0.02) or "ERROR", 10, concurrency=1, rate=1000)
+        self.assertEqual({error for _, error in results}, {"ERROR"})
+        self.assertGreater(results[-1][0], 0.15)
+        self.assertGreaterEqual(elapsed, 0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
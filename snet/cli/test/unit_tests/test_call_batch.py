@@ -0,0 +1,143 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import grpc
+from google.protobuf import struct_pb2
+from web3 import Web3
+
+from snet.cli.commands.mpe_client import MPEClientCommand
+from snet.cli.utils.utils import DefaultAttributeObject
+
+CHANNEL_ID = 7
+PRICE = 10
+
+
+class _RpcError(grpc.RpcError):
+    def __init__(self, code, details=""):
+        self._code = code
+        self._details = details
+
+    def code(self):
+        return self._code
+
+    def details(self):
+        return self._details
+
+
+class _FakeDaemon(object):
+    """ Accepts escrow payment only if it is exactly "last signed amount + price" """
+
+    def __init__(self, signed_amount=0):
+        self.signed_amount = signed_amount
+        self.amounts = []
+
+    def get_channel_state(self):
+        return {"current_nonce": 0, "current_signed_amount": self.signed_amount}
+
+    def call(self, request, metadata, compression=None):
+        amount = int(dict(metadata)["snet-payment-channel-amount"])
+        self.amounts.append(amount)
+        if amount != self.signed_amount + PRICE:
+            raise _RpcError(grpc.StatusCode.UNAUTHENTICATED, "incorrect payment amount")
+        self.signed_amount = amount
+        return request
+
+
+class _ClientCommand(MPEClientCommand):
+    def __init__(self, daemon, **kwargs):
+        args = DefaultAttributeObject(**dict({"max_retries": 3, "payment_mode": "escrow", "concurrency": 1}, **kwargs))
+        super().__init__(None, args, out_f=io.StringIO(), err_f=io.StringIO(), w3=Web3(), ident=object())
+        self.daemon = daemon
+
+    def get_mpe_address(self):
+        return "0x" + "00" * 20
+
+    def _get_channel_state_from_server(self, grpc_channel, channel_id):
+        return self.daemon.get_channel_state()
+
+    def _create_call_metadata(self, channel_id, nonce, amount, mpe_address=None):
+        return [("snet-payment-channel-amount", str(amount))]
+
+
+class TestCallBatch(unittest.TestCase):
+    def setUp(self):
+        self.home_dir = tempfile.mkdtemp()
+        self.home_patch = mock.patch.dict(os.environ, {"HOME": self.home_dir})
+        self.home_patch.start()
+        self.state = {"grpc_channel": None, "mpe_address": "0x" + "00" * 20, "channel_id": CHANNEL_ID,
+                      "price": PRICE, "payment_mode": "escrow", "prepaid_calls": 1, "compression": None}
+
+    def tearDown(self):
+        self.home_patch.stop()
+        shutil.rmtree(self.home_dir)
+
+    def _call(self, command, line='{"x": 1}'):
+        return command._call_batch_item(command.daemon.call, self._build_request, self.state, 0, line)
+
+    @staticmethod
+    def _build_request(params):
+        request = struct_pb2.Struct()
+        request.update(params)
+        return request
+
+    def test_retry_after_rejected_payment(self):
+        daemon = _FakeDaemon(signed_amount=100)
+        command = _ClientCommand(daemon)
+        self.assertEqual(self._call(command), {"index": 0, "response": {"x": 1}})
+
+        # another process has signed two amounts in the ledger, but they have never reached the daemon
+        command._allocate_channel_amount(None, CHANNEL_ID, PRICE)
+        command._allocate_channel_amount(None, CHANNEL_ID, PRICE)
+        self.assertEqual(self._call(command, '{"x": 2}'), {"index": 0, "response": {"x": 2}})
+        # the rejected payment invalidates the ledger, so the retry is based on the state from the daemon
+        self.assertEqual(daemon.amounts, [110, 140, 120])
+        self.assertEqual(daemon.signed_amount, 120)
+
+    def test_max_retries(self):
+        daemon = _FakeDaemon()
+        command = _ClientCommand(daemon, max_retries=2)
+        daemon.call = mock.Mock(side_effect=_RpcError(grpc.StatusCode.FAILED_PRECONDITION, "payment in progress"))
+        result = self._call(command)
+        self.assertEqual(result, {"index": 0, "error": "FAILED_PRECONDITION: payment in progress"})
+        self.assertEqual(daemon.call.call_count, 3)
+
+        # other errors are not retried
+        daemon.call = mock.Mock(side_effect=_RpcError(grpc.StatusCode.INVALID_ARGUMENT, "wrong request"))
+        self.assertEqual(self._call(command)["error"], "INVALID_ARGUMENT: wrong request")
+        self.assertEqual(daemon.call.call_count, 1)
+        self.assertEqual(self._call(command, "not json")["index"], 0)
+
+    def test_results_in_input_order(self):
+        in_flight = []
+        max_in_flight = []
+        lock = threading.Lock()
+
+        def call_item(index, line):
+            with lock:
+                in_flight.append(index)
+                max_in_flight.append(len(in_flight))
+            # the first requests are the slowest ones
+            time.sleep(0.01 * (10 - index))
+            with lock:
+                in_flight.remove(index)
+            return {"index": index, "response": line}
+
+        lines = [str(i) for i in range(10)]
+        results = list(MPEClientCommand._run_batch_calls(call_item, lines, 4))
+        self.assertEqual([r["index"] for r in results], list(range(10)))
+        self.assertEqual([r["response"] for r in results], lines)
+        self.assertEqual(max(max_in_flight), 4)
+
+    def test_escrow_concurrency(self):
+        self.assertEqual(_ClientCommand(None, concurrency=8)._get_batch_concurrency(), 1)
+        self.assertEqual(_ClientCommand(None, concurrency=8, payment_mode="prepaid")._get_batch_concurrency(), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import base64
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from google.protobuf.internal.decoder import _DecodeVarint32
+
+from snet.cli.utils.call_output import CallOutput, OUTPUT_FORMATS, response_to_dict
+from snet.cli.utils.proto_utils import build_method_index, import_protobuf_from_index, LazyJsonMessage
+from snet.cli.utils.utils import compile_proto
+
+SERVICE_SPEC_DIR = Path(__file__).absolute().parent.parent.joinpath("functional_tests", "service_spec1")
+
+
+class TestCallOutput(unittest.TestCase):
+    def setUp(self):
+        self.codegen_dir = Path(tempfile.mkdtemp())
+        self.assertTrue(compile_proto(SERVICE_SPEC_DIR, self.codegen_dir, proto_file="ExampleService.proto"))
+        index = build_method_index(self.codegen_dir)
+        _, _, self.response_class = import_protobuf_from_index(self.codegen_dir,
+                                                               index["methods"]["ExampleService.classify"])
+        self.responses = [self.response_class(predictions=["cat"], binary_field=b"\x00\x01"),
+                          self.response_class(predictions=["dog", "bird"], binary_field=b"\x02")]
+
+    def tearDown(self):
+        shutil.rmtree(self.codegen_dir)
+
+    def _print_responses(self, output_format, responses, is_stream):
+        printed = []
+        with CallOutput(printed.append, output_format, is_stream=is_stream) as output:
+            for r in responses:
+                output.write(r)
+        return printed
+
+    def test_formats(self):
+        self.assertEqual(OUTPUT_FORMATS, ["text", "json", "ndjson"])
+        expected = [{"predictions": ["cat"], "binary_field": base64.b64encode(b"\x00\x01").decode()},
+                    {"predictions": ["dog", "bird"], "binary_field": base64.b64encode(b"\x02").decode()}]
+
+        printed = self._print_responses("text", self.responses[:1], is_stream=False)
+        self.assertEqual(printed, [self.responses[0]])
+        self.assertIn('predictions: "cat"', str(printed[0]))
+
+        printed = self._print_responses("json", self.responses, is_stream=True)
+        self.assertEqual([json.loads(p) for p in printed], expected)
+
+        printed = self._print_responses("ndjson", self.responses, is_stream=True)
+        self.assertEqual([json.loads(p) for p in printed], expected)
+        self.assertTrue(all("\n" not in p for p in printed))
+
+        with self.assertRaises(Exception):
+            CallOutput(print, "xml")
+
+    def test_lazy_json_response(self):
+        data = json.dumps({"predictions": ["cat"], "binary_field": base64.b64encode(b"\x00\x01").decode()})
+        response = LazyJsonMessage(data.encode("utf-8"), self.response_class)
+        self.assertEqual(response_to_dict(response), response_to_dict(self.responses[0]))
+
+    def test_save_response(self):
+        tmp_dir = Path(tempfile.mkdtemp())
+        try:
+            file_name = tmp_dir.joinpath("response.bin")
+            printed = []
+            with CallOutput(printed.append, save_response=file_name) as output:
+                output.write(self.responses[0])
+            self.assertEqual(printed, [])
+            self.assertEqual(self.response_class.FromString(file_name.read_bytes()), self.responses[0])
+
+            # responses of the stream are length-delimited
+            with CallOutput(printed.append, save_response=file_name, is_stream=True) as output:
+                for r in self.responses:
+                    output.write(r)
+            data = file_name.read_bytes()
+            saved, pos = [], 0
+            while pos < len(data):
+                length, pos = _DecodeVarint32(data, pos)
+                saved.append(self.response_class.FromString(data[pos:pos + length]))
+                pos += length
+            self.assertEqual(saved, self.responses)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_save_fields(self):
+        tmp_dir = Path(tempfile.mkdtemp())
+        try:
+            binary_file = tmp_dir.joinpath("binary")
+            text_file = tmp_dir.joinpath("text")
+            save_fields = [("binary_field", binary_file), ("predictions", text_file)]
+            with CallOutput(print, save_fields=save_fields, is_stream=True) as output:
+                for r in self.responses:
+                    output.write(r)
+            # bytes are concatenated, other fields are written one value per line
+            self.assertEqual(binary_file.read_bytes(), b"\x00\x01\x02")
+            lines = text_file.read_text().splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertIn("cat", lines[0])
+            self.assertIn("bird", lines[1])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import base64
+import io
+import json
+import mmap
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from web3 import Web3
+
+from snet.cli.commands.mpe_client import MPEClientCommand
+from snet.cli.utils.proto_utils import build_method_index, import_protobuf_from_index, build_serialized_request
+from snet.cli.utils.utils import DefaultAttributeObject, compile_proto
+
+SERVICE_SPEC_DIR = Path(__file__).absolute().parent.parent.joinpath("functional_tests", "service_spec1")
+
+
+class _ClientCommand(MPEClientCommand):
+    """ Keeps all mmaps of file@ params to check that they are closed """
+
+    def __init__(self, **kwargs):
+        super().__init__(None, DefaultAttributeObject(**kwargs), out_f=io.StringIO(), err_f=io.StringIO(),
+                         w3=Web3(), ident=object())
+        self.all_mapped_files = []
+
+    def _map_file(self, file_name, mapped_files):
+        data = MPEClientCommand._map_file(file_name, mapped_files)
+        self.all_mapped_files.append(data)
+        return data
+
+
+class TestCallParams(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.data_file = self.tmp_dir.joinpath("data.bin")
+        self.data_file.write_bytes(b"0123456789")
+        self.empty_file = self.tmp_dir.joinpath("empty.bin")
+        self.empty_file.write_bytes(b"")
+        self.assertTrue(compile_proto(SERVICE_SPEC_DIR, self.tmp_dir, proto_file="ExampleService.proto"))
+        index = build_method_index(self.tmp_dir)
+        _, _, self.response_class = import_protobuf_from_index(self.tmp_dir,
+                                                               index["methods"]["ExampleService.classify"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _assert_all_closed(self, command):
+        self.assertTrue(command.all_mapped_files)
+        self.assertTrue(all(m.closed for m in command.all_mapped_files if isinstance(m, mmap.mmap)))
+
+    def test_transform_call_params(self):
+        command = _ClientCommand()
+        mapped_files = []
+        params = command._transform_call_params({"file@binary_field": str(self.data_file),
+                                                 "nested": {"file@b64encode@image": str(self.data_file)},
+                                                 "file@empty": str(self.empty_file),
+                                                 "b64decode@text": base64.b64encode(b"text").decode()},
+                                                mapped_files)
+        self.assertEqual(bytes(params["binary_field"]), b"0123456789")
+        self.assertEqual(params["nested"]["image"], base64.b64encode(b"0123456789"))
+        self.assertEqual(params["empty"], b"")
+        self.assertEqual(params["text"], b"text")
+        # empty files are not mapped
+        self.assertEqual(len(mapped_files), 2)
+        command._close_mapped_files(mapped_files)
+        self.assertEqual(mapped_files, [])
+        self._assert_all_closed(command)
+
+        with self.assertRaises(Exception):
+            command._transform_call_params({"unknown@field": "value"}, [])
+
+    def test_stream_chunks(self):
+        command = _ClientCommand(chunk_size=4)
+        lines = [json.dumps({"file_chunks@binary_field": str(self.data_file), "predictions": ["a"]}),
+                 "",
+                 json.dumps({"file@binary_field": str(self.data_file)})]
+        requests = [build_serialized_request(self.response_class, p)
+                    for p in command._iterate_streaming_call_params_from_lines(lines)]
+        messages = [self.response_class.FromString(r) for r in requests]
+        self.assertEqual([m.binary_field for m in messages], [b"0123", b"4567", b"89", b"0123456789"])
+        self.assertEqual([list(m.predictions) for m in messages], [["a"]] * 3 + [[]])
+        self._assert_all_closed(command)
+
+        # files are closed even if the stream is abandoned
+        command = _ClientCommand(chunk_size=4)
+        stream = command._iterate_streaming_call_params_from_lines(lines)
+        build_serialized_request(self.response_class, next(stream))
+        stream.close()
+        self._assert_all_closed(command)
+
+    def test_batch_item(self):
+        command = _ClientCommand()
+        state = {"payment_mode": "none"}
+        command.allocate_call_payment = lambda state, rejected_generation=None: (None, [])
+        line = json.dumps({"file@binary_field": str(self.data_file)})
+        def call_fn(request, metadata, compression):
+            return self.response_class.FromString(request)
+
+        result = command._call_batch_item(call_fn, lambda params: build_serialized_request(self.response_class, params),
+                                          dict(state, compression=None), 0, line)
+        self.assertEqual(result["response"]["binary_field"], base64.b64encode(b"0123456789").decode())
+        # the request is built, so the file is closed before the call
+        self._assert_all_closed(command)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import grpc
+from web3 import Web3
+
+from snet.cli.commands.mpe_client import MPEClientCommand
+from snet.cli.utils.utils import DefaultAttributeObject
+
+CHANNEL_ID = 7
+PRICE = 10
+
+
+class _RpcError(grpc.RpcError):
+    pass
+
+
+class _ClientCommand(MPEClientCommand):
+    """ Client with the fake daemon, which has got payments up to signed_amount """
+
+    def __init__(self, signed_amount=0):
+        super().__init__(None, DefaultAttributeObject(), out_f=io.StringIO(), err_f=io.StringIO(),
+                         w3=Web3(), ident=object())
+        self.signed_amount = signed_amount
+        self.n_state_requests = 0
+
+    def get_mpe_address(self):
+        return "0x" + "00" * 20
+
+    def _get_channel_state_from_server(self, grpc_channel, channel_id):
+        self.n_state_requests += 1
+        return {"current_nonce": 3, "current_signed_amount": self.signed_amount}
+
+
+def _allocate_in_process(n, queue):
+    command = _ClientCommand()
+    queue.put([command._allocate_channel_amount(None, CHANNEL_ID, PRICE)[1] for _ in range(n)])
+
+
+class TestChannelLedger(unittest.TestCase):
+    def setUp(self):
+        self.home_dir = tempfile.mkdtemp()
+        self.home_patch = mock.patch.dict(os.environ, {"HOME": self.home_dir})
+        self.home_patch.start()
+
+    def tearDown(self):
+        self.home_patch.stop()
+        shutil.rmtree(self.home_dir)
+
+    def test_allocate(self):
+        command = _ClientCommand(signed_amount=100)
+        self.assertEqual(command._allocate_channel_amount(None, CHANNEL_ID, PRICE), (3, 110, 0))
+        self.assertEqual(command._allocate_channel_amount(None, CHANNEL_ID, PRICE), (3, 120, 0))
+        # the daemon is asked only for the channel which is not in the ledger
+        self.assertEqual(command.n_state_requests, 1)
+        self.assertEqual(command._allocate_channel_amount(None, CHANNEL_ID + 1, PRICE), (3, 110, 0))
+        self.assertEqual(command.n_state_requests, 2)
+
+        # the ledger is shared with other commands (and processes)
+        self.assertEqual(_ClientCommand()._allocate_channel_amount(None, CHANNEL_ID, PRICE), (3, 130, 0))
+
+    def test_concurrent_threads(self):
+        command = _ClientCommand()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            amounts = list(executor.map(lambda _: command._allocate_channel_amount(None, CHANNEL_ID, PRICE)[1],
+                                        range(50)))
+        self.assertEqual(sorted(amounts), [PRICE * (i + 1) for i in range(50)])
+
+    @unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "fork is not supported")
+    def test_concurrent_processes(self):
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        processes = [context.Process(target=_allocate_in_process, args=(20, queue)) for _ in range(3)]
+        for p in processes:
+            p.start()
+        amounts = [a for _ in processes for a in queue.get(timeout=60)]
+        for p in processes:
+            p.join()
+        # each amount is signed only once
+        self.assertEqual(sorted(amounts), [PRICE * (i + 1) for i in range(60)])
+
+    def test_invalidate(self):
+        command = _ClientCommand(signed_amount=100)
+        _, _, generation = command._allocate_channel_amount(None, CHANNEL_ID, PRICE)
+        command._allocate_channel_amount(None, CHANNEL_ID, PRICE)
+        # two calls have failed, so the daemon has got nothing
+        command._invalidate_channel_ledger(CHANNEL_ID, generation)
+        command._invalidate_channel_ledger(CHANNEL_ID, generation)
+
+        # after invalidation we start from the state of the daemon with the next generation
+        self.assertEqual(command._allocate_channel_amount(None, CHANNEL_ID, PRICE), (3, 110, 1))
+        self.assertEqual(command.n_state_requests, 2)
+
+        # late failure of the call from the old generation doesn't invalidate the reconciled ledger
+        command._invalidate_channel_ledger(CHANNEL_ID, generation)
+        self.assertEqual(command._allocate_channel_amount(None, CHANNEL_ID, PRICE), (3, 120, 1))
+        self.assertEqual(command.n_state_requests, 2)
+
+        # unknown channel is ignored
+        command._invalidate_channel_ledger(CHANNEL_ID + 1, 0)
+        self.assertNotIn(CHANNEL_ID + 1, command._read_channel_ledger())
+
+    def test_recovery_after_invalidation(self):
+        command = _ClientCommand(signed_amount=100)
+        _, _, generation = command._allocate_channel_amount(None, CHANNEL_ID, PRICE)
+        command._invalidate_channel_ledger(CHANNEL_ID, generation)
+        # meanwhile the daemon has got payments from another client
+        command.signed_amount = 150
+        self.assertEqual(command._allocate_channel_amount(None, CHANNEL_ID, PRICE), (3, 160, 1))
+
+        # corrupted ledger is read as empty, so we ask the daemon again
+        command._get_channel_ledger_file().write_bytes(b"corrupted")
+        self.assertEqual(command._allocate_channel_amount(None, CHANNEL_ID, PRICE), (3, 160, 0))
+
+    def test_invalidate_on_stream_error(self):
+        command = _ClientCommand()
+        _, _, generation = command._allocate_channel_amount(None, CHANNEL_ID, PRICE)
+
+        def responses():
+            yield 1
+            raise _RpcError()
+
+        stream = command._invalidate_channel_ledger_on_stream_error(responses(), CHANNEL_ID, generation)
+        self.assertEqual(next(stream), 1)
+        self.assertFalse(command._read_channel_ledger()[CHANNEL_ID]["is_stale"])
+        with self.assertRaises(grpc.RpcError):
+            next(stream)
+        self.assertTrue(command._read_channel_ledger()[CHANNEL_ID]["is_stale"])
+
+
+if __name__ == "__main__":
+    unittest.main()
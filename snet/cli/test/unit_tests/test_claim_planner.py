@@ -0,0 +1,52 @@
+import unittest
+
+from snet.cli.utils.claim_planner import make_claim_plan, get_claim_gas, select_channels_to_claim, \
+    CLAIM_TX_BASE_GAS, CLAIM_GAS_PER_CHANNEL
+
+
+class TestClaimPlanner(unittest.TestCase):
+    def test_ranking_and_net_value(self):
+        candidates = [{"channel_id": 1, "amount": 10 ** 18, "blocks_to_expiration": 100000},
+                      {"channel_id": 2, "amount": 10 ** 12, "blocks_to_expiration": 100000},
+                      {"channel_id": 3, "amount": 10 ** 17, "blocks_to_expiration": 10}]
+        plan = make_claim_plan(candidates, gas_price=10 ** 9, batch_size=10, expiration_threshold=1000,
+                               token_price_in_eth="0.001")
+        # channel 3 expires soon, so it goes first; channel 2 costs more gas than it is worth
+        self.assertEqual([p["channel_id"] for p in plan], [3, 1, 2])
+        self.assertEqual([p["selected"] for p in plan], [True, True, False])
+        self.assertEqual(plan[2]["reason"], "gas cost exceeds the amount")
+        self.assertEqual(plan[1]["net_value_wei"], 10 ** 15 - plan[1]["gas_cost_wei"])
+
+    def test_gas_budget(self):
+        candidates = [{"channel_id": i, "amount": i, "blocks_to_expiration": 100000} for i in range(5)]
+        budget = get_claim_gas(3, batch_size=2)
+        self.assertEqual(budget, 2 * CLAIM_TX_BASE_GAS + 3 * CLAIM_GAS_PER_CHANNEL)
+        plan = make_claim_plan(candidates, gas_price=1, batch_size=2, expiration_threshold=0, gas_budget=budget)
+        self.assertEqual([p["channel_id"] for p in plan if p["selected"]], [4, 3, 2])
+        self.assertEqual({p["reason"] for p in plan if not p["selected"]}, {"out of gas budget"})
+
+    def test_select_channels_to_claim(self):
+        unclaimed = [{"channel_id": 1, "amount": 100}, {"channel_id": 2, "amount": 5},
+                     {"channel_id": 3, "amount": 5}, {"channel_id": 4, "amount": 0}]
+        requested = []
+
+        def get_expirations(channels_ids):
+            requested.append(channels_ids)
+            return {channel_id: {1: 5000, 2: 1050, 3: 5000}[channel_id] for channel_id in channels_ids}
+
+        expirations = {}
+        selected = select_channels_to_claim(unclaimed, expirations, get_expirations, current_block=1000,
+                                            expiration_threshold=100, amount_threshold=50)
+        self.assertEqual(selected, [(1, "amount"), (2, "expiration")])
+        self.assertEqual(requested, [[2, 3]])
+        self.assertEqual(expirations, {2: 1050, 3: 5000})
+
+        # cached expirations are not requested again
+        selected = select_channels_to_claim(unclaimed, expirations, get_expirations, current_block=4950,
+                                            expiration_threshold=100)
+        self.assertEqual(selected, [(1, "expiration"), (2, "expiration"), (3, "expiration")])
+        self.assertEqual(requested, [[2, 3], [1]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,21 @@
+import unittest
+
+from snet.cli.utils.daemon_stubs import get_daemon_stub_classes
+
+
+class TestDaemonStubs(unittest.TestCase):
+    def test_get_daemon_stub_classes(self):
+        stub_class, request_class, response_class = get_daemon_stub_classes("GetChannelState")
+        self.assertEqual(stub_class.__name__, "PaymentChannelStateServiceStub")
+        self.assertEqual(request_class.DESCRIPTOR.name, "ChannelStateRequest")
+        self.assertEqual(response_class.DESCRIPTOR.name, "ChannelStateReply")
+        # protobuf is imported only once
+        self.assertIs(get_daemon_stub_classes("GetChannelState"), get_daemon_stub_classes("GetChannelState"))
+
+    def test_unknown_method(self):
+        with self.assertRaises(Exception):
+            get_daemon_stub_classes("UnknownMethod")
+
+
+if __name__ == "__main__":
+    unittest.main()
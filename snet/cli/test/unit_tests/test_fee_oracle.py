@@ -0,0 +1,43 @@
+import unittest
+
+from snet.cli.utils.fee_oracle import FeeOracle
+
+
+class _Eth(object):
+    def __init__(self, history):
+        self.history = history
+        self.block_number = 100
+        self.requests = 0
+
+    def fee_history(self, block_count, newest_block, reward_percentiles):
+        self.requests += 1
+        if self.history is None:
+            raise ValueError("the method eth_feeHistory does not exist")
+        return self.history
+
+
+class _W3(object):
+    def __init__(self, history):
+        self.eth = _Eth(history)
+
+
+class TestFeeOracle(unittest.TestCase):
+    def test_fee_params(self):
+        w3 = _W3({"baseFeePerGas": [90, 100, 110],
+                  "reward": [[1, 10, 100], [3, 30, 300]]})
+        oracle = FeeOracle(w3)
+        self.assertEqual(oracle.get_fee_params("slow"), {"maxFeePerGas": 223, "maxPriorityFeePerGas": 3})
+        self.assertEqual(oracle.get_fee_params("fast"), {"maxFeePerGas": 520, "maxPriorityFeePerGas": 300})
+        # history is cached until the next block
+        self.assertEqual(w3.eth.requests, 1)
+        w3.eth.block_number += 1
+        oracle.get_fee_params()
+        self.assertEqual(w3.eth.requests, 2)
+
+    def test_legacy_network(self):
+        self.assertIsNone(FeeOracle(_W3(None)).get_fee_params())
+        self.assertIsNone(FeeOracle(_W3({"baseFeePerGas": [0, 0], "reward": [[0, 0, 0]]})).get_fee_params())
+
+
+if __name__ == "__main__":
+    unittest.main()
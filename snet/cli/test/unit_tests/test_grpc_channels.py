@@ -0,0 +1,45 @@
+import unittest
+from concurrent import futures
+
+import grpc
+from grpc_health.v1 import health, health_pb2_grpc
+
+from snet.cli.utils.utils import open_grpc_channel, close_grpc_channels, check_endpoint_health, \
+    get_grpc_channel_options
+
+
+class TestGrpcChannels(unittest.TestCase):
+    def setUp(self):
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+        health_pb2_grpc.add_HealthServicer_to_server(health.HealthServicer(), self.server)
+        self.endpoint = "http://localhost:%i" % self.server.add_insecure_port("localhost:0")
+        self.server.start()
+
+    def tearDown(self):
+        close_grpc_channels()
+        self.server.stop(None)
+
+    def test_reuse_and_close(self):
+        options = get_grpc_channel_options(keepalive_time_ms=10000)
+        channel = open_grpc_channel(self.endpoint, options, reuse=True)
+        self.assertIs(open_grpc_channel(self.endpoint, options, reuse=True), channel)
+        self.assertIsNot(open_grpc_channel(self.endpoint, reuse=True), channel)
+
+        close_grpc_channels()
+        with self.assertRaises(ValueError):
+            # closed channel can't be used anymore
+            channel.unary_unary("/grpc.health.v1.Health/Check")(b"")
+        self.assertIsNot(open_grpc_channel(self.endpoint, options, reuse=True), channel)
+
+    def test_check_endpoint_health(self):
+        is_available, rtt = check_endpoint_health(self.endpoint, 5, get_grpc_channel_options(keepalive_time_ms=10000))
+        self.assertTrue(is_available)
+        self.assertGreater(rtt, 0)
+
+        # the health check request doesn't fit into the message size limit
+        self.assertEqual(check_endpoint_health(self.endpoint, 5, get_grpc_channel_options(max_message_length=1)),
+                         (False, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
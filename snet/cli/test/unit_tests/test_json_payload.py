@@ -0,0 +1,109 @@
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from google.protobuf import json_format
+
+from snet.cli.utils.proto_utils import build_method_index, import_protobuf_from_index, build_json_request, \
+    LazyJsonMessage
+from snet.cli.utils.utils import compile_proto
+
+SERVICE_SPEC_DIR = Path(__file__).absolute().parent.parent.joinpath("functional_tests", "service_spec1")
+
+TYPES_PROTO = """
+syntax = "proto3";
+
+enum Color {
+  RED = 0;
+  GREEN = 1;
+}
+
+message Inner {
+  int64 id = 1;
+}
+
+message TypesRequest {
+  int32 i32 = 1;
+  int64 i64 = 2;
+  uint64 u64 = 3;
+  float f = 4;
+  double d = 5;
+  bool b = 6;
+  string s = 7;
+  bytes data = 8;
+  Color color = 9;
+  repeated int64 ids = 10;
+  repeated Color colors = 11;
+  map<int32, string> names = 12;
+  map<bool, int64> flags = 13;
+  Inner inner = 14;
+}
+
+service TypesService {
+  rpc call(TypesRequest) returns (TypesRequest);
+}
+"""
+
+
+class TestJsonPayload(unittest.TestCase):
+    def setUp(self):
+        self.codegen_dir = Path(tempfile.mkdtemp())
+        self.proto_dir = Path(tempfile.mkdtemp())
+        self.proto_dir.joinpath("TypesService.proto").write_text(TYPES_PROTO)
+        self.assertTrue(compile_proto(self.proto_dir, self.codegen_dir, proto_file="TypesService.proto"))
+        self.assertTrue(compile_proto(SERVICE_SPEC_DIR, self.codegen_dir, proto_file="ExampleService.proto"))
+        index = build_method_index(self.codegen_dir)
+        _, self.types_class, _ = import_protobuf_from_index(self.codegen_dir, index["methods"]["TypesService.call"])
+        _, self.request_class, self.response_class = import_protobuf_from_index(
+            self.codegen_dir, index["methods"]["ExampleService.classify"])
+
+    def tearDown(self):
+        shutil.rmtree(self.codegen_dir)
+        shutil.rmtree(self.proto_dir)
+
+    def _assert_same_as_message_to_json(self, request_class, params, message=None):
+        if message is None:
+            message = request_class(**params)
+        expected = json_format.MessageToJson(message, True, preserving_proto_field_name=True)
+        self.assertEqual(json.loads(build_json_request(request_class, params)), json.loads(expected))
+
+    def test_build_json_request(self):
+        for params in [{"image_type": "jpg", "image": "abc"}, {"image": "abc"}, {}]:
+            self._assert_same_as_message_to_json(self.request_class, params)
+        with self.assertRaises(ValueError):
+            build_json_request(self.request_class, {"unknown_field": "abc"})
+
+    def test_scalar_types(self):
+        for params in [{"i32": -5, "i64": 2 ** 40, "u64": 2 ** 64 - 1, "f": 0.5, "d": 1, "b": True, "s": "abc",
+                        "data": b"\x00\x01"},
+                       {"color": 1, "colors": ["GREEN", 0]},
+                       {"color": "GREEN", "ids": [1, 2 ** 50]},
+                       {"names": {1: "a", 2: "b"}, "flags": {True: 1, False: 2 ** 40}}]:
+            self._assert_same_as_message_to_json(self.types_class, params)
+
+        message = self.types_class()
+        message.inner.id = 2 ** 40
+        self._assert_same_as_message_to_json(self.types_class, {"inner": {"id": 2 ** 40}}, message)
+
+        data = json.loads(build_json_request(self.types_class, {"i64": 7, "color": 1}))
+        self.assertEqual(data["i64"], "7")
+        self.assertEqual(data["color"], "GREEN")
+
+    def test_wrong_types(self):
+        # wrong values are checked by protobuf locally, as for request_class(**params)
+        for params in [{"i32": "abc"}, {"i32": 2 ** 40}, {"u64": -1}, {"s": 5}, {"b": "true"}, {"f": "1.0"},
+                       {"color": "BLUE"}, {"ids": ["a"]}, {"names": {"a": "b"}}]:
+            with self.assertRaises((TypeError, ValueError)):
+                build_json_request(self.types_class, params)
+
+    def test_lazy_json_message(self):
+        params = {"predictions": ["cat"], "binary_field": memoryview(b"binary")}
+        response = LazyJsonMessage(build_json_request(self.response_class, params), self.response_class)
+        self.assertEqual(response.to_dict()["predictions"], ["cat"])
+        self.assertEqual(response.binary_field, b"binary")
+
+
+if __name__ == "__main__":
+    unittest.main()
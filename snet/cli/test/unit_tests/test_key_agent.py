@@ -0,0 +1,94 @@
+import shutil
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from eth_account import Account
+from hexbytes import HexBytes
+
+from snet.cli.utils.key_agent import KeyAgentClient, KeyStore, is_agent_supported, run_agent, get_agent_log_path
+
+PRIVATE_KEY = "0x" + "11" * 32
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestKeyStore(unittest.TestCase):
+    def test_ttl(self):
+        clock = _Clock()
+        key_store = KeyStore(default_ttl=100, clock=clock)
+        address = key_store.add("key:1", PRIVATE_KEY)
+        key_store.add("key:2", PRIVATE_KEY, ttl=10)
+        self.assertEqual(key_store.handle_request({"op": "get_address", "key_id": "key:1"}), address)
+        self.assertEqual(len(key_store.list_keys()), 2)
+
+        clock.now = 50
+        self.assertIsNone(key_store.get_account("key:2"))
+        self.assertEqual([k["key_id"] for k in key_store.list_keys()], ["key:1"])
+        self.assertEqual(key_store.list_keys()[0]["expires_in"], 50)
+
+        clock.now = 100
+        self.assertIsNone(key_store.handle_request({"op": "get_address", "key_id": "key:1"}))
+        with self.assertRaises(Exception):
+            key_store.handle_request({"op": "sign_message", "key_id": "key:1", "message": "0x00"})
+
+
+@unittest.skipUnless(is_agent_supported(), "Unix domain sockets are not supported")
+class TestKeyAgent(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = Path(self.tmp_dir).joinpath("agent.sock")
+        self.thread = threading.Thread(target=run_agent, args=(self.socket_path, 100))
+        self.thread.start()
+        self.client = KeyAgentClient(self.socket_path)
+        while not self.client.is_running():
+            self.thread.join(0.05)
+
+    def tearDown(self):
+        if self.client.is_running():
+            self.client.stop()
+        self.thread.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sign(self):
+        self.assertEqual(self.socket_path.stat().st_mode & 0o777, 0o600)
+        self.assertIsNone(self.client.get_address("key:1"))
+        address = self.client.add_key("key:1", bytes.fromhex(PRIVATE_KEY[2:]))
+        self.assertEqual(self.client.get_address("key:1"), address)
+        self.assertEqual(len(self.client.sign_message("key:1", b"message")), 65)
+        self.assertEqual([k["address"] for k in self.client.list_keys()], [address])
+
+        self.assertTrue(self.client.remove_key("key:1"))
+        with self.assertRaises(Exception):
+            self.client.sign_message("key:1", b"message")
+
+    def test_sign_transaction(self):
+        self.client.add_key("key:1", PRIVATE_KEY)
+        transaction = {"nonce": 7, "gas": 100000, "maxFeePerGas": 2 * 10 ** 9, "maxPriorityFeePerGas": 10 ** 9,
+                       "chainId": 11155111, "to": "0x" + "22" * 20, "value": 10 ** 18,
+                       "data": HexBytes("0xa9059cbb" + "00" * 64)}
+        expected = Account.sign_transaction(transaction, PRIVATE_KEY).rawTransaction
+        self.assertEqual(self.client.sign_transaction("key:1", transaction), bytes(expected))
+
+        transaction["data"] = bytes(transaction["data"])
+        self.assertEqual(self.client.sign_transaction("key:1", transaction), bytes(expected))
+
+    def test_log_path(self):
+        self.assertEqual(get_agent_log_path(self.socket_path), Path(self.tmp_dir).joinpath("agent.log"))
+
+    def test_stop(self):
+        self.client.stop()
+        self.thread.join()
+        self.assertFalse(self.socket_path.exists())
+        self.assertFalse(self.client.is_running())
+
+
+if __name__ == "__main__":
+    unittest.main()
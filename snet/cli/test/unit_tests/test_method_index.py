@@ -0,0 +1,93 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from google.protobuf import empty_pb2
+
+from snet.cli.utils.proto_utils import build_method_index, save_method_index, load_method_index, \
+    find_method_in_index, import_protobuf_from_index, build_serialized_request
+from snet.cli.utils.utils import compile_proto
+
+SERVICE_SPEC_DIR = Path(__file__).absolute().parent.parent.joinpath("functional_tests", "service_spec1")
+
+NESTED_PROTO = """
+syntax = "proto3";
+
+import "google/protobuf/empty.proto";
+
+message Outer {
+  message Inner {
+    int32 x = 1;
+  }
+}
+
+service NestedService {
+  rpc call(Outer.Inner) returns (google.protobuf.Empty);
+}
+"""
+
+
+class TestMethodIndex(unittest.TestCase):
+    def setUp(self):
+        self.codegen_dir = Path(tempfile.mkdtemp())
+        self.assertTrue(compile_proto(SERVICE_SPEC_DIR, self.codegen_dir, proto_file="ExampleService.proto"))
+
+    def tearDown(self):
+        shutil.rmtree(self.codegen_dir)
+
+    def test_build_index(self):
+        index = build_method_index(self.codegen_dir)
+        entry = index["methods"]["ExampleService.classify"]
+        self.assertEqual(entry["module"], "ExampleService")
+        self.assertEqual(entry["stub"], "ExampleServiceStub")
+        self.assertEqual(entry["request_type"], "ClassifyRequest")
+        self.assertEqual(entry["response_type"], "ClassifyResponse")
+        self.assertEqual(entry["streaming"], "unary")
+        self.assertEqual(entry["package"], "")
+
+    def test_save_and_import(self):
+        self.assertIsNone(load_method_index(self.codegen_dir))
+        save_method_index(self.codegen_dir, build_method_index(self.codegen_dir))
+        index = load_method_index(self.codegen_dir)
+
+        entry = find_method_in_index(index, "classify", "ExampleService")
+        stub_class, request_class, response_class = import_protobuf_from_index(self.codegen_dir, entry)
+        self.assertEqual(stub_class.__name__, "ExampleServiceStub")
+        self.assertEqual(request_class.DESCRIPTOR.name, "ClassifyRequest")
+        self.assertEqual(response_class.DESCRIPTOR.name, "ClassifyResponse")
+
+        with self.assertRaises(Exception):
+            find_method_in_index(index, "unknown_method")
+        with self.assertRaises(Exception):
+            find_method_in_index(index, "classify", "UnknownService")
+
+    def test_nested_and_imported_types(self):
+        proto_dir = Path(tempfile.mkdtemp())
+        try:
+            proto_dir.joinpath("NestedService.proto").write_text(NESTED_PROTO)
+            self.assertTrue(compile_proto(proto_dir, self.codegen_dir, proto_file="NestedService.proto"))
+            index = build_method_index(self.codegen_dir)
+            _, request_class, response_class = import_protobuf_from_index(
+                self.codegen_dir, index["methods"]["NestedService.call"])
+            import NestedService_pb2
+            self.assertIs(request_class, NestedService_pb2.Outer.Inner)
+            self.assertIs(response_class, empty_pb2.Empty)
+        finally:
+            shutil.rmtree(proto_dir)
+
+    def test_build_serialized_request(self):
+        index = build_method_index(self.codegen_dir)
+        _, _, response_class = import_protobuf_from_index(self.codegen_dir, index["methods"]["ExampleService.classify"])
+
+        # we use ClassifyResponse because it has bytes field
+        params = {"predictions": ["cat", "dog"], "binary_field": memoryview(b"\x00binary" * 100)}
+        serialized = build_serialized_request(response_class, params)
+        expected = response_class(predictions=["cat", "dog"], binary_field=b"\x00binary" * 100)
+        self.assertEqual(response_class.FromString(serialized), expected)
+
+        self.assertEqual(build_serialized_request(response_class, {"binary_field": bytearray()}), b"")
+
+
+if __name__ == '__main__':
+    unittest.main()
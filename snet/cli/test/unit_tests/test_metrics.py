@@ -0,0 +1,49 @@
+import threading
+import unittest
+import urllib.request
+
+from snet.cli.utils.metrics import Metrics, start_metrics_server
+
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics(self):
+        metrics = Metrics("snet_test")
+        metrics.inc("iterations_total")
+        metrics.inc("iterations_total")
+        metrics.inc("claimed_cogs_total", 15)
+        metrics.set("unclaimed_channels", 3)
+        metrics.set("unclaimed_channels", 2)
+        self.assertEqual(metrics.to_dict(), {"iterations_total": 2, "claimed_cogs_total": 15, "unclaimed_channels": 2})
+
+    def test_concurrent_inc(self):
+        metrics = Metrics("snet_test")
+        threads = [threading.Thread(target=lambda: [metrics.inc("requests_total") for _ in range(1000)])
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(metrics.to_dict(), {"requests_total": 4000})
+
+    def test_prometheus_text(self):
+        metrics = Metrics("snet_test")
+        self.assertEqual(metrics.to_prometheus_text(), "")
+        metrics.set("unclaimed_channels", 2)
+        metrics.inc("claimed_cogs_total", 15)
+        # one "<prefix>_<name> <value>" line per metric, sorted by name
+        expected = "snet_test_claimed_cogs_total 15\nsnet_test_unclaimed_channels 2\n"
+        self.assertEqual(metrics.to_prometheus_text(), expected)
+
+        server = start_metrics_server(metrics, 0)
+        try:
+            url = "http://127.0.0.1:%i/metrics" % server.server_address[1]
+            with urllib.request.urlopen(url) as response:
+                self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+                self.assertEqual(response.read().decode("utf-8"), expected)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import io
+import unittest
+
+from snet.cli.commands.commands import BlockchainCommand
+from snet.cli.utils.nonce_manager import NonceManager, is_nonce_error
+
+
+class _Eth(object):
+    def __init__(self, pending_count):
+        self.pending_count = pending_count
+        self.requests = 0
+
+    def get_transaction_count(self, address, block_identifier):
+        self.requests += 1
+        return self.pending_count
+
+
+class _W3(object):
+    def __init__(self, pending_count):
+        self.eth = _Eth(pending_count)
+
+
+class _Ident(object):
+    def get_address(self):
+        return "0x0"
+
+
+class _BlockchainCommand(BlockchainCommand):
+    """ Transactions are "sent" to the fake node, which rejects nonces below its pending transaction count """
+
+    def __init__(self, w3):
+        super().__init__(None, None, out_f=io.StringIO(), err_f=io.StringIO(), w3=w3, ident=_Ident())
+        self.sent = []
+
+    def check_ident(self):
+        pass
+
+    def send_contract_command(self, contract_name, contract_fn, contract_params, is_silent=False):
+        nonce_manager = self.get_nonce_manager()
+        nonce = nonce_manager.next_nonce()
+        if nonce < self.w3.eth.pending_count:
+            nonce_manager.release(nonce)
+            raise ValueError({"code": -32000, "message": "nonce too low"})
+        self.w3.eth.pending_count += 1
+        self.sent.append((contract_fn, nonce))
+        return contract_fn
+
+    def wait_for_contract_commands(self, sent):
+        return [({"status": 1}, []) for _ in sent]
+
+
+class TestNonceManager(unittest.TestCase):
+    def test_consecutive_nonces(self):
+        w3 = _W3(5)
+        nonce_manager = NonceManager(w3, "0x0")
+        self.assertEqual([nonce_manager.next_nonce() for _ in range(3)], [5, 6, 7])
+        self.assertEqual(w3.eth.requests, 1)
+
+    def test_release(self):
+        w3 = _W3(5)
+        nonce_manager = NonceManager(w3, "0x0")
+        nonce_manager.next_nonce()
+        # the last nonce is simply reused
+        nonce_manager.release(nonce_manager.next_nonce())
+        self.assertEqual(nonce_manager.next_nonce(), 6)
+        self.assertEqual(w3.eth.requests, 1)
+
+        # the gap: the next nonce is taken from the node again
+        nonce_manager.next_nonce()
+        w3.eth.pending_count = 6
+        nonce_manager.release(6)
+        self.assertEqual(nonce_manager.next_nonce(), 6)
+        self.assertEqual(w3.eth.requests, 2)
+
+    def test_resync(self):
+        w3 = _W3(5)
+        nonce_manager = NonceManager(w3, "0x0")
+        nonce_manager.next_nonce()
+        w3.eth.pending_count = 9
+        nonce_manager.resync()
+        self.assertEqual(nonce_manager.next_nonce(), 9)
+
+    def test_is_nonce_error(self):
+        self.assertTrue(is_nonce_error(ValueError({"code": -32000, "message": "nonce too low"})))
+        self.assertTrue(is_nonce_error(ValueError("Replacement transaction underpriced")))
+        self.assertFalse(is_nonce_error(ValueError("execution reverted")))
+
+    def test_transact_resyncs_stale_nonce(self):
+        w3 = _W3(5)
+        command = _BlockchainCommand(w3)
+        command.send_contract_command("MultiPartyEscrow", "deposit", [])
+        # another transaction has been sent from the same address by somebody else
+        w3.eth.pending_count += 1
+        results = command.transact_contract_commands([("MultiPartyEscrow", "channelClaim", []),
+                                                      ("MultiPartyEscrow", "channelClaim", [])])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(command.sent, [("deposit", 5), ("channelClaim", 7), ("channelClaim", 8)])
+
+    def test_transact_raises_other_errors(self):
+        class _FailingCommand(_BlockchainCommand):
+            def send_contract_command(self, contract_name, contract_fn, contract_params, is_silent=False):
+                raise ValueError("execution reverted")
+
+        with self.assertRaisesRegex(ValueError, "execution reverted"):
+            _FailingCommand(_W3(5)).transact_contract_commands([("MultiPartyEscrow", "deposit", [])])
+
+
+if __name__ == "__main__":
+    unittest.main()
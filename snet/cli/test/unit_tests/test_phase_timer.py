@@ -0,0 +1,34 @@
+import unittest
+
+from snet.cli.utils.phase_timer import PhaseTimer
+
+
+class TestPhaseTimer(unittest.TestCase):
+    def test_nested_and_repeated_phases(self):
+        timer = PhaseTimer()
+        with timer.phase("payment"):
+            with timer.phase("sign"):
+                pass
+        with timer.phase("rpc"):
+            pass
+        with timer.phase("rpc"):
+            pass
+
+        rez = timer.to_dict()
+        self.assertEqual([p["phase"] for p in rez["phases"]], ["payment", "payment/sign", "rpc"])
+        self.assertEqual([p["count"] for p in rez["phases"]], [1, 1, 2])
+        phases = {p["phase"]: p["ms"] for p in rez["phases"]}
+        self.assertGreaterEqual(phases["payment"], phases["payment/sign"])
+        self.assertGreaterEqual(rez["total_ms"], phases["payment"] + phases["rpc"])
+        self.assertIn("sign", timer.format_report())
+
+    def test_phase_is_measured_on_exception(self):
+        timer = PhaseTimer()
+        with self.assertRaises(ValueError):
+            with timer.phase("rpc"):
+                raise ValueError()
+        self.assertEqual(timer.to_dict()["phases"][0]["count"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
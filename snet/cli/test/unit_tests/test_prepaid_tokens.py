@@ -0,0 +1,150 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent import futures
+from types import SimpleNamespace
+from unittest import mock
+
+import grpc
+from web3 import Web3
+
+from snet.cli.commands.mpe_client import MPEClientCommand
+from snet.cli.utils.daemon_stubs import get_daemon_stub_classes
+from snet.cli.utils.utils import DefaultAttributeObject, file_lock
+
+CHANNEL_ID = 7
+PRICE = 10
+CHANNEL_VALUE = 1000
+
+
+class _FakeTokenService(object):
+    """ TokenService of the daemon: a new token is issued each time the signed amount grows """
+
+    def __init__(self):
+        self.signed_amount = 0
+        self.used_amount = 0
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def GetToken(self, request, context):
+        _, _, response_class = get_daemon_stub_classes("GetToken")
+        with self.lock:
+            self.requests.append(request.signed_amount)
+            self.signed_amount = max(self.signed_amount, request.signed_amount)
+            return response_class(channel_id=request.channel_id, token="token-%i" % self.signed_amount,
+                                  planned_amount=self.signed_amount, used_amount=self.used_amount)
+
+    def use(self, token):
+        """ Paid call with the token, return False if the daemon rejects it (UNAUTHENTICATED) """
+        with self.lock:
+            if token != "token-%i" % self.signed_amount or self.used_amount + PRICE > self.signed_amount:
+                return False
+            self.used_amount += PRICE
+            return True
+
+
+class _Ident(object):
+    w3 = SimpleNamespace(eth=SimpleNamespace(block_number=100))
+
+    def sign_message_after_solidity_keccak(self, message):
+        return bytes(65)
+
+
+class _ClientCommand(MPEClientCommand):
+    def __init__(self, token_service):
+        super().__init__(None, DefaultAttributeObject(), out_f=io.StringIO(), err_f=io.StringIO(),
+                         w3=Web3(), ident=_Ident())
+        self.token_service = token_service
+
+    def get_mpe_address(self):
+        return "0x" + "00" * 20
+
+    def _get_channel_state_statelessly(self, grpc_channel, channel_id):
+        signed_amount = self.token_service.signed_amount
+        return 0, signed_amount, CHANNEL_VALUE - signed_amount
+
+
+class TestPrepaidTokens(unittest.TestCase):
+    def setUp(self):
+        self.home_dir = tempfile.mkdtemp()
+        self.home_patch = mock.patch.dict(os.environ, {"HOME": self.home_dir})
+        self.home_patch.start()
+
+        self.token_service = _FakeTokenService()
+        stub_class, _, _ = get_daemon_stub_classes("GetToken")
+        pb2_grpc = __import__(stub_class.__module__)
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        pb2_grpc.add_TokenServiceServicer_to_server(self.token_service, self.server)
+        port = self.server.add_insecure_port("localhost:0")
+        self.server.start()
+        self.grpc_channel = grpc.insecure_channel("localhost:%i" % port)
+        self.command = _ClientCommand(self.token_service)
+
+    def tearDown(self):
+        self.grpc_channel.close()
+        self.server.stop(None)
+        self.home_patch.stop()
+        shutil.rmtree(self.home_dir)
+
+    def _get_token(self, prepaid_calls=3, rejected_token=None):
+        token, metadata = self.command._get_prepaid_payment_metadata(self.grpc_channel, CHANNEL_ID, PRICE,
+                                                                     prepaid_calls, rejected_token)
+        self.assertEqual(dict(metadata)["snet-prepaid-auth-token-bin"], token.encode("utf-8"))
+        return token
+
+    def test_reuse_and_renewal(self):
+        tokens = []
+        for _ in range(4):
+            tokens.append(self._get_token())
+            self.assertTrue(self.token_service.use(tokens[-1]))
+        # the token for 3 calls is used up, so we renew it for the next 3 calls
+        self.assertEqual(tokens, ["token-30"] * 3 + ["token-60"])
+        # before signing more we check if the last signed amount is still unused (it is not)
+        self.assertEqual(self.token_service.requests, [30, 30, 60])
+
+        # the token is cached between processes
+        self.assertEqual(_ClientCommand(self.token_service)._read_prepaid_tokens()[CHANNEL_ID]["used_amount"], 40)
+
+    def test_renewal_of_rejected_token(self):
+        token = self._get_token()
+        # the token was used up by another process, so we ask the daemon how much is left
+        self.token_service.used_amount = 30
+        self.assertEqual(self._get_token(rejected_token=token), "token-60")
+        self.assertEqual(self.token_service.requests, [30, 30, 60])
+
+        # the last signed amount is not used up yet (it was signed by another process)
+        self.token_service.used_amount = 40
+        self.assertEqual(self._get_token(rejected_token="token-60"), "token-60")
+        self.assertEqual(self.token_service.requests, [30, 30, 60, 60])
+
+    def test_not_enough_funds(self):
+        self.token_service.signed_amount = self.token_service.used_amount = CHANNEL_VALUE - PRICE // 2
+        with self.assertRaises(Exception):
+            self._get_token()
+
+    def test_concurrent_calls(self):
+        def call():
+            # as in _call_server_prepaid: the token could be used up by the calls in flight, so we renew it
+            token = self._get_token(prepaid_calls=5)
+            while not self.token_service.use(token):
+                token = self._get_token(prepaid_calls=5, rejected_token=token)
+
+        with futures.ThreadPoolExecutor(max_workers=8) as executor:
+            for f in [executor.submit(call) for _ in range(20)]:
+                f.result()
+        self.assertEqual(self.token_service.used_amount, 20 * PRICE)
+        # the daemon never accepts more than was signed, and we don't sign much more than was used
+        self.assertLessEqual(self.token_service.signed_amount, 25 * PRICE)
+
+    def test_separate_lock(self):
+        # prepaid tokens don't wait for the lock of the escrow ledger
+        with file_lock(self.command._get_channel_ledger_file().with_suffix(".lock")):
+            with futures.ThreadPoolExecutor(max_workers=1) as executor:
+                self.assertEqual(executor.submit(self._get_token).result(timeout=10), "token-30")
+
+
+if __name__ == "__main__":
+    unittest.main()
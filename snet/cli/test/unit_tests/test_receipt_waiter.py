@@ -0,0 +1,62 @@
+import unittest
+
+from snet.cli.utils.receipt_waiter import DEFAULT_RECEIPT_TIMEOUT, ReceiptWaiter
+
+
+class _Eth(object):
+    """ Every call of block_number mines a new block, transaction i is mined in block i """
+
+    def __init__(self, mined):
+        self._block_number = 0
+        self.mined = mined
+        self.receipt_requests = 0
+
+    @property
+    def block_number(self):
+        self._block_number += 1
+        return self._block_number
+
+    def filter(self, _):
+        raise ValueError("filters are not supported")
+
+    def get_transaction_receipt(self, txn_hash):
+        self.receipt_requests += 1
+        if txn_hash in self.mined and self.mined[txn_hash] <= self._block_number:
+            return {"blockHash": b"\1", "blockNumber": self.mined[txn_hash], "transactionHash": txn_hash}
+        return None
+
+
+class _W3(object):
+    def __init__(self, mined):
+        self.eth = _Eth(mined)
+
+    @staticmethod
+    def to_hex(value):
+        return str(value)
+
+
+class TestReceiptWaiter(unittest.TestCase):
+    def test_wait(self):
+        w3 = _W3({"a": 3, "b": 1})
+        missing = []
+        receipts = ReceiptWaiter(w3, poll_interval=0).wait(["a", "b"], on_missing=missing.append)
+        self.assertEqual([r["transactionHash"] for r in receipts], ["a", "b"])
+        self.assertEqual(missing, ["a", "a"])
+
+    def test_confirmations(self):
+        w3 = _W3({"a": 1})
+        receipt, = ReceiptWaiter(w3, confirmations=2, poll_interval=0).wait(["a"])
+        self.assertEqual(receipt["blockNumber"], 1)
+        self.assertGreaterEqual(w3.eth._block_number, 3)
+
+    def test_timeout(self):
+        w3 = _W3({})
+        with self.assertRaises(Exception):
+            ReceiptWaiter(w3, timeout=0.05, poll_interval=0.01).wait(["a"])
+        # waiting is bounded unless None is given explicitly
+        self.assertEqual(ReceiptWaiter(w3).timeout, DEFAULT_RECEIPT_TIMEOUT)
+        self.assertIsNone(ReceiptWaiter(w3, timeout=None).timeout)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import grpc
+from eth_utils import event_abi_to_log_topic
+from web3 import Web3
+from snet.contracts import get_contract_def
+
+from snet.cli.commands.mpe_client import MPEClientCommand
+from snet.cli.utils.utils import DefaultAttributeObject, abi_get_element_by_name, type_converter
+
+ORG_ID = "test_org"
+SERVICE_ID = "test_service"
+
+
+class _RpcError(grpc.RpcError):
+    def __init__(self, code, details):
+        self._code = code
+        self._details = details
+
+    def code(self):
+        return self._code
+
+    def details(self):
+        return self._details
+
+
+def _make_log(event_name, block_number, service_id=None):
+    topics = [event_abi_to_log_topic(abi_get_element_by_name(get_contract_def("Registry"), event_name)),
+              type_converter("bytes32")(ORG_ID)]
+    if service_id is not None:
+        topics.append(type_converter("bytes32")(service_id))
+    return {"blockNumber": block_number, "topics": topics}
+
+
+class _Eth(object):
+    """ Fake eth module: block number and logs of Registry """
+
+    def __init__(self):
+        self.block_number = 1000
+        self.logs = []
+        self.filters = []
+
+    def get_logs(self, log_filter):
+        self.filters.append((log_filter["fromBlock"], log_filter["toBlock"]))
+        return [log for log in self.logs if log_filter["fromBlock"] <= log["blockNumber"] <= log_filter["toBlock"]]
+
+
+class _ClientCommand(MPEClientCommand):
+    """ Registrations are counted instead of being read from Registry """
+
+    def __init__(self, **kwargs):
+        args = DefaultAttributeObject(**dict({"org_id": ORG_ID, "service_id": SERVICE_ID, "group_name": "default_group",
+                                              "registry_check_interval": 0, "yes": True}, **kwargs))
+        self.eth = _Eth()
+        super().__init__(None, args, out_f=io.StringIO(), err_f=io.StringIO(), w3=Web3(),
+                         ident=SimpleNamespace(w3=SimpleNamespace(eth=self.eth)))
+        self.n_org_reads = 0
+        self.n_service_reads = 0
+        self.price = 10
+
+    def get_mpe_address(self):
+        return "0x" + "00" * 20
+
+    def get_registry_address(self):
+        return "0x" + "11" * 20
+
+    def is_service_initialized(self):
+        return True
+
+    def _init_or_update_registered_org_if_needed(self):
+        self.n_org_reads += 1
+
+    def _init_or_update_registered_service_if_needed(self):
+        self.n_service_reads += 1
+
+    def _get_service_metadata(self):
+        return {}
+
+    def _get_price_from_metadata(self, service_metadata, group_name):
+        return self.price
+
+
+class TestRegistryCheck(unittest.TestCase):
+    def setUp(self):
+        self.home_dir = tempfile.mkdtemp()
+        self.home_patch = mock.patch.dict(os.environ, {"HOME": self.home_dir})
+        self.home_patch.start()
+        self.command = _ClientCommand()
+
+    def tearDown(self):
+        self.home_patch.stop()
+        shutil.rmtree(self.home_dir)
+
+    def _check(self, check_interval=0):
+        self.command._init_or_update_registered_org_and_service_from_events(check_interval)
+        return self.command.n_org_reads, self.command.n_service_reads
+
+    def test_get_registry_events(self):
+        eth = self.command.eth
+        eth.logs = [_make_log("OrganizationModified", 10),
+                    _make_log("ServiceMetadataModified", 6000, SERVICE_ID),
+                    _make_log("ServiceDeleted", 12000, "another_service")]
+        events = self.command._get_registry_events(ORG_ID, 1, 12000)
+        self.assertEqual(events, [("OrganizationModified", None), ("ServiceMetadataModified", SERVICE_ID),
+                                  ("ServiceDeleted", "another_service")])
+        # logs are requested in batches of blocks
+        self.assertEqual(eth.filters, [(1, 5001), (5002, 10002), (10003, 12000)])
+
+    def test_checkpoint(self):
+        eth = self.command.eth
+        # without checkpoint we read both registrations directly
+        self.assertEqual(self._check(), (1, 1))
+        self.assertEqual(self.command._read_registry_checkpoint()["block_number"], 1000)
+
+        # the checkpoint is fresh, so we don't even ask for the block number
+        eth.block_number = 1010
+        eth.logs = [_make_log("OrganizationModified", 1005)]
+        self.assertEqual(self._check(check_interval=3600), (1, 1))
+        self.assertEqual(eth.filters, [])
+
+        # events of other services don't cause reads of our service registration
+        eth.logs.append(_make_log("ServiceMetadataModified", 1006, "another_service"))
+        self.assertEqual(self._check(), (2, 1))
+        self.assertEqual(eth.filters, [(1001, 1010)])
+        self.assertEqual(self.command._read_registry_checkpoint()["block_number"], 1010)
+
+        eth.block_number = 1020
+        eth.logs.append(_make_log("ServiceDeleted", 1015, SERVICE_ID))
+        self.assertEqual(self._check(), (2, 2))
+
+        # no new blocks, no requests
+        self.assertEqual(self._check(), (2, 2))
+        self.assertEqual(eth.filters, [(1001, 1010), (1011, 1020)])
+
+    def test_corrupted_checkpoint(self):
+        self._check()
+        with open(self.command._get_registry_checkpoint_file(ORG_ID, SERVICE_ID), "wb") as f:
+            f.write(b"corrupted")
+        self.assertIsNone(self.command._read_registry_checkpoint())
+        self.assertEqual(self._check(check_interval=3600), (2, 2))
+
+    def test_price_rejection(self):
+        self.assertTrue(self.command._is_price_rejection(
+            _RpcError(grpc.StatusCode.UNAUTHENTICATED, "income 10 does not equal to price 20")))
+        self.assertFalse(self.command._is_price_rejection(
+            _RpcError(grpc.StatusCode.UNAUTHENTICATED, "incorrect payment amount")))
+        self.assertFalse(self.command._is_price_rejection(_RpcError(grpc.StatusCode.INTERNAL, "price")))
+
+        self._check(check_interval=3600)
+        self.command.eth.block_number = 1010
+        self.command.price = 20
+        # the price rejection forces reading of registrations even if the checkpoint is fresh
+        self.assertEqual(self.command._update_price_after_rejection(10), 20)
+        self.assertEqual((self.command.n_org_reads, self.command.n_service_reads), (2, 2))
+        self.assertEqual(self.command._read_registry_checkpoint()["block_number"], 1010)
+        self.assertIn("has been changed", self.command.err_f.getvalue())
+
+    def test_price_rejection_in_escrow_call(self):
+        daemon_price = 20
+        signed_amount = 100
+        amounts = []
+
+        def call_server(grpc_channel, channel_id, nonce, amount, params, service_metadata):
+            amounts.append(amount)
+            if amount - signed_amount != daemon_price:
+                raise _RpcError(grpc.StatusCode.UNAUTHENTICATED,
+                                "income %i does not equal to price %i" % (amount - signed_amount, daemon_price))
+            return "response"
+
+        self.command._call_server_via_grpc_channel = call_server
+        self.command._get_channel_state_from_server = lambda grpc_channel, channel_id: {
+            "current_nonce": 0, "current_signed_amount": signed_amount}
+        self.command.price = daemon_price
+        self.assertEqual(self.command._call_server_escrow(None, 7, 10, {}, {}), "response")
+        # the retry is based on the state from the daemon and the price from the updated metadata
+        self.assertEqual(amounts, [110, 120])
+
+
+if __name__ == "__main__":
+    unittest.main()
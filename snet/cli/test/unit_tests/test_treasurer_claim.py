@@ -0,0 +1,106 @@
+import io
+import unittest
+
+from web3 import Web3
+
+from snet.cli.commands.mpe_treasurer import MPETreasurerCommand
+from snet.cli.utils.utils import DefaultAttributeObject
+
+
+def _payment(channel_id):
+    return {"channel_id": channel_id, "amount": 100 + channel_id, "signature": b"\x00" * 64 + b"\x1b"}
+
+
+class _TreasurerCommand(MPETreasurerCommand):
+    """
+    Fake blockchain: multiChannelClaim is rejected at gas estimation if the batch is larger than max_batch,
+    transactions with one of bad_channels in them are mined with status 0
+    """
+
+    def __init__(self, claim_batch_size, max_batch=None, bad_channels=()):
+        args = DefaultAttributeObject(claim_batch_size=claim_batch_size)
+        super().__init__(None, args, out_f=io.StringIO(), err_f=io.StringIO(), w3=Web3(), ident=object())
+        self.max_batch = max_batch
+        self.bad_channels = set(bad_channels)
+        self.sent = []
+
+    def send_contract_command(self, contract_name, contract_fn, contract_params, is_silent=False):
+        channels = contract_params[0] if contract_fn == "multiChannelClaim" else [contract_params[0]]
+        if self.max_batch is not None and len(channels) > self.max_batch:
+            raise ValueError("out of gas")
+        self.sent.append((contract_fn, channels))
+        return channels
+
+    def wait_for_contract_commands(self, sent):
+        return [({"status": 0 if self.bad_channels.intersection(channels) else 1}, []) for channels in sent]
+
+
+class TestBlockchainClaim(unittest.TestCase):
+    def test_batches(self):
+        command = _TreasurerCommand(claim_batch_size=2)
+        batches = []
+        claimed = command._blockchain_claim([_payment(i) for i in range(5)], batches.append)
+        self.assertEqual([p["channel_id"] for p in claimed], [0, 1, 2, 3, 4])
+        self.assertEqual([[p["channel_id"] for p in b] for b in batches], [[0, 1], [2, 3], [4]])
+        self.assertEqual(command.sent, [("multiChannelClaim", [0, 1]), ("multiChannelClaim", [2, 3]),
+                                        ("channelClaim", [4])])
+
+    def test_split_batch_after_failed_gas_estimation(self):
+        command = _TreasurerCommand(claim_batch_size=5, max_batch=2)
+        claimed = command._blockchain_claim([_payment(i) for i in range(5)])
+        self.assertEqual(sorted(p["channel_id"] for p in claimed), [0, 1, 2, 3, 4])
+        # 5 -> 2 + 3 -> 2 + (1 + 2)
+        self.assertEqual(command.sent, [("multiChannelClaim", [0, 1]), ("channelClaim", [2]),
+                                        ("multiChannelClaim", [3, 4])])
+        self.assertIn("Splitting the batch into 2 and 3 channels", command.err_f.getvalue())
+        self.assertIn("Splitting the batch into 1 and 2 channels", command.err_f.getvalue())
+
+    def test_split_failed_transaction_down_to_bad_channel(self):
+        command = _TreasurerCommand(claim_batch_size=4, bad_channels=[3])
+        batches = []
+        with self.assertRaisesRegex(Exception, "Cannot claim channels: 3$"):
+            command._blockchain_claim([_payment(i) for i in range(1, 6)], batches.append)
+        self.assertEqual(command.sent, [("multiChannelClaim", [1, 2, 3, 4]), ("channelClaim", [5]),
+                                        ("multiChannelClaim", [1, 2]), ("multiChannelClaim", [3, 4]),
+                                        ("channelClaim", [3]), ("channelClaim", [4])])
+        # every channel except the bad one has been claimed exactly once
+        self.assertEqual(sorted(p["channel_id"] for b in batches for p in b), [1, 2, 4, 5])
+
+
+class _StartClaimCommand(MPETreasurerCommand):
+    def __init__(self, unclaimed, blockchain_nonces):
+        super().__init__(None, DefaultAttributeObject(), out_f=io.StringIO(), err_f=io.StringIO(), w3=Web3(),
+                         ident=object())
+        self.unclaimed = unclaimed
+        self.blockchain_nonces = blockchain_nonces
+        self.blockchain_requests = []
+
+    def _get_payments_from_daemons(self, grpc_channels, method):
+        return self.unclaimed
+
+    def _get_channel_state_from_blockchain(self, channel_id):
+        self.blockchain_requests.append(channel_id)
+        return {"nonce": self.blockchain_nonces[channel_id]}
+
+    def _start_claims_on_daemons(self, grpc_channels, to_claim):
+        return to_claim
+
+
+class TestStartClaimChannels(unittest.TestCase):
+    def test_start_claim_channels(self):
+        unclaimed = [{"channel_id": 1, "nonce": 0, "amount": 10, "endpoint": "a"},
+                     {"channel_id": 2, "nonce": 3, "amount": 10, "endpoint": "b"},
+                     {"channel_id": 3, "nonce": 0, "amount": 0, "endpoint": "a"},
+                     {"channel_id": 4, "nonce": 1, "amount": 10, "endpoint": "b"}]
+        command = _StartClaimCommand(unclaimed, {1: 0, 2: 3, 4: 2})
+        to_claim = command._start_claim_channels({}, [1, 2, 3, 4, 5])
+        self.assertEqual(to_claim, [("a", 1, 0), ("b", 2, 3)])
+        # only channels with unclaimed amount are read from blockchain
+        self.assertEqual(sorted(command.blockchain_requests), [1, 2, 4])
+        self.assertIn("nothing to claim for channel 3", command.out_f.getvalue())
+        self.assertIn("nothing to claim for channel 5", command.out_f.getvalue())
+        self.assertIn("Old payment for channel 4 is still in progress", command.out_f.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Compare the old (message based) and the new (direct) JSON payload encoding for services with "encoding": "json".
+
+    python snet/cli/test/utils/benchmark_json_encoding.py [--repeat N]
+
+For several payload sizes we measure serialization of the request from call params
+and deserialization of the response (with conversion to dict, as for --output-format json).
+"""
+import argparse
+import base64
+import json
+import shutil
+import tempfile
+import timeit
+from pathlib import Path
+
+from google.protobuf import json_format
+
+from snet.cli.utils.call_output import response_to_dict
+from snet.cli.utils.proto_utils import build_method_index, import_protobuf_from_index, build_json_request, \
+    LazyJsonMessage
+from snet.cli.utils.utils import compile_proto
+
+SERVICE_SPEC_DIR = Path(__file__).absolute().parent.parent.joinpath("functional_tests", "service_spec1")
+PAYLOAD_SIZES = [100, 10 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+
+
+def old_serialize(request_class, params):
+    return bytes(json_format.MessageToJson(request_class(**params), True, preserving_proto_field_name=True), "utf-8")
+
+
+def old_deserialize_to_dict(response_class, data):
+    response = response_class()
+    json_format.Parse(data, response, True)
+    return json_format.MessageToDict(response, preserving_proto_field_name=True)
+
+
+def new_deserialize_to_dict(response_class, data):
+    return response_to_dict(LazyJsonMessage(data, response_class))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Number of repetitions for each measurement")
+    args = parser.parse_args()
+
+    codegen_dir = Path(tempfile.mkdtemp())
+    try:
+        compile_proto(SERVICE_SPEC_DIR, codegen_dir, proto_file="ExampleService.proto")
+        index = build_method_index(codegen_dir)
+        _, request_class, response_class = import_protobuf_from_index(codegen_dir,
+                                                                      index["methods"]["ExampleService.classify"])
+
+        print("%12s %16s %16s %16s %16s" % ("size", "old request ms", "new request ms",
+                                            "old response ms", "new response ms"))
+        for size in PAYLOAD_SIZES:
+            params = {"image_type": "jpg", "image": "x" * size}
+            response_data = json.dumps({"predictions": ["cat"] * (size // 100 + 1),
+                                        "confidences": [0.5] * (size // 100 + 1),
+                                        "binary_field": base64.b64encode(b"\0" * size).decode("ascii")})
+            assert json.loads(old_serialize(request_class, params)) == json.loads(build_json_request(request_class, params))
+
+            def measure(fn):
+                return min(timeit.repeat(fn, number=1, repeat=args.repeat)) * 1000
+
+            print("%12i %16.3f %16.3f %16.3f %16.3f" % (
+                size,
+                measure(lambda: old_serialize(request_class, params)),
+                measure(lambda: build_json_request(request_class, params)),
+                measure(lambda: old_deserialize_to_dict(response_class, response_data)),
+                measure(lambda: new_deserialize_to_dict(response_class, response_data))))
+    finally:
+        shutil.rmtree(codegen_dir)
+
+
+if __name__ == "__main__":
+    main()
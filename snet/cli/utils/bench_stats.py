@@ -0,0 +1,90 @@
+""" Benchmark loop and statistics of its results (see snet client bench) """
+import bisect
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from snet.cli.utils.utils import percentile
+
+
+def run_bench_requests(send_fn, n_requests, concurrency, rate=None):
+    """
+    Call send_fn() n_requests times in concurrency threads. send_fn returns error (None for successful requests).
+    Return (results, elapsed) for summarize_bench_results.
+        - closed loop (rate is None): each thread sends the next request when its previous request is finished,
+          latency is the duration of send_fn
+        - open loop: requests are scheduled at the given rate even if the previous ones are not finished,
+          latency is measured from the scheduled time, so it includes waiting for a free thread
+    """
+    def timed_send(scheduled_at):
+        started_at = time.monotonic() if scheduled_at is None else scheduled_at
+        error = send_fn()
+        return time.monotonic() - started_at, error
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for i in range(n_requests):
+            scheduled_at = None
+            if rate:
+                scheduled_at = started_at + i / rate
+                delay = scheduled_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(timed_send, scheduled_at))
+        results = [f.result() for f in futures]
+    return results, time.monotonic() - started_at
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def summarize_bench_results(results, elapsed):
+    """
+    results is the list of (latency_in_seconds, error), where error is None for successful requests
+    and gRPC status name (or exception name) for failed requests.
+    Latency percentiles are calculated only for successful requests.
+    """
+    latencies = [latency for latency, error in results if error is None]
+    errors = Counter(error for _, error in results if error is not None)
+    summary = {"requests": len(results),
+               "successful": len(latencies),
+               "errors": dict(errors),
+               "elapsed_s": round(elapsed, 3),
+               "rps": round(len(results) / elapsed, 2) if elapsed > 0 else None}
+    if latencies:
+        summary["latency_ms"] = {"p50": _ms(percentile(latencies, 50)),
+                                 "p90": _ms(percentile(latencies, 90)),
+                                 "p99": _ms(percentile(latencies, 99)),
+                                 "max": _ms(max(latencies))}
+    return summary
+
+
+def latency_histogram(latencies, n_buckets=10):
+    """
+    Return list of (upper_bound_in_seconds, count) with logarithmic buckets between min and max latency
+    (the last upper bound is max latency)
+    """
+    if not latencies:
+        return []
+    low, high = min(latencies), max(latencies)
+    if low <= 0 or low == high:
+        return [(high, len(latencies))]
+    bounds = [low * (high / low) ** (i / n_buckets) for i in range(1, n_buckets + 1)]
+    bounds[-1] = high
+    counts = [0] * n_buckets
+    for latency in latencies:
+        counts[min(bisect.bisect_left(bounds, latency), n_buckets - 1)] += 1
+    return list(zip(bounds, counts))
+
+
+def format_histogram(histogram, width=40):
+    if not histogram:
+        return ""
+    max_count = max(count for _, count in histogram)
+    lines = []
+    for bound, count in histogram:
+        bar = "#" * (int(round(width * count / max_count)) if max_count else 0)
+        lines.append("<= %10.1f ms %8i %s" % (bound * 1000, count, bar))
+    return "\n".join(lines)
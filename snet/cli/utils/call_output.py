@@ -0,0 +1,78 @@
+""" Output of call responses (stdout, files with responses and files with selected fields) """
+import json
+
+from google.protobuf import json_format
+
+from snet.cli.utils.proto_utils import write_delimited_message, LazyJsonMessage
+from snet.cli.utils.utils import rgetattr
+
+OUTPUT_FORMATS = ["text", "json", "ndjson"]
+
+
+def response_to_dict(response):
+    if isinstance(response, LazyJsonMessage):
+        # response of json encoded service, we don't need to parse it into protobuf message
+        return response.to_dict()
+    return json_format.MessageToDict(response, preserving_proto_field_name=True)
+
+
+class CallOutput(object):
+    """
+    Write responses as they arrive (one response for unary methods and many responses for server streaming methods):
+        - save_response: file with serialized responses (length-delimited in case of the stream)
+        - save_fields: list of (field, file_name), field could be nested (field1.field2).
+                       bytes fields are written to the file as is (concatenated in case of the stream),
+                       other fields are written as text (one value per line in case of the stream)
+        - otherwise responses are printed with print_fn in the output_format:
+                       text (protobuf text format), json (indented) or ndjson (one response per line)
+    """
+
+    def __init__(self, print_fn, output_format="text", save_response=None, save_fields=None, is_stream=False):
+        if output_format not in OUTPUT_FORMATS:
+            raise Exception("Unknown output format: %s. Possible formats: %s" % (output_format, ", ".join(OUTPUT_FORMATS)))
+        self.print_fn = print_fn
+        self.output_format = output_format
+        self.is_stream = is_stream
+        self.response_f = open(save_response, "wb") if save_response else None
+        self.fields = [(field, open(file_name, "wb")) for field, file_name in (save_fields or [])]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.response_f is not None:
+            self.response_f.close()
+        for _, f in self.fields:
+            f.close()
+
+    def write(self, response):
+        if self.response_f is not None:
+            if self.is_stream:
+                write_delimited_message(self.response_f, response)
+            else:
+                self.response_f.write(response.SerializeToString())
+            self.response_f.flush()
+
+        for field, f in self.fields:
+            value = rgetattr(response, field)
+            if type(value) == bytes:
+                f.write(value)
+            else:
+                f.write(str(value).encode("utf-8"))
+                if self.is_stream:
+                    f.write(b"\n")
+            f.flush()
+
+        if self.response_f is None and not self.fields:
+            self._print(response)
+
+    def _print(self, response):
+        if self.output_format == "json":
+            self.print_fn(json.dumps(response_to_dict(response), indent=4))
+        elif self.output_format == "ndjson":
+            self.print_fn(json.dumps(response_to_dict(response)))
+        else:
+            self.print_fn(response)
@@ -0,0 +1,79 @@
+""" Planning of treasurer claims: which channels are worth claiming at the current gas price """
+import math
+from decimal import Decimal
+
+# rough gas usage of multiChannelClaim, it is used only for planning (transactions themselves are estimated by the node)
+CLAIM_TX_BASE_GAS = 35000
+CLAIM_GAS_PER_CHANNEL = 45000
+
+
+def get_claim_gas(n_channels, batch_size):
+    """ Gas of claiming n_channels in multiChannelClaim transactions of at most batch_size channels """
+    return math.ceil(n_channels / batch_size) * CLAIM_TX_BASE_GAS + n_channels * CLAIM_GAS_PER_CHANNEL
+
+
+def make_claim_plan(candidates, gas_price, batch_size, expiration_threshold, gas_budget=None, token_price_in_eth=None):
+    """
+    candidates is the list of dicts with channel_id, amount (in cogs) and blocks_to_expiration.
+    Each channel is charged CLAIM_GAS_PER_CHANNEL plus its share of the base gas of the batch.
+    If token_price_in_eth is given, net value (in wei) is the amount in ETH minus the gas cost, and channels with
+    non-positive net value are skipped (both ASI(FET) and ETH have 18 decimals, so cogs * price is in wei).
+    Channels which expire in less than expiration_threshold blocks go first (the sender could take their amount back
+    after expiration), other channels are ranked by net value (or by amount if there is no token price).
+    Channels are selected in this order while the total gas fits gas_budget.
+    Return the list of candidates (in the ranked order) with gas, gas_cost_wei, net_value_wei, selected and reason
+    """
+    channel_gas = CLAIM_GAS_PER_CHANNEL + math.ceil(CLAIM_TX_BASE_GAS / batch_size)
+    plan = []
+    for c in candidates:
+        p = dict(c, gas=channel_gas, gas_cost_wei=channel_gas * gas_price, net_value_wei=None)
+        if token_price_in_eth is not None:
+            p["net_value_wei"] = int(Decimal(c["amount"]) * Decimal(token_price_in_eth)) - p["gas_cost_wei"]
+        plan.append(p)
+
+    def rank(p):
+        is_expiring = p["blocks_to_expiration"] < expiration_threshold
+        value = p["net_value_wei"] if p["net_value_wei"] is not None else p["amount"]
+        return not is_expiring, -value
+
+    plan.sort(key=rank)
+    n_selected = 0
+    for p in plan:
+        p["selected"] = False
+        if p["net_value_wei"] is not None and p["net_value_wei"] <= 0:
+            p["reason"] = "gas cost exceeds the amount"
+        elif gas_budget is not None and get_claim_gas(n_selected + 1, batch_size) > gas_budget:
+            p["reason"] = "out of gas budget"
+        else:
+            p["selected"] = True
+            p["reason"] = None
+            n_selected += 1
+    return plan
+
+
+def select_channels_to_claim(unclaimed_payments, expirations, get_expirations, current_block, expiration_threshold,
+                             amount_threshold=None):
+    """
+    Select channels for snet treasurer run: channels with unclaimed amount of at least amount_threshold and channels
+    which expire in less than expiration_threshold blocks.
+    expirations is the cache {channel_id: expiration}, it is filled with get_expirations(channels_ids) for unknown
+    channels (expiration could only be extended, so outdated value could only make us claim the channel earlier).
+    Return list of (channel_id, reason), where reason is "amount" or "expiration"
+    """
+    selected = []
+    to_check = []
+    for p in unclaimed_payments:
+        if p["amount"] == 0:
+            continue
+        if amount_threshold is not None and p["amount"] >= amount_threshold:
+            selected.append((p["channel_id"], "amount"))
+        else:
+            to_check.append(p["channel_id"])
+
+    uncached = [channel_id for channel_id in to_check if channel_id not in expirations]
+    if uncached:
+        expirations.update(get_expirations(uncached))
+    for channel_id in to_check:
+        if expirations[channel_id] < current_block + expiration_threshold:
+            selected.append((channel_id, "expiration"))
+    return selected
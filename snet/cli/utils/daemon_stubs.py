@@ -0,0 +1,75 @@
+""" Stubs of the daemon built-in services (payment channel state, prepaid token and provider control services) """
+import functools
+import hashlib
+import sys
+import threading
+from importlib.metadata import PackageNotFoundError
+from pathlib import Path
+
+from snet.cli.utils.proto_utils import import_protobuf_from_file
+from snet.cli.utils.utils import RESOURCES_PATH, compile_proto, get_cli_version
+
+# method -> .proto file of the daemon built-in service
+DAEMON_SERVICE_METHODS = {"GetChannelState": "state_service",
+                          "GetToken": "token_service",
+                          "GetListUnclaimed": "control_service",
+                          "GetListInProgress": "control_service",
+                          "StartClaim": "control_service"}
+
+_import_lock = threading.Lock()
+
+
+def _get_stubs_version(proto_dir, proto_names):
+    try:
+        return get_cli_version()
+    except PackageNotFoundError:
+        # we run from the source tree without installation, so the version is given by the .proto files themselves
+        h = hashlib.sha256()
+        for name in sorted(proto_names):
+            h.update(proto_dir.joinpath("%s.proto" % name).read_bytes())
+        return "dev-%s" % h.hexdigest()[:16]
+
+
+def _get_daemon_stubs_dir():
+    """
+    Stubs are compiled into the package resources at installation (see setup.py).
+    If they are missing (for example, we run from the source tree) we compile them once into the directory
+    of the current snet-cli version (or of the current .proto files), so stubs of different versions don't mix
+    """
+    proto_dir = Path(RESOURCES_PATH.joinpath("proto"))
+    proto_names = set(DAEMON_SERVICE_METHODS.values())
+    if all(proto_dir.joinpath("%s_pb2_grpc.py" % name).is_file() for name in proto_names):
+        return proto_dir
+    codegen_dir = Path.home().joinpath(".snet", "daemon_stubs", _get_stubs_version(proto_dir, proto_names))
+    for name in proto_names:
+        if not codegen_dir.joinpath("%s_pb2_grpc.py" % name).is_file():
+            compile_proto(proto_dir, codegen_dir, proto_file="%s.proto" % name)
+    return codegen_dir
+
+
+@functools.lru_cache(maxsize=None)
+def _get_daemon_stubs_dir_once():
+    stubs_dir = _get_daemon_stubs_dir()
+    # <SERVICE>_pb2_grpc.py imports <SERVICE>_pb2.py, so the directory should be in the path
+    sys.path.append(str(stubs_dir))
+    return stubs_dir
+
+
+@functools.lru_cache(maxsize=None)
+def _get_daemon_stub_classes(method_name):
+    with _import_lock:
+        _get_daemon_stubs_dir_once()
+        is_found, rez = import_protobuf_from_file("%s_pb2_grpc.py" % DAEMON_SERVICE_METHODS[method_name], method_name)
+    if not is_found:
+        raise Exception("Cannot find method %s in the daemon services" % method_name)
+    return rez
+
+
+def get_daemon_stub_classes(method_name):
+    """
+    Return stub_class, request_class, response_class for the method of the daemon built-in service.
+    Protobuf is imported only once per process (without scanning of the directory)
+    """
+    if method_name not in DAEMON_SERVICE_METHODS:
+        raise Exception("Unknown method of the daemon services: %s" % method_name)
+    return _get_daemon_stub_classes(method_name)
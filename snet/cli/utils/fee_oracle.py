@@ -0,0 +1,61 @@
+""" EIP-1559 transaction fees from the fee history of the last blocks """
+
+# percentile of priority fees paid in the last blocks for each urgency
+FEE_URGENCY_PERCENTILES = {"slow": 10, "medium": 50, "fast": 90}
+
+# maxFeePerGas = 2 * base fee + priority fee, so the transaction stays valid even after six full blocks
+# (base fee grows at most by 12.5% per block). We pay only the actual base fee, not maxFeePerGas
+BASE_FEE_MULTIPLIER = 2
+
+
+class FeeOracle(object):
+    """
+    Fee parameters of transactions (maxFeePerGas and maxPriorityFeePerGas) calculated from eth_feeHistory.
+    The history is requested at most once per block, so all transactions of the command share it.
+    """
+
+    def __init__(self, w3, history_blocks=10):
+        self.w3 = w3
+        self.history_blocks = history_blocks
+        self._history_block = None
+        self._history = None
+
+    def _get_fee_history(self):
+        block_number = self.w3.eth.block_number
+        if block_number != self._history_block:
+            try:
+                self._history = self.w3.eth.fee_history(self.history_blocks, block_number,
+                                                        list(FEE_URGENCY_PERCENTILES.values()))
+            except ValueError:
+                # eth_feeHistory isn't supported by the node
+                self._history = None
+            self._history_block = block_number
+        return self._history
+
+    def _get_base_and_priority_fee(self, urgency):
+        if urgency not in FEE_URGENCY_PERCENTILES:
+            raise Exception("Unknown fee urgency: %s. Possible values: %s" % (
+                urgency, ", ".join(FEE_URGENCY_PERCENTILES)))
+        history = self._get_fee_history()
+        if not history or not history.get("baseFeePerGas") or not history["baseFeePerGas"][-1]:
+            return None
+        # the last element is the base fee of the next block
+        base_fee = history["baseFeePerGas"][-1]
+        column = list(FEE_URGENCY_PERCENTILES).index(urgency)
+        rewards = sorted(r[column] for r in history.get("reward") or [] if r)
+        priority_fee = rewards[len(rewards) // 2] if rewards else 0
+        return base_fee, priority_fee
+
+    def get_fee_params(self, urgency="medium"):
+        """ Return dict with maxFeePerGas and maxPriorityFeePerGas or None if the network doesn't support EIP-1559 """
+        fees = self._get_base_and_priority_fee(urgency)
+        if fees is None:
+            return None
+        base_fee, priority_fee = fees
+        return {"maxFeePerGas": BASE_FEE_MULTIPLIER * base_fee + priority_fee,
+                "maxPriorityFeePerGas": priority_fee}
+
+    def get_expected_gas_price(self, urgency="medium"):
+        """ Price per gas we expect to pay in the next block (base fee + priority fee) or None without EIP-1559 """
+        fees = self._get_base_and_priority_fee(urgency)
+        return sum(fees) if fees is not None else None
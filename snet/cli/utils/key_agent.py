@@ -0,0 +1,250 @@
+"""
+Key agent (see snet agent): decrypted private keys are kept in memory of a background process and commands
+ask the agent to sign transactions and messages instead of decrypting the key (with password prompt) each time.
+
+The agent listens on the Unix socket (only the owner can connect to it) and speaks JSON lines:
+one request {"op": ..., ...} per connection, one response {"result": ...} or {"error": ...}.
+Keys are forgotten ttl seconds after they were added. Private keys never leave the agent.
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from eth_account import Account
+from eth_account.messages import defunct_hash_message
+
+DEFAULT_AGENT_TTL = 3600
+AGENT_START_TIMEOUT = 10
+AGENT_REQUEST_TIMEOUT = 10
+
+
+def is_agent_supported():
+    return hasattr(socket, "AF_UNIX") and hasattr(socketserver, "ThreadingUnixStreamServer")
+
+
+def get_agent_socket_path():
+    """ SNET_AGENT_SOCK environment variable overrides the default ~/.snet/agent.sock (as SSH_AUTH_SOCK for ssh) """
+    return Path(os.environ.get("SNET_AGENT_SOCK") or Path.home().joinpath(".snet", "agent.sock"))
+
+
+def get_agent_log_path(socket_path):
+    """ The detached agent writes its errors next to the socket (~/.snet/agent.log by default) """
+    return Path(socket_path).with_suffix(".log")
+
+
+def _to_hex(value):
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + bytes(value).hex()
+    return value
+
+
+class KeyStore(object):
+    """ Decrypted keys with expiration times, safe to use from several threads """
+
+    def __init__(self, default_ttl=DEFAULT_AGENT_TTL, clock=time.monotonic):
+        self.default_ttl = default_ttl
+        self.clock = clock
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def add(self, key_id, private_key, ttl=None):
+        account = Account.from_key(private_key)
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._lock:
+            self._keys[key_id] = (account, self.clock() + ttl)
+        return account.address
+
+    def remove(self, key_id):
+        with self._lock:
+            return self._keys.pop(key_id, None) is not None
+
+    def remove_expired(self):
+        now = self.clock()
+        with self._lock:
+            for key_id in [k for k, (_, expires_at) in self._keys.items() if expires_at <= now]:
+                del self._keys[key_id]
+
+    def get_account(self, key_id):
+        """ Return account or None if the key hasn't been added or has expired """
+        self.remove_expired()
+        with self._lock:
+            account, _ = self._keys.get(key_id, (None, None))
+        return account
+
+    def list_keys(self):
+        self.remove_expired()
+        now = self.clock()
+        with self._lock:
+            return [{"key_id": key_id, "address": account.address, "expires_in": int(expires_at - now)}
+                    for key_id, (account, expires_at) in self._keys.items()]
+
+    def handle_request(self, request):
+        """ Process one request of the agent protocol, return the result (exception for the wrong request) """
+        op = request.get("op")
+        if op == "add":
+            return self.add(request["key_id"], request["private_key"], request.get("ttl"))
+        if op == "remove":
+            return self.remove(request["key_id"])
+        if op == "list":
+            return self.list_keys()
+        if op == "get_address":
+            account = self.get_account(request["key_id"])
+            return account.address if account is not None else None
+        if op in ("sign_transaction", "sign_message"):
+            account = self.get_account(request["key_id"])
+            if account is None:
+                raise Exception("Key %s is not in the agent (or has expired)" % request["key_id"])
+            if op == "sign_transaction":
+                return _to_hex(account.sign_transaction(request["transaction"]).rawTransaction)
+            h = defunct_hash_message(bytes.fromhex(request["message"][2:]))
+            return _to_hex(account.signHash(h).signature)
+        raise Exception("Unknown agent request: %s" % op)
+
+
+class _AgentRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get("op") == "stop":
+                response = {"result": True}
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+            else:
+                response = {"result": self.server.key_store.handle_request(request)}
+        except Exception as e:
+            response = {"error": str(e)}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def run_agent(socket_path, default_ttl=DEFAULT_AGENT_TTL, cleanup_interval=10):
+    """ Serve requests on socket_path until stop request (blocking) """
+    if not is_agent_supported():
+        raise Exception("snet agent requires Unix domain sockets, which are not supported on this platform")
+    socket_path = Path(socket_path)
+    socket_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if socket_path.exists():
+        if KeyAgentClient(socket_path).is_running():
+            raise Exception("Agent is already running on %s" % socket_path)
+        socket_path.unlink()
+
+    # socket is created with 0600 permissions: only the owner could connect to the agent
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(str(socket_path), _AgentRequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    server.key_store = KeyStore(default_ttl)
+
+    stopped = threading.Event()
+
+    def cleanup():
+        # expired keys are removed from memory even if nobody asks the agent
+        while not stopped.wait(cleanup_interval):
+            server.key_store.remove_expired()
+
+    threading.Thread(target=cleanup, daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        stopped.set()
+        server.server_close()
+        if socket_path.exists():
+            socket_path.unlink()
+
+
+def start_agent_process(socket_path, default_ttl=DEFAULT_AGENT_TTL):
+    """ Start the agent in the detached background process and wait until it accepts connections """
+    if not is_agent_supported():
+        raise Exception("snet agent requires Unix domain sockets, which are not supported on this platform")
+    # nobody reads the pipe of the detached process, so its stderr goes to the log file
+    log_path = get_agent_log_path(socket_path)
+    log_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    with open(os.open(str(log_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as log_file:
+        process = subprocess.Popen([sys.executable, "-m", "snet.cli.utils.key_agent",
+                                    "--socket", str(socket_path), "--ttl", str(default_ttl)],
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log_file,
+                                   start_new_session=True)
+    client = KeyAgentClient(socket_path)
+    deadline = time.monotonic() + AGENT_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if client.is_running():
+            return process.pid
+        if process.poll() is not None:
+            raise Exception("Agent failed to start: %s" % log_path.read_text("utf-8", "replace").strip())
+        time.sleep(0.1)
+    raise Exception("Agent hasn't started in %i seconds" % AGENT_START_TIMEOUT)
+
+
+class KeyAgentClient(object):
+    def __init__(self, socket_path=None):
+        self.socket_path = Path(socket_path or get_agent_socket_path())
+
+    def _request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(AGENT_REQUEST_TIMEOUT)
+            s.connect(str(self.socket_path))
+            s.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with s.makefile("rb") as f:
+                response = json.loads(f.readline())
+        if "error" in response:
+            raise Exception("Agent error: %s" % response["error"])
+        return response["result"]
+
+    def is_running(self):
+        if not is_agent_supported() or not self.socket_path.exists():
+            return False
+        try:
+            self._request({"op": "list"})
+            return True
+        except (socket.timeout, OSError, ValueError):
+            # the agent which doesn't answer in time is as good as not running
+            return False
+
+    def add_key(self, key_id, private_key, ttl=None):
+        return self._request({"op": "add", "key_id": key_id, "private_key": _to_hex(private_key), "ttl": ttl})
+
+    def remove_key(self, key_id):
+        return self._request({"op": "remove", "key_id": key_id})
+
+    def list_keys(self):
+        return self._request({"op": "list"})
+
+    def get_address(self, key_id):
+        return self._request({"op": "get_address", "key_id": key_id})
+
+    def sign_transaction(self, key_id, transaction):
+        transaction = {k: _to_hex(v) for k, v in transaction.items()}
+        raw_transaction = self._request({"op": "sign_transaction", "key_id": key_id, "transaction": transaction})
+        return bytes.fromhex(raw_transaction[2:])
+
+    def sign_message(self, key_id, message):
+        signature = self._request({"op": "sign_message", "key_id": key_id, "message": _to_hex(message)})
+        return bytes.fromhex(signature[2:])
+
+    def stop(self):
+        return self._request({"op": "stop"})
+
+
+def get_running_agent():
+    """ Return client of the running agent or None """
+    client = KeyAgentClient()
+    return client if client.is_running() else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="snet key agent (normally started with 'snet agent start')")
+    parser.add_argument("--socket", default=None, help="Path to the agent socket")
+    parser.add_argument("--ttl", type=int, default=DEFAULT_AGENT_TTL, help="Default lifetime of keys in seconds")
+    args = parser.parse_args()
+    run_agent(args.socket or get_agent_socket_path(), args.ttl)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+""" Counters and gauges of long-running commands with optional Prometheus text endpoint """
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics(object):
+    """ Thread-safe set of named numeric values (counters are increased with inc, gauges are set with set) """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def to_dict(self):
+        with self._lock:
+            return dict(self._values)
+
+    def to_prometheus_text(self):
+        return "".join("%s_%s %s\n" % (self.prefix, name, value) for name, value in sorted(self.to_dict().items()))
+
+
+def start_metrics_server(metrics, port, host="127.0.0.1"):
+    """ Serve metrics in Prometheus text format on http://host:port/metrics from the daemon thread """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,48 @@
+""" Local assignment of transaction nonces (pipelined transactions) """
+import threading
+
+# errors of eth_sendRawTransaction (geth, erigon, nethermind) which mean that the locally assigned nonce is stale
+NONCE_ERRORS = ("nonce too low", "nonce too high", "invalid nonce", "replacement transaction underpriced")
+
+
+def is_nonce_error(e):
+    """ True if the transaction has been rejected by the node because of its nonce """
+    message = str(e).lower()
+    return any(error in message for error in NONCE_ERRORS)
+
+
+class NonceManager(object):
+    """
+    Assign consecutive nonces to transactions of one address locally, so several transactions could be sent
+    without waiting for the receipts of the previous ones.
+    The first nonce is taken from the "pending" transaction count of the node.
+    If the transaction with the assigned nonce hasn't been sent, the nonce should be returned with release().
+    If the node has rejected the nonce (see is_nonce_error), resync() makes the next transaction take it from the node.
+    """
+
+    def __init__(self, w3, address):
+        self.w3 = w3
+        self.address = address
+        self._next_nonce = None
+        self._lock = threading.Lock()
+
+    def next_nonce(self):
+        with self._lock:
+            if self._next_nonce is None:
+                self._next_nonce = self.w3.eth.get_transaction_count(self.address, "pending")
+            nonce = self._next_nonce
+            self._next_nonce += 1
+            return nonce
+
+    def release(self, nonce):
+        with self._lock:
+            if self._next_nonce == nonce + 1:
+                self._next_nonce = nonce
+            else:
+                # transactions with the bigger nonces have been sent already and they can't be mined before
+                # the gap is filled, so the next transaction should take the nonce from the node again
+                self._next_nonce = None
+
+    def resync(self):
+        with self._lock:
+            self._next_nonce = None
@@ -0,0 +1,58 @@
+""" Per-phase latency instrumentation (see snet client call --profile) """
+import json
+import time
+from contextlib import contextmanager
+
+
+class PhaseTimer(object):
+    """
+    Measure durations of named phases with monotonic clock.
+    Phases could be nested: nested phase is reported as "outer/inner" and its time is included into the outer phase.
+    If the same phase is entered several times, its durations are summed up.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.durations = {}
+        self.counts = {}
+        self._stack = []
+
+    @contextmanager
+    def phase(self, name):
+        self._stack.append(name)
+        path = "/".join(self._stack)
+        # phases are reported in the order of their first start
+        self.durations.setdefault(path, 0.0)
+        self.counts.setdefault(path, 0)
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.durations[path] += time.monotonic() - started_at
+            self.counts[path] += 1
+            self._stack.pop()
+
+    def total(self):
+        return time.monotonic() - self.started_at
+
+    def to_dict(self):
+        return {"total_ms": round(self.total() * 1000, 3),
+                "phases": [{"phase": path, "ms": round(duration * 1000, 3), "count": self.counts[path]}
+                           for path, duration in self.durations.items()]}
+
+    def format_report(self):
+        """ Human readable breakdown (one phase per line, nested phases are indented) """
+        rez = self.to_dict()
+        lines = ["%-40s %10s" % ("phase", "ms")]
+        for p in rez["phases"]:
+            depth = p["phase"].count("/")
+            name = "  " * depth + p["phase"].split("/")[-1]
+            if p["count"] > 1:
+                name += " (x%i)" % p["count"]
+            lines.append("%-40s %10.1f" % (name, p["ms"]))
+        lines.append("%-40s %10.1f" % ("total", rez["total_ms"]))
+        return "\n".join(lines)
+
+    def save_json(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
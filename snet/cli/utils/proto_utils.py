@@ -1,9 +1,36 @@
 """ Utils related to protobuf """
+import base64
+import importlib
+import json
+import math
+import mmap
 import sys
 from pathlib import Path
 import os
 
-from google.protobuf import json_format
+from google.protobuf import descriptor_pb2, json_format
+from google.protobuf.descriptor import FieldDescriptor
+
+METHOD_INDEX_FILE = "method_index.json"
+METHOD_INDEX_VERSION = 1
+
+
+def get_message_class(descriptor):
+    """
+    Return the generated class of the message descriptor.
+    Message classes are attributes of the _pb2 module of their .proto file
+    (nested messages are attributes of the containing message class).
+    """
+    names = []
+    while descriptor is not None:
+        names.insert(0, descriptor.name)
+        file_descriptor = descriptor.file
+        descriptor = descriptor.containing_type
+    module_name = file_descriptor.name[:-len(".proto")].replace("-", "_").replace("/", ".") + "_pb2"
+    message_class = importlib.import_module(module_name)
+    for name in names:
+        message_class = getattr(message_class, name)
+    return message_class
 
 
 def import_protobuf_from_dir(proto_dir, method_name, service_name=None):
@@ -20,7 +47,7 @@ def import_protobuf_from_dir(proto_dir, method_name, service_name=None):
 
     good_rez = []
     for grpc_py_file in grpc_py_files:
-        is_found, rez = _import_protobuf_from_file(grpc_py_file, method_name, service_name)
+        is_found, rez = import_protobuf_from_file(grpc_py_file, method_name, service_name)
         if is_found:
             good_rez.append(rez)
     if len(good_rez) == 0:
@@ -36,7 +63,7 @@ def import_protobuf_from_dir(proto_dir, method_name, service_name=None):
     return good_rez[0]
 
 
-def _import_protobuf_from_file(grpc_py_file, method_name, service_name=None):
+def import_protobuf_from_file(grpc_py_file, method_name, service_name=None):
     """
     helper function which try to import method from the given _pb2_grpc.py file
     service_name should be provided only in case of name conflict
@@ -62,8 +89,8 @@ def _import_protobuf_from_file(grpc_py_file, method_name, service_name=None):
         service_descriptor = getattr(pb2, "DESCRIPTOR").services_by_name[service_name]
         for method in service_descriptor.methods:
             if method.name == method_name:
-                request_class = method.input_type._concrete_class
-                response_class = method.output_type._concrete_class
+                request_class = get_message_class(method.input_type)
+                response_class = get_message_class(method.output_type)
                 stub_class = getattr(pb2_grpc, "%sStub" % service_name)
 
                 found_services.append(service_name)
@@ -75,6 +102,181 @@ def _import_protobuf_from_file(grpc_py_file, method_name, service_name=None):
     return True, (stub_class, request_class, response_class)
 
 
+def get_method_streaming_kind(method_descriptor):
+    """ Return "unary", "client_streaming", "server_streaming" or "bidi_streaming" for the given method descriptor """
+    client_streaming = getattr(method_descriptor, "client_streaming", None)
+    server_streaming = getattr(method_descriptor, "server_streaming", None)
+    if client_streaming is None or server_streaming is None:
+        method_proto = descriptor_pb2.MethodDescriptorProto()
+        method_descriptor.CopyToProto(method_proto)
+        client_streaming, server_streaming = method_proto.client_streaming, method_proto.server_streaming
+    if client_streaming and server_streaming:
+        return "bidi_streaming"
+    if client_streaming:
+        return "client_streaming"
+    if server_streaming:
+        return "server_streaming"
+    return "unary"
+
+
+def build_method_index(proto_dir):
+    """
+    Import all compiled grpc modules from proto_dir (only once) and build the index of all methods.
+    Return dict which maps fully qualified method name (<package>.<service>.<method>) to
+    the module, stub class, request/response types, streaming kind and package of this method
+    """
+    proto_dir = Path(proto_dir)
+    sys.path.append(str(proto_dir))
+    methods = {}
+    for grpc_py_file in sorted(p.name for p in proto_dir.glob("*_pb2_grpc.py")):
+        prefix = grpc_py_file[:-12]
+        pb2 = __import__("%s_pb2" % prefix)
+        pb2_grpc = __import__("%s_pb2_grpc" % prefix)
+        package = pb2.DESCRIPTOR.package
+        for service_descriptor in pb2.DESCRIPTOR.services_by_name.values():
+            stub_name = "%sStub" % service_descriptor.name
+            if not hasattr(pb2_grpc, stub_name):
+                continue
+            for method in service_descriptor.methods:
+                methods[method.full_name] = {
+                    "package": package,
+                    "service": service_descriptor.name,
+                    "method": method.name,
+                    "module": prefix,
+                    "stub": stub_name,
+                    "request_type": method.input_type.full_name,
+                    "response_type": method.output_type.full_name,
+                    "streaming": get_method_streaming_kind(method)
+                }
+    return {"version": METHOD_INDEX_VERSION, "methods": methods}
+
+
+def save_method_index(proto_dir, index):
+    with open(Path(proto_dir).joinpath(METHOD_INDEX_FILE), "w") as f:
+        json.dump(index, f, indent=4)
+
+
+def load_method_index(proto_dir):
+    """ Return method index saved in proto_dir, or None if there is no (compatible) index """
+    index_file = Path(proto_dir).joinpath(METHOD_INDEX_FILE)
+    if not index_file.is_file():
+        return None
+    with open(index_file) as f:
+        index = json.load(f)
+    if index.get("version") != METHOD_INDEX_VERSION:
+        return None
+    return index
+
+
+def find_method_in_index(index, method_name, service_name=None):
+    """
+    Find method in the index built by build_method_index.
+    service_name could be a simple or a fully qualified (<package>.<service>) name,
+    and it should be provided only in the case of conflicting method names.
+    """
+    found = []
+    for full_name, entry in index["methods"].items():
+        if entry["method"] != method_name:
+            continue
+        service_full_name = full_name[:-len(method_name) - 1]
+        if service_name and service_name not in (entry["service"], service_full_name):
+            continue
+        found.append(entry)
+    if len(found) == 0:
+        raise Exception("Error while loading protobuf. Cannot find method=%s" % method_name)
+    if len(found) > 1:
+        services = ", ".join(sorted("%s.%s" % (e["package"], e["service"]) if e["package"] else e["service"]
+                                    for e in found))
+        raise Exception("Error while loading protobuf. We found methods %s in multiply services [%s]."
+                        " You should specify service_name." % (method_name, services))
+    return found[0]
+
+
+def import_protobuf_from_index(proto_dir, index_entry):
+    """
+    Import only the module which contains the method described by index_entry (see find_method_in_index)
+    Return stub_class, request_class, response_class
+    """
+    sys.path.append(str(Path(proto_dir)))
+    pb2 = __import__("%s_pb2" % index_entry["module"])
+    pb2_grpc = __import__("%s_pb2_grpc" % index_entry["module"])
+    service_descriptor = pb2.DESCRIPTOR.services_by_name[index_entry["service"]]
+    method = service_descriptor.methods_by_name[index_entry["method"]]
+    stub_class = getattr(pb2_grpc, index_entry["stub"])
+    return stub_class, get_message_class(method.input_type), get_message_class(method.output_type)
+
+
+def _encode_varint(value):
+    rez = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            rez.append(byte | 0x80)
+        else:
+            rez.append(byte)
+            return bytes(rez)
+
+
+def write_delimited_message(f, message):
+    """ Write protobuf message to the binary file prefixed by its varint encoded length (standard delimited format) """
+    data = message.SerializeToString()
+    f.write(_encode_varint(len(data)))
+    f.write(data)
+
+
+def is_buffer(value):
+    return isinstance(value, (mmap.mmap, memoryview, bytearray))
+
+
+def materialize_buffers(value):
+    """ Recursively convert buffers (mmap, memoryview, bytearray) in call params to bytes """
+    if isinstance(value, dict):
+        return {k: materialize_buffers(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [materialize_buffers(v) for v in value]
+    if is_buffer(value):
+        return bytes(value)
+    return value
+
+
+def build_serialized_request(request_class, params):
+    """
+    Build request message from params and serialize it.
+    Top level (non repeated) bytes fields could be given as buffers (for example mmap of the file): we don't copy
+    them into the message, but append them to the serialized message (protobuf allows any order of fields),
+    so their content is copied only once. Other buffers are converted to bytes.
+    """
+    fields = request_class.DESCRIPTOR.fields_by_name
+    raw_fields = []
+    other_params = {}
+    for k, v in params.items():
+        field = fields.get(k)
+        if (is_buffer(v) and field is not None and field.type == FieldDescriptor.TYPE_BYTES
+                and field.label != FieldDescriptor.LABEL_REPEATED):
+            raw_fields.append((field.number, v))
+        else:
+            other_params[k] = materialize_buffers(v)
+
+    parts = [request_class(**other_params).SerializeToString()]
+    for number, buffer in raw_fields:
+        # proto3 doesn't serialize empty bytes fields
+        if len(buffer):
+            parts += [_encode_varint((number << 3) | 2), _encode_varint(len(buffer)), buffer]
+    return b"".join(parts)
+
+
+def switch_to_serialized_requests(call_fn):
+    """ Allow to pass already serialized requests (see build_serialized_request) to GRPC call """
+
+    def serializer(request):
+        if isinstance(request, bytes):
+            return request
+        return request.SerializeToString()
+
+    call_fn._request_serializer = serializer
+
+
 def switch_to_json_payload_encoding(call_fn, response_class):
     """ Switch payload encoding to JSON for GRPC call """
 
@@ -88,3 +290,184 @@ def switch_to_json_payload_encoding(call_fn, response_class):
 
     call_fn._request_serializer = json_serializer
     call_fn._response_deserializer = json_deserializer
+
+
+class _CannotSerializeDirectly(Exception):
+    pass
+
+
+_INT64_TYPES = (FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64, FieldDescriptor.TYPE_SINT64,
+                FieldDescriptor.TYPE_FIXED64, FieldDescriptor.TYPE_SFIXED64)
+_FLOAT_TYPES = (FieldDescriptor.TYPE_FLOAT, FieldDescriptor.TYPE_DOUBLE)
+
+
+def _is_map_field(field):
+    return field.message_type is not None and field.message_type.GetOptions().map_entry
+
+
+def _default_json_value(field):
+    """ Default value of the field in the same form as MessageToJson with including_default_value_fields """
+    if _is_map_field(field):
+        return {}
+    if field.label == FieldDescriptor.LABEL_REPEATED:
+        return []
+    if field.type == FieldDescriptor.TYPE_ENUM:
+        return field.enum_type.values_by_number[0].name if 0 in field.enum_type.values_by_number else 0
+    if field.type in _INT64_TYPES:
+        return "0"
+    if field.type in _FLOAT_TYPES:
+        return 0.0
+    return field.default_value if field.type != FieldDescriptor.TYPE_BYTES else ""
+
+
+_INT_RANGES = {FieldDescriptor.CPPTYPE_INT32: (-2 ** 31, 2 ** 31 - 1),
+               FieldDescriptor.CPPTYPE_UINT32: (0, 2 ** 32 - 1),
+               FieldDescriptor.CPPTYPE_INT64: (-2 ** 63, 2 ** 63 - 1),
+               FieldDescriptor.CPPTYPE_UINT64: (0, 2 ** 64 - 1)}
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _single_value_to_json(field, value):
+    """
+    Convert the value to the JSON form of MessageToJson. Values which we cannot convert directly (including values
+    of the wrong type) raise _CannotSerializeDirectly, so they go through the protobuf message, which checks them
+    """
+    if field.type == FieldDescriptor.TYPE_MESSAGE:
+        # well-known types have special JSON mapping, so we don't serialize them directly
+        if not isinstance(value, dict) or field.message_type.full_name.startswith("google.protobuf."):
+            raise _CannotSerializeDirectly()
+        return _params_to_json_dict(field.message_type, value)
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        if not isinstance(value, bytes) and not is_buffer(value):
+            raise _CannotSerializeDirectly()
+        return base64.b64encode(value).decode("ascii")
+    if field.cpp_type == FieldDescriptor.CPPTYPE_STRING and isinstance(value, str):
+        return value
+    if field.cpp_type == FieldDescriptor.CPPTYPE_BOOL and isinstance(value, bool):
+        return value
+    if field.cpp_type in _INT_RANGES and _is_int(value):
+        low, high = _INT_RANGES[field.cpp_type]
+        if low <= value <= high:
+            # 64 bit integers are strings in JSON mapping
+            return str(value) if field.type in _INT64_TYPES else value
+    if field.cpp_type in (FieldDescriptor.CPPTYPE_FLOAT, FieldDescriptor.CPPTYPE_DOUBLE) \
+            and (_is_int(value) or isinstance(value, float)) and math.isfinite(value):
+        return float(value)
+    if field.cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+        # enums are given by name or number and are written by name (unknown numbers are written as numbers)
+        if isinstance(value, str) and value in field.enum_type.values_by_name:
+            return value
+        if _is_int(value) and value in field.enum_type.values_by_number:
+            return field.enum_type.values_by_number[value].name
+    raise _CannotSerializeDirectly()
+
+
+def _map_key_to_json(key_field, key):
+    if key_field.cpp_type == FieldDescriptor.CPPTYPE_STRING and isinstance(key, str):
+        return key
+    if key_field.cpp_type == FieldDescriptor.CPPTYPE_BOOL and isinstance(key, bool):
+        return "true" if key else "false"
+    if key_field.cpp_type in _INT_RANGES and _is_int(key):
+        return str(key)
+    raise _CannotSerializeDirectly()
+
+
+def _params_to_json_dict(descriptor, params):
+    unknown_fields = set(params) - set(descriptor.fields_by_name)
+    if unknown_fields:
+        raise ValueError('Protocol message %s has no "%s" field.' % (descriptor.name, sorted(unknown_fields)[0]))
+    rez = {}
+    for field in descriptor.fields:
+        if field.name not in params:
+            # MessageToJson(..., including_default_value_fields=True) skips messages and fields with presence
+            if (field.type == FieldDescriptor.TYPE_MESSAGE and not _is_map_field(field)
+                    and field.label != FieldDescriptor.LABEL_REPEATED):
+                continue
+            if field.containing_oneof is not None:
+                continue
+            rez[field.name] = _default_json_value(field)
+            continue
+        value = params[field.name]
+        if _is_map_field(field):
+            if not isinstance(value, dict):
+                raise _CannotSerializeDirectly()
+            key_field = field.message_type.fields_by_name["key"]
+            value_field = field.message_type.fields_by_name["value"]
+            rez[field.name] = {_map_key_to_json(key_field, k): _single_value_to_json(value_field, v)
+                               for k, v in value.items()}
+        elif field.label == FieldDescriptor.LABEL_REPEATED:
+            if not isinstance(value, (list, tuple)):
+                raise _CannotSerializeDirectly()
+            rez[field.name] = [_single_value_to_json(field, v) for v in value]
+        else:
+            rez[field.name] = _single_value_to_json(field, value)
+    return rez
+
+
+def build_json_request(request_class, params):
+    """
+    Serialize call params directly to JSON (proto3 JSON mapping with original field names) for services with
+    json payload encoding, without building protobuf message and converting it to JSON.
+    We fall back to the message based path (MessageToJson) for values which need the special JSON mapping
+    (well-known types, not finite floats, protobuf messages given as values) and for values of the wrong type
+    or out of range, so they raise the same TypeError/ValueError as request_class(**params)
+    """
+    try:
+        return json.dumps(_params_to_json_dict(request_class.DESCRIPTOR, params)).encode("utf-8")
+    except _CannotSerializeDirectly:
+        message = request_class(**materialize_buffers(params))
+        return bytes(json_format.MessageToJson(message, True, preserving_proto_field_name=True), "utf-8")
+
+
+class LazyJsonMessage(object):
+    """
+    Response of the service with json payload encoding.
+    JSON is parsed into protobuf message only when some field of the message is accessed,
+    to_dict() returns the JSON as it is (without the round trip through protobuf message)
+    """
+
+    def __init__(self, data, message_class):
+        self._data = data
+        self._message_class = message_class
+        self._message = None
+
+    @property
+    def message(self):
+        if self._message is None:
+            self._message = self._message_class()
+            json_format.Parse(self._data, self._message, True)
+        return self._message
+
+    def to_dict(self):
+        return json.loads(self._data)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.message, name)
+
+    def __str__(self):
+        return str(self.message)
+
+
+def switch_to_fast_json_payload_encoding(call_fn, response_class):
+    """
+    Switch payload encoding to JSON for GRPC call: requests should be already serialized by build_json_request
+    and responses are returned as LazyJsonMessage
+    """
+
+    def json_serializer(request):
+        if isinstance(request, bytes):
+            return request
+        return bytes(json_format.MessageToJson(request, True, preserving_proto_field_name=True), "utf-8")
+
+    def json_deserializer(data):
+        return LazyJsonMessage(data, response_class)
+
+    call_fn._request_serializer = json_serializer
+    call_fn._response_deserializer = json_deserializer
@@ -0,0 +1,90 @@
+""" Waiting for transaction receipts of many transactions at once """
+import time
+
+from web3.exceptions import TransactionNotFound
+
+# the same default as in web3 wait_for_transaction_receipt
+DEFAULT_RECEIPT_TIMEOUT = 120
+
+
+class ReceiptWaiter(object):
+    """
+    Wait for receipts of several transactions together: receipts are checked once per new block for all transactions
+    which are still pending. New blocks are taken from the node block filter (eth_newBlockFilter) or, if the node
+    doesn't support filters, from polling of the block number.
+        - timeout: raise exception if not all receipts are received in the given number of seconds
+                   (None - wait forever, it should be requested explicitly)
+        - confirmations: number of blocks which should be mined on top of the block with the transaction
+    """
+
+    def __init__(self, w3, timeout=DEFAULT_RECEIPT_TIMEOUT, confirmations=0, poll_interval=1):
+        self.w3 = w3
+        self.timeout = timeout
+        self.confirmations = confirmations
+        self.poll_interval = poll_interval
+
+    def _get_receipt(self, txn_hash):
+        try:
+            receipt = self.w3.eth.get_transaction_receipt(txn_hash)
+        except TransactionNotFound:
+            return None
+        if not receipt or receipt.get("blockHash") is None:
+            return None
+        return receipt
+
+    def _create_block_filter(self):
+        try:
+            return self.w3.eth.filter("latest")
+        except ValueError:
+            # the node doesn't support filters
+            return None
+
+    def _wait_for_new_block(self, block_filter, last_block, deadline):
+        while deadline is None or time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            if block_filter is not None:
+                try:
+                    if block_filter.get_new_entries():
+                        return self.w3.eth.block_number
+                    continue
+                except ValueError:
+                    # filter could be removed by the node after inactivity, we fall back to polling
+                    block_filter = None
+            block_number = self.w3.eth.block_number
+            if block_number != last_block:
+                return block_number
+        return last_block
+
+    def wait(self, txn_hashes, on_missing=None):
+        """
+        Return receipts in the order of txn_hashes.
+        on_missing(txn_hash) is called on each new block for transactions without receipt (for example,
+        it could resend the dropped transaction or raise exception for the replaced one)
+        """
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        receipts = {}
+        block_filter = self._create_block_filter()
+        try:
+            block_number = self.w3.eth.block_number
+            while True:
+                for txn_hash in txn_hashes:
+                    if txn_hash in receipts:
+                        continue
+                    receipt = self._get_receipt(txn_hash)
+                    if receipt is None:
+                        if on_missing is not None:
+                            on_missing(txn_hash)
+                    elif block_number - receipt["blockNumber"] >= self.confirmations:
+                        receipts[txn_hash] = receipt
+                if len(receipts) == len(set(txn_hashes)):
+                    return [receipts[txn_hash] for txn_hash in txn_hashes]
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise Exception("Transactions haven't been mined in %s seconds: %s" % (
+                        self.timeout, ", ".join(self.w3.to_hex(h) for h in txn_hashes if h not in receipts)))
+                block_number = self._wait_for_new_block(block_filter, block_number, deadline)
+        finally:
+            if block_filter is not None:
+                try:
+                    self.w3.eth.uninstall_filter(block_filter.filter_id)
+                except ValueError:
+                    pass
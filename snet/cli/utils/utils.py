@@ -1,5 +1,7 @@
+import atexit
 import json
 import os
+import pickle
 import subprocess
 import functools
 import re
@@ -11,9 +13,20 @@ from pathlib import Path, PurePath
 from lighthouseweb3 import Lighthouse
 import io
 import tarfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
 import web3
 import grpc
+from grpc_health.v1 import health_pb2, health_pb2_grpc
 from grpc_tools.protoc import main as protoc
 from trezorlib.cli.firmware import download
 
@@ -235,19 +248,163 @@ def remove_http_https_prefix(endpoint):
     return endpoint
 
 
-def open_grpc_channel(endpoint):
+DEFAULT_GRPC_MAX_MESSAGE_LENGTH = 1024 ** 3
+
+_grpc_channels_cache = {}
+_grpc_channels_lock = threading.Lock()
+
+
+def get_grpc_channel_options(max_message_length=None, keepalive_time_ms=None, http2_window_size=None):
+    """
+    Build grpc channel options:
+        - max_message_length limits both send and receive messages (1GB by default)
+        - keepalive_time_ms enables http2 keepalive pings
+        - http2_window_size sets fixed http2 stream window (instead of the dynamic BDP based window)
+    """
+    max_message_length = max_message_length or DEFAULT_GRPC_MAX_MESSAGE_LENGTH
+    options = [('grpc.max_send_message_length', max_message_length),
+               ('grpc.max_receive_message_length', max_message_length)]
+    if keepalive_time_ms:
+        options += [('grpc.keepalive_time_ms', keepalive_time_ms),
+                    ('grpc.keepalive_permit_without_calls', 1),
+                    ('grpc.http2.max_pings_without_data', 0)]
+    if http2_window_size:
+        options += [('grpc.http2.lookahead_bytes', http2_window_size),
+                    ('grpc.http2.bdp_probe', 0)]
+    return options
+
+
+def open_grpc_channel(endpoint, options=None, reuse=False):
     """
        open grpc channel:
            - for http://  we open insecure_channel
            - for https:// we open secure_channel (with default credentials)
            - without prefix we open insecure_channel
+       options are grpc channel options (see get_grpc_channel_options)
+       if reuse is True we return already opened channel with the same endpoint and options
     """
-    _GB = 1024 ** 3
-    options = [('grpc.max_send_message_length', _GB),
-               ('grpc.max_receive_message_length', _GB)]
+    if options is None:
+        options = get_grpc_channel_options()
+    if not reuse:
+        return _create_grpc_channel(endpoint, options)
+
+    key = (endpoint, tuple(options))
+    with _grpc_channels_lock:
+        if key not in _grpc_channels_cache:
+            if not _grpc_channels_cache:
+                atexit.register(close_grpc_channels)
+            _grpc_channels_cache[key] = _create_grpc_channel(endpoint, options)
+        return _grpc_channels_cache[key]
+
+
+def _create_grpc_channel(endpoint, options):
+    if endpoint.startswith("https://"):
+        return grpc.secure_channel(remove_http_https_prefix(endpoint),
+                                   grpc.ssl_channel_credentials(root_certificates=certificate),
+                                   options=options)
+    return grpc.insecure_channel(remove_http_https_prefix(endpoint), options=options)
+
+
+def close_grpc_channels():
+    """ Close all channels opened with reuse=True (called at exit, long-running users could call it earlier) """
+    with _grpc_channels_lock:
+        channels = list(_grpc_channels_cache.values())
+        _grpc_channels_cache.clear()
+        atexit.unregister(close_grpc_channels)
+    for channel in channels:
+        channel.close()
+
+
+def open_grpc_aio_channel(endpoint, options=None):
+    """ The same as open_grpc_channel, but for asyncio (grpc.aio) """
+    if options is None:
+        options = get_grpc_channel_options()
     if endpoint.startswith("https://"):
-        return grpc.secure_channel(remove_http_https_prefix(endpoint), grpc.ssl_channel_credentials(root_certificates=certificate))
-    return grpc.insecure_channel(remove_http_https_prefix(endpoint))
+        return grpc.aio.secure_channel(remove_http_https_prefix(endpoint),
+                                       grpc.ssl_channel_credentials(root_certificates=certificate),
+                                       options=options)
+    return grpc.aio.insecure_channel(remove_http_https_prefix(endpoint), options=options)
+
+
+def check_endpoint_health(endpoint, timeout=10, options=None):
+    """
+    Check endpoint via the standard grpc health checking service.
+    options are grpc channel options (see get_grpc_channel_options)
+    Return (is_available, rtt), where rtt is the round trip time of the check in seconds
+    """
+    channel = open_grpc_channel(endpoint, options)
+    try:
+        stub = health_pb2_grpc.HealthStub(channel)
+        start = time.monotonic()
+        response = stub.Check(health_pb2.HealthCheckRequest(service=""), timeout=timeout)
+        rtt = time.monotonic() - start
+        return response.status == health_pb2.HealthCheckResponse.SERVING, rtt
+    except Exception:
+        return False, None
+    finally:
+        channel.close()
+
+
+def is_grpc_channel_ready(channel, timeout):
+    """ Return True if the connection of the channel has been established in timeout seconds """
+    try:
+        grpc.channel_ready_future(channel).result(timeout=timeout)
+        return True
+    except grpc.FutureTimeoutError:
+        return False
+
+
+@contextmanager
+def file_lock(lock_file):
+    """ Exclusive lock between processes (and threads) based on the lock file """
+    lock_file = Path(lock_file)
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_file, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    # LK_LOCK gives up after 10 seconds, so we try again
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_pickle_atomically(file_name, obj):
+    """ Pickle obj to the temporary file and rename it, so readers never see a partially written file """
+    file_name = Path(file_name)
+    file_name.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = file_name.with_suffix(".%i.%i.tmp" % (os.getpid(), threading.get_ident()))
+    with open(tmp_file, "wb") as f:
+        pickle.dump(obj, f)
+    os.replace(tmp_file, file_name)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of values (None for empty values)
+    >>> percentile([4, 1, 3, 2], 50)
+    2
+    >>> percentile([4, 1, 3, 2], 99)
+    4
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(-(-p * len(values) // 100)), 1)
+    return values[rank - 1]
 
 
 def rgetattr(obj, attr):